@@ -2,6 +2,9 @@ from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth import get_user_model
 
+from thoughts.LLM import get_embedder
+from thoughts.embedding_backends import BACKEND_CHOICES
+
 from .models import CustomUser
 
 User = get_user_model()
@@ -32,17 +35,34 @@ class LoginForm(forms.Form):
 class ApiKeyForm(forms.ModelForm):
     class Meta:
         model = CustomUser
-        fields = ['api_key', 'max_chunk_size_setting']
+        fields = ['api_key', 'max_chunk_size_setting', 'embedding_backend']
         labels = {
             'api_key': 'OpenAI API Key',
             'max_chunk_size_setting': 'Maximum Chunk Size',
+            'embedding_backend': 'Embedding Backend',
         }
         help_texts = {
             'api_key': 'Enter your personal OpenAI API key. Obtain a key from ' +
                        '<a href="https://platform.openai.com/api-keys" target="_blank">OpenAI API Keys</a>.',
             'max_chunk_size_setting': 'Set the maximum size of text chunks for processing (default is 600 characters).',
+            'embedding_backend': 'Used for the gardens you create from now on. The local model needs no API key.',
         }
         widgets = {
             'api_key': forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Enter your API Key here'}),
             'max_chunk_size_setting': forms.NumberInput(attrs={'class': 'form-control'}),
-        }
\ No newline at end of file
+            'embedding_backend': forms.Select(attrs={'class': 'form-control'}),
+        }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Only offer the backends this deployment can embed with
+        self.fields['embedding_backend'].choices = [('', '---------')] + [
+            (name, label) for name, label in BACKEND_CHOICES if get_embedder(name).unavailable_reason() is None
+        ]
+
+    def clean_embedding_backend(self):
+        backend = self.cleaned_data['embedding_backend']
+        reason = get_embedder(backend).unavailable_reason() if backend else None
+        if reason:
+            raise forms.ValidationError(f"This backend can't be used here: {reason}.")
+        return backend
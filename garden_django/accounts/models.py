@@ -1,12 +1,16 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 
+from thoughts.embedding_backends import BACKEND_CHOICES
+
 
 # Create your models here.
 class CustomUser(AbstractUser):
     api_key = models.CharField(max_length=255, blank=True, null=True)
     use_system_api_key = models.BooleanField(default=False)
     max_chunk_size_setting = models.IntegerField(default=600)
+    # Embedding backend of the gardens this user creates; blank means settings.EMBEDDING_BACKEND
+    embedding_backend = models.CharField(max_length=20, choices=BACKEND_CHOICES, blank=True)
 
     telegram_id = models.CharField(max_length=255, blank=True, null=True)
     email = models.EmailField(unique=True)
\ No newline at end of file
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 from django.core.exceptions import ImproperlyConfigured
 
 from urllib.parse import urlparse
@@ -59,10 +60,23 @@ AUTH_USER_MODEL = 'accounts.CustomUser'
 
 TOKEN_TG = get_env_variable('TOKEN_TG')
 SYSTEM_PASSWORD = get_env_variable('SYSTEM_PASSWORD')
+# Threads the Telegram bot's handlers share for database queries and other blocking calls
+TELEGRAM_THREADS = int(get_env_variable('TELEGRAM_THREADS', 8))
+# Seconds the bot keeps a Telegram account's user in memory, and how many it keeps
+TELEGRAM_USER_CACHE_TTL = int(get_env_variable('TELEGRAM_USER_CACHE_TTL', 300))
+TELEGRAM_USER_CACHE_SIZE = int(get_env_variable('TELEGRAM_USER_CACHE_SIZE', 10000))
+# Free-text messages go to the command whose examples they resemble most (cosine similarity), when the best
+# match scores at least TELEGRAM_INTENT_MIN_SIMILARITY and beats the next by TELEGRAM_INTENT_MIN_MARGIN;
+# otherwise the chat model decides. Decisions are cached per message text.
+TELEGRAM_INTENT_MIN_SIMILARITY = float(get_env_variable('TELEGRAM_INTENT_MIN_SIMILARITY', 0.5))
+TELEGRAM_INTENT_MIN_MARGIN = float(get_env_variable('TELEGRAM_INTENT_MIN_MARGIN', 0.03))
+TELEGRAM_INTENT_CACHE_TTL = int(get_env_variable('TELEGRAM_INTENT_CACHE_TTL', 60 * 60 * 24 * 30))
 
 # Application definition
 
 INSTALLED_APPS = [
+    # First, so that runserver serves the ASGI application and async views don't tie up a thread each
+    'daphne',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -106,6 +120,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'garden.wsgi.application'
+ASGI_APPLICATION = 'garden.asgi.application'
 
 
 DOMAIN = get_env_variable('DOMAIN', 'localhost')
@@ -213,10 +228,88 @@ else:
     MEDIA_URL = '/media/'
     MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Vector search
+# Distance used by the snippet ANN index and by every similarity query: 'cosine', 'ip' (inner product) or 'l2'.
+# OpenAI embeddings are normalized, so cosine and inner product rank identically; ip is the cheapest.
+# The index operator class is picked when the migration runs, so set this before migrating.
+VECTOR_DISTANCE = get_env_variable('VECTOR_DISTANCE', 'cosine')
+# Size of stored embeddings. text-embedding-3 models can return shortened embeddings (e.g. 256 or 512),
+# which shrink tables, indexes and distance computations; other models only come in their native size.
+EMBEDDING_DIMENSIONS = int(get_env_variable('EMBEDDING_DIMENSIONS', 1536))
+# Default embedding backend, 'openai' or 'local' (a CPU model, see LOCAL_EMBEDDING_* in thoughts/embedding_backends.py);
+# gardens and users can pick their own. Every backend must produce EMBEDDING_DIMENSIONS dimensions.
+EMBEDDING_BACKEND = get_env_variable('EMBEDDING_BACKEND', 'openai')
+# Column type of stored embeddings: 'vector' (32-bit floats) or 'halfvec' (16-bit floats, half the size).
+# After changing either setting on an existing database, run `manage.py convert_embeddings`.
+VECTOR_STORAGE = get_env_variable('VECTOR_STORAGE', 'vector')
+# Size of the HNSW candidate list per query (hnsw.ef_search): higher means better recall and slower search.
+HNSW_EF_SEARCH = int(get_env_variable('HNSW_EF_SEARCH', 40))
+# Default search mode: 'hybrid' (vector + full text, fused by rank), 'vector' or 'lexical' (no embedding call)
+SEARCH_MODE = get_env_variable('SEARCH_MODE', 'hybrid')
+# Hybrid search fuses the top HYBRID_CANDIDATES of each list, scoring 1 / (RRF_K + rank) per list
+HYBRID_CANDIDATES = int(get_env_variable('HYBRID_CANDIDATES', 50))
+RRF_K = int(get_env_variable('RRF_K', 60))
+# Seed listings show SEEDS_PER_PAGE seeds at a time; each user's first page is cached for SEED_LISTING_CACHE_TTL seconds
+SEEDS_PER_PAGE = int(get_env_variable('SEEDS_PER_PAGE', 20))
+SEED_LISTING_CACHE_TTL = int(get_env_variable('SEED_LISTING_CACHE_TTL', 300))
+# Coarse search ranks seeds by their centroid first, then snippets within the top COARSE_SEEDS seeds only
+COARSE_SEEDS = int(get_env_variable('COARSE_SEEDS', 20))
+
+# Chunking: snippets hold at most CHUNK_MAX_TOKENS tokens of the embedding model (and the user's maximum chunk size
+# in characters), and repeat the last CHUNK_OVERLAP_TOKENS tokens or so of the snippet before them
+CHUNK_MAX_TOKENS = int(get_env_variable('CHUNK_MAX_TOKENS', 512))
+CHUNK_OVERLAP_TOKENS = int(get_env_variable('CHUNK_OVERLAP_TOKENS', 0))
+
+# Snippets stored without an embedding (e.g. the API was down) are embedded by a task every few minutes,
+# tried at most SNIPPET_EMBEDDING_MAX_ATTEMPTS times
+SNIPPET_EMBEDDING_MAX_ATTEMPTS = int(get_env_variable('SNIPPET_EMBEDDING_MAX_ATTEMPTS', 5))
+
+# A video, URL or file already in a garden the user can read is linked (same garden) or cloned with its
+# embeddings (other gardens) instead of being fetched and embedded again; SOURCE_DEDUP=0 always ingests anew
+SOURCE_DEDUP = get_env_variable('SOURCE_DEDUP', '1') == '1'
+
+# PDF extraction
+# Documents with at least PDF_PARALLEL_MIN_PAGES pages are extracted by a pool of PDF_WORKERS processes,
+# PDF_PAGES_PER_TASK pages at a time, in the django-q task ingesting the upload rather than in the web request.
+# Set PDF_WORKERS=1 to always extract in-process.
+PDF_WORKERS = int(get_env_variable('PDF_WORKERS', min(4, os.cpu_count() or 1)))
+PDF_PARALLEL_MIN_PAGES = int(get_env_variable('PDF_PARALLEL_MIN_PAGES', 100))
+PDF_PAGES_PER_TASK = int(get_env_variable('PDF_PAGES_PER_TASK', 25))
+
+# Video reserve downloads
+# Downloads are streamed to VIDEO_DOWNLOAD_DIR in chunks, then copied to storage (multipart upload on S3).
+VIDEO_DOWNLOAD_DIR = get_env_variable('VIDEO_DOWNLOAD_DIR', os.path.join(tempfile.gettempdir(), 'garden_videos'))
+VIDEO_DOWNLOAD_CHUNK_SIZE = int(get_env_variable('VIDEO_DOWNLOAD_CHUNK_SIZE', 1024 * 1024))
+VIDEO_DOWNLOAD_RETRIES = int(get_env_variable('VIDEO_DOWNLOAD_RETRIES', 5))
+# Bandwidth cap of each download in bytes per second, 0 for unlimited
+VIDEO_DOWNLOAD_MAX_BYTES_PER_SEC = int(get_env_variable('VIDEO_DOWNLOAD_MAX_BYTES_PER_SEC', 0))
+# Downloads running at once across all workers, 0 for unlimited; others wait up to VIDEO_DOWNLOAD_SLOT_WAIT seconds
+VIDEO_DOWNLOAD_CONCURRENCY = int(get_env_variable('VIDEO_DOWNLOAD_CONCURRENCY', 2))
+VIDEO_DOWNLOAD_SLOT_WAIT = int(get_env_variable('VIDEO_DOWNLOAD_SLOT_WAIT', 300))
+
 REDIS_URL = get_env_variable('REDIS_URL', 'redis://redis:6379/0')
 
 redis_url = urlparse(REDIS_URL)
 
+# Search query embeddings are cached per process (LRU, bounded) and in Redis, shared by all processes
+QUERY_EMBEDDING_CACHE_TTL = int(get_env_variable('QUERY_EMBEDDING_CACHE_TTL', 60 * 60 * 24 * 7))
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": REDIS_URL,
+        "KEY_PREFIX": "garden",
+    },
+    "query_embeddings": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "query-embeddings",
+        "TIMEOUT": QUERY_EMBEDDING_CACHE_TTL,
+        "OPTIONS": {
+            "MAX_ENTRIES": int(get_env_variable('QUERY_EMBEDDING_CACHE_MAX_ENTRIES', 5000)),
+        },
+    },
+}
+
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
@@ -230,9 +323,13 @@ CHANNEL_LAYERS = {
 Q_CLUSTER = {
     'name': 'garden',
     'workers': int(get_env_variable('Q_CLUSTER_WORKERS', 4)),
-    'timeout': 90,
-    'retry': 120,
+    # A single task embeds a whole seed, so large books need more than a couple of minutes.
+    # 'retry' must stay above 'timeout', otherwise a running task is handed to a second worker.
+    'timeout': int(get_env_variable('Q_CLUSTER_TIMEOUT', 600)),
+    'retry': int(get_env_variable('Q_CLUSTER_TIMEOUT', 600)) + 60,
     'queue_limit': 50,
     'bulk': 10,
     'orm': 'default',
+    # Workers may start child processes, such as the pool extracting a big PDF (thoughts.files.iter_pdf_pages)
+    'daemonize_workers': False,
 }
\ No newline at end of file
@@ -1,35 +1,30 @@
 # telegram_bot/bot.py
+import asyncio
+import functools
 import logging
 import os
-import uuid
-import datetime
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.contrib.auth.decorators import login_required
-from django.core.files.storage import default_storage, FileSystemStorage
-from django.core.paginator import Paginator
-from django.db import IntegrityError, models
-from django.db.models import F
-from django.http import JsonResponse, HttpResponse
-from django.shortcuts import render, redirect, get_object_or_404
-from django.utils.text import slugify
+from django.db import close_old_connections
 
 from telegram import Update, ForceReply
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ConversationHandler, CallbackContext
 
 from django_q.tasks import async_task
-from django_q.models import Task
-from pgvector.django import L2Distance
 
-from thoughts.db_walker import filter_snippets_for_user, filter_seeds_for_user
-from thoughts.files import (extract_text_from_pdf, extract_text_from_docx, process_and_create_embeddings,
+from thoughts.db_walker import search_similar_snippets, run_search, page_snippets, list_seeds_page, snippet_search_mode
+from thoughts.files import (iter_pdf_pages, extract_text_from_docx, process_and_create_embeddings,
                     split_text_into_chunks, extract_text_from_youtube)
 from thoughts.main_logic import create_seed_from_youtube, create_seed_from
-from thoughts.models import Seed, Snippet, Garden
-from thoughts.LLM import get_embedding, get_user_intent
-
-from asgiref.sync import sync_to_async
+from thoughts.models import Seed, Snippet, Garden, IngestionJob
+from thoughts.ingestion import start_ingestion_job, queue_chunks
+from thoughts.sources import ingest_known_source, source_key_for_file, source_key_for_url
+from .intents import route_intent
 
 
 
@@ -46,314 +41,382 @@ if TOKEN_TG is None:
 # States for the conversation handler
 ASK_API_KEY, ASK_PASSWORD, AUTHENTICATED = range(3)
 
+# Snippets shown per /seed_detail message, well under Telegram's message size limit
+SNIPPETS_PER_MESSAGE = 10
+
 User = get_user_model()
 
-@sync_to_async
-def get_user_by_telegram_id(telegram_id):
-    return User.objects.get(telegram_id=telegram_id)
+# Handlers are coroutines; everything that blocks (ORM, OpenAI, YouTube, file parsing) runs on this pool,
+# so a slow import only holds one of its threads instead of the whole bot
+_executor = ThreadPoolExecutor(max_workers=settings.TELEGRAM_THREADS, thread_name_prefix='telegram')
+
+
+def _call(func, *args, **kwargs):
+    # Pool threads live as long as the bot, so drop connections that broke or outlived CONN_MAX_AGE
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
 
-@sync_to_async
-def get_or_create_user(telegram_id, username, email):
-    return User.objects.get_or_create(
-        telegram_id=telegram_id,
-        defaults={'username': username, 'email': email}
+async def run_sync(func, *args, **kwargs):
+    """Run blocking func on the bot's bounded thread pool and wait for it without blocking other updates."""
+    return await asyncio.get_running_loop().run_in_executor(
+        _executor, functools.partial(_call, func, *args, **kwargs)
     )
 
-@sync_to_async
-def save_user(user):
-    user.save()
 
-@sync_to_async
-def filter_seeds_for_user(custom_user):
-    return Seed.objects.filter(garden__owner=custom_user)
+# telegram_id -> (user, expiry); every update needs its user, which rarely changes
+_users = OrderedDict()
 
-@sync_to_async
-def filter_snippets_for_user(custom_user):
-    return Snippet.objects.filter(seed__garden__owner=custom_user)
 
-@sync_to_async
-def get_seed(seed_id, custom_user):
-    return Seed.objects.get(id=seed_id, garden__owner=custom_user)
+def remember_user(telegram_id, user):
+    _users[str(telegram_id)] = (user, time.monotonic() + settings.TELEGRAM_USER_CACHE_TTL)
+    _users.move_to_end(str(telegram_id))
+    if len(_users) > settings.TELEGRAM_USER_CACHE_SIZE:
+        _users.popitem(last=False)
 
-@sync_to_async
-def get_snippet(snippet_id, custom_user):
-    return Snippet.objects.get(id=snippet_id, seed__garden__owner=custom_user)
 
-def start(update: Update, context: CallbackContext) -> int:
-    user = update.message.from_user
-    telegram_id = user.id
-    
-    try:
-        custom_user = User.objects.get(telegram_id=telegram_id)
-        update.message.reply_text('Welcome back! You are already authenticated.')
-        return AUTHENTICATED
-    except User.DoesNotExist:
-        update.message.reply_text(
-            'Welcome! Please send your OpenAI API key or type "password" to use a system-wide key.',
-            reply_markup=ForceReply(selective=True),
-        )
-        return ASK_API_KEY
-
-def handle_api_key(update: Update, context: CallbackContext) -> int:
-    api_key = update.message.text
-    user = update.message.from_user
-    telegram_id = user.id
+async def get_user(telegram_id):
+    """The user linked to a Telegram account, or None. Only the event loop thread touches the cache."""
+    entry = _users.get(str(telegram_id))
+    if entry and entry[1] > time.monotonic():
+        _users.move_to_end(str(telegram_id))
+        return entry[0]
+    user = await run_sync(User.objects.filter(telegram_id=str(telegram_id)).first)
+    if user is not None:
+        remember_user(telegram_id, user)
+    return user
+
+
+async def require_user(update: Update):
+    custom_user = await get_user(update.message.from_user.id)
+    if custom_user is None:
+        await update.message.reply_text("User not found. Please authenticate using /start.")
+    return custom_user
+
+
+def link_user(telegram_id):
     custom_user, created = User.objects.get_or_create(
-        telegram_id=telegram_id,
+        telegram_id=str(telegram_id),
         defaults={'username': f'tg_{telegram_id}', 'email': f'{telegram_id}@example.com'}
     )
     if created:
         custom_user.set_unusable_password()
-    
+        custom_user.save()
+    return custom_user
+
+
+def ensure_garden(custom_user):
+    if not custom_user.owned_gardens.exists():
+        Garden.objects.create(owner=custom_user, name=f"{custom_user.username}'s Garden")
+
+
+def plant_seed(custom_user, title, content):
+    job = start_ingestion_job(custom_user, title)
+    try:
+        job.advance(IngestionJob.TAG)
+        seed = create_seed_from(title, content, custom_user)
+
+        # Break down the content into chunks and process asynchronously.
+        job.advance(IngestionJob.CHUNK)
+        chunks = split_text_into_chunks(content, max_chunk_size=custom_user.max_chunk_size_setting)
+        queue_chunks(job, seed, chunks)
+        return seed
+    except Exception as e:
+        job.fail(e)
+        raise
+
+
+def plant_youtube_seed(custom_user, youtube_url):
+    job = start_ingestion_job(custom_user, youtube_url)
+    try:
+        # A video the user already has is linked or cloned, not fetched and embedded again
+        seed = ingest_known_source(custom_user, source_key_for_url(youtube_url), job=job)
+        if seed:
+            return seed
+
+        # Extract captions or relevant text from the YouTube video.
+        caption_text_list, caption_text = extract_text_from_youtube(youtube_url)
+
+        # Create a new seed in your system based on the YouTube video.
+        job.advance(IngestionJob.TAG)
+        seed = create_seed_from_youtube(youtube_url, caption_text, custom_user)
+
+        # The bot has no download_video choice like the web form, it always keeps a copy of the video
+        async_task('thoughts.files.download_and_save_video_to_seed', youtube_url, seed, group=str(seed.pk))
+
+        # Embed and store all chunks of caption text in one task
+        queue_chunks(job, seed, caption_text_list)
+        return seed
+    except Exception as e:
+        job.fail(e)
+        raise
+
+
+def plant_document_seed(custom_user, path, file_name):
+    source_key = source_key_for_file(path)
+    seed = ingest_known_source(custom_user, source_key)
+    if seed:
+        return seed
+    if file_name.endswith('.pdf'):
+        text = iter_pdf_pages(path)
+    else:
+        text = extract_text_from_docx(path)
+    return process_and_create_embeddings(text, file_name.rsplit('.', 1)[0], custom_user, source_key=source_key)
+
+
+def find_similar_snippets(custom_user, snippet_id):
+    target_part = Snippet.objects.select_related('garden').get(id=snippet_id, garden__owner=custom_user)
+    return search_similar_snippets(custom_user, target_part, limit=6)
+
+
+def seed_snippets_page(custom_user, seed_id, after):
+    seed = Seed.objects.get(id=seed_id, garden__owner=custom_user)  # Ensure the seed belongs to the user
+    snippets, _, has_next = page_snippets(seed, per_page=SNIPPETS_PER_MESSAGE, after=after)
+    return seed, snippets, has_next
+
+
+async def start(update: Update, context: CallbackContext) -> int:
+    if await get_user(update.message.from_user.id):
+        await update.message.reply_text('Welcome back! You are already authenticated.')
+        return AUTHENTICATED
+    await update.message.reply_text(
+        'Welcome! Please send your OpenAI API key or type "password" to use a system-wide key.',
+        reply_markup=ForceReply(selective=True),
+    )
+    return ASK_API_KEY
+
+async def handle_api_key(update: Update, context: CallbackContext) -> int:
+    api_key = update.message.text
+    telegram_id = update.message.from_user.id
+    custom_user = await run_sync(link_user, telegram_id)
+
     if api_key.lower() == 'password':
-        update.message.reply_text('Please enter the system password:')
+        await update.message.reply_text('Please enter the system password:')
         return ASK_PASSWORD
     else:
         custom_user.api_key = api_key
-        custom_user.save()
-        update.message.reply_text('API key saved. You are now authenticated.')
+        await run_sync(custom_user.save)
+        remember_user(telegram_id, custom_user)
+        await update.message.reply_text('API key saved. You are now authenticated.')
         return AUTHENTICATED
 
-def handle_password(update: Update, context: CallbackContext) -> int:
+async def handle_password(update: Update, context: CallbackContext) -> int:
     password = update.message.text
-    user = update.message.from_user
-    telegram_id = user.id
-    custom_user = User.objects.get(telegram_id=telegram_id)
-    
+    telegram_id = update.message.from_user.id
+
     if password == settings.SYSTEM_PASSWORD:
+        custom_user = await run_sync(link_user, telegram_id)
         custom_user.use_system_api_key = True
-        custom_user.save()
-        update.message.reply_text('Password correct. You are now authenticated using the system API key.')
+        await run_sync(custom_user.save)
+        remember_user(telegram_id, custom_user)
+        await update.message.reply_text('Password correct. You are now authenticated using the system API key.')
         return AUTHENTICATED
     else:
-        update.message.reply_text('Incorrect password. Please try again.')
+        await update.message.reply_text('Incorrect password. Please try again.')
         return ASK_PASSWORD
 
-def authenticated(update: Update, context: CallbackContext) -> None:
-    user = update.message.from_user
-    telegram_id = user.id
-    custom_user = User.objects.get(telegram_id=telegram_id)
-    if not user.owned_gardens.exists():
-        #TODO: Create a default garden for the user
-        Garden.objects.create(owner=custom_user, name=f"{custom_user.username}'s Garden")
-
-    update.message.reply_text("You are authenticated. Use /plant to plant a seed or /search to find similarities.")
-
-def list_seeds(update: Update, context: CallbackContext) -> None:
-    # Logic to list seeds
-    user = update.message.from_user
-    telegram_id = user.id
-    custom_user = User.objects.get(telegram_id=telegram_id)
-    seeds = filter_seeds_for_user(custom_user)
-    seeds_list = "\n".join([f"{seed.id}: {seed.title}" for seed in seeds])
-    update.message.reply_text(f"Here are your seeds:\n{seeds_list}")
-
-def create_seed(update: Update, context: CallbackContext) -> None:
-    message_parts = update.message.text.split()
-    if len(message_parts) < 3:
-        update.message.reply_text("Please provide a title and content after /create_seed_from_message command.")
+async def authenticated(update: Update, context: CallbackContext) -> None:
+    custom_user = await require_user(update)
+    if custom_user is None:
         return
+    await run_sync(ensure_garden, custom_user)
 
-    title, content = message_parts[1], ' '.join(message_parts[2:])
-
-    user = update.message.from_user
-    telegram_id = user.id
-    custom_user = User.objects.get(telegram_id=telegram_id)
+    await update.message.reply_text("You are authenticated. Use /plant to plant a seed or /search to find similarities.")
 
-    try:
-        seed = create_seed_from(title, content, custom_user)
+async def list_seeds(update: Update, context: CallbackContext, text: str = None) -> None:
+    custom_user = await require_user(update)
+    if custom_user is None:
+        return
+    # Newest first, one page per message: /list_seeds [<before>]
+    before = [int(word) for word in (text or update.message.text).split() if word.isdigit()]
+    seeds, cursor = await run_sync(list_seeds_page, custom_user, before=before[0] if before else None)
+    seeds_list = "\n".join([f"{seed['id']}: {seed['title']}" for seed in seeds])
+    if cursor:
+        seeds_list += f"\n\nMore: /list_seeds {cursor}"
+    await update.message.reply_text(f"Here are your seeds:\n{seeds_list}")
+
+async def create_seed(update: Update, context: CallbackContext, text: str = None) -> None:
+    # text is the message without its command, when the intent router already took it off
+    message_parts = text.split() if text is not None else update.message.text.split()[1:]
+    if len(message_parts) < 2:
+        await update.message.reply_text("Please provide a title and content after /create_seed_from_message command.")
+        return
 
-        # Break down the content into chunks and process asynchronously.
-        for chunk in split_text_into_chunks(content, max_chunk_size=custom_user.max_chunk_size_setting):
-            async_task('thoughts.main_logic.create_snippet_from', chunk, seed, custom_user, group=str(seed.pk))
+    title, content = message_parts[0], ' '.join(message_parts[1:])
 
-        update.message.reply_text(f"Seed created with ID: {seed.pk}")
+    custom_user = await require_user(update)
+    if custom_user is None:
+        return
 
+    try:
+        seed = await run_sync(plant_seed, custom_user, title, content)
+        await update.message.reply_text(f"Seed created with ID: {seed.pk}")
     except Exception as e:
-        update.message.reply_text(f"Error while creating seed from message: {str(e)}")
+        await update.message.reply_text(f"Error while creating seed from message: {str(e)}")
 
 
-def search(update: Update, context: CallbackContext) -> None:
-    search_text = update.message.text[len("/search_seeds "):] 
+async def search(update: Update, context: CallbackContext, text: str = None) -> None:
+    search_text = text if text is not None else update.message.text[len("/search_seeds "):]
 
     if not search_text.strip():
-        update.message.reply_text("Please provide a search query after the /search_seeds command.")
+        await update.message.reply_text("Please provide a search query after the /search_seeds command.")
         return
 
-    user = update.message.from_user
-    telegram_id = user.id
-    custom_user = User.objects.get(telegram_id=telegram_id)
+    custom_user = await require_user(update)
+    if custom_user is None:
+        return
 
     try:
-        embedding = get_embedding(search_text, custom_user)
-
-        parts = filter_snippets_for_user(custom_user).annotate(
-            distance=L2Distance(F('embedding'), embedding)
-        ).order_by('distance')[:15]
+        # The replies list snippets, even when SEARCH_MODE returns seeds
+        parts = await run_sync(run_search, custom_user, search_text, mode=snippet_search_mode(), limit=15)
 
         # Format search results as a text message
         message = f"**Search Results for:** {search_text}\n"
         for part in parts:
             message += f"{part.id}: {part.content}\n\n"
 
-        update.message.reply_text(message, parse_mode='Markdown')
+        await update.message.reply_text(message, parse_mode='Markdown')
     except Exception as e:
-        update.message.reply_text(f"Error while searching seeds: {str(e)}")
+        await update.message.reply_text(f"Error while searching seeds: {str(e)}")
 
-def find_similar(update: Update, context: CallbackContext) -> None:
-    snippet_id = update.message.text.split()[-1]  # Assuming the snippet ID is provided as the last word in the message
+async def find_similar(update: Update, context: CallbackContext, text: str = None) -> None:
+    words = (text or update.message.text).split() or ['']
+    snippet_id = words[-1]  # Assuming the snippet ID is provided as the last word in the message
     try:
         snippet_id = int(snippet_id)
     except ValueError:
-        update.message.reply_text("Invalid snippet ID. Please provide a valid snippet ID.")
+        await update.message.reply_text("Invalid snippet ID. Please provide a valid snippet ID.")
         return
 
-    user = update.message.from_user
-    telegram_id = user.id
-    custom_user = User.objects.get(telegram_id=telegram_id)
-    
-    try:
-        target_part = Snippet.objects.get(id=snippet_id, seed__garden__owner=custom_user)
-        target_embedding = target_part.embedding
+    custom_user = await require_user(update)
+    if custom_user is None:
+        return
 
-        similar_parts = filter_snippets_for_user(custom_user).annotate(
-            distance=L2Distance(F('embedding'), target_embedding)
-        ).exclude(id=snippet_id).order_by('distance')[:6]
+    try:
+        similar_parts = await run_sync(find_similar_snippets, custom_user, snippet_id)
 
         # Format search results as a text message
         message = f"**Similar Seeds for Snippet** (ID: {snippet_id})\n"
         for part in similar_parts:
             message += f"{part.id}: {part.content}\n\n"
 
-        update.message.reply_text(message, parse_mode='Markdown')
+        await update.message.reply_text(message, parse_mode='Markdown')
     except Snippet.DoesNotExist:
-        update.message.reply_text("No snippet found with the provided ID.")
-
-def process_youtube(update: Update, context: CallbackContext) -> None:
-
-    user = update.message.from_user
-    telegram_id = user.id
-    custom_user = User.objects.get(telegram_id=telegram_id)
+        await update.message.reply_text("No snippet found with the provided ID.")
 
+async def process_youtube(update: Update, context: CallbackContext, text: str = None) -> None:
     # Process YouTube URL sent in message
-    youtube_url = update.message.text
-    
+    youtube_url = text or update.message.text
+
     if not youtube_url:
-        update.message.reply_text("No YouTube URL provided.")
+        await update.message.reply_text("No YouTube URL provided.")
         return
-    
-    try:
-        # Extract captions or relevant text from the YouTube video.
-        caption_text_list, caption_text = extract_text_from_youtube(youtube_url)
-        
-        # Create a new seed in your system based on the YouTube video.
-        seed = create_seed_from_youtube(youtube_url, caption_text, custom_user)
-        
-        # Download video to default storage if needed (not implemented in this bot)
-        # TODO Download all videos?
-        async_task('thoughts.files.download_and_save_video_to_seed', youtube_url, seed, group=str(seed.pk))
-        
-        # Process each chunk of caption text asynchronously
-        for chunk in caption_text_list:
-            chunk_text = chunk.get('text', '')
-            async_task('thoughts.main_logic.create_snippet_from', chunk_text, seed, custom_user, group=str(seed.pk))
-        
-        update.message.reply_text(f"YouTube video processed. Seed ID: {seed.pk}")
 
+    custom_user = await require_user(update)
+    if custom_user is None:
+        return
+
+    try:
+        seed = await run_sync(plant_youtube_seed, custom_user, youtube_url)
+        await update.message.reply_text(f"YouTube video processed. Seed ID: {seed.pk}")
     except Exception as e:
-        update.message.reply_text(f"Error processing YouTube URL: {str(e)}")
+        await update.message.reply_text(f"Error processing YouTube URL: {str(e)}")
 
-def upload_file(update: Update, context: CallbackContext) -> None:
+async def upload_file(update: Update, context: CallbackContext) -> None:
     # Process uploaded file sent in message
     uploaded_file = update.message.document
-    
+
     if not uploaded_file:
-        update.message.reply_text("No file uploaded.")
+        await update.message.reply_text("No file uploaded.")
+        return
+    if not uploaded_file.file_name.endswith(('.pdf', '.docx')):
+        await update.message.reply_text("Unsupported file type.")
         return
-    
+
+    custom_user = await require_user(update)
+    if custom_user is None:
+        return
+
     try:
-        # Determine file type and process
-        if uploaded_file.file_name.endswith('.pdf'):
-            text = extract_text_from_pdf(uploaded_file)
-        elif uploaded_file.file_name.endswith('.docx'):
-            text = extract_text_from_docx(uploaded_file)
-        else:
-            update.message.reply_text("Unsupported file type.")
-            return
-        
-        # Process the extracted text to create a seed
-        seed_title = uploaded_file.file_name.rsplit('.', 1)[0]
-        user = User.objects.get(telegram_id=update.message.from_user.id)
-        seed = process_and_create_embeddings(text, seed_title, user)
-        
-        update.message.reply_text(f"File uploaded and processed. Seed ID: {seed.pk}")
+        # Extractors read from disk, and big PDFs are split across processes from there
+        suffix = os.path.splitext(uploaded_file.file_name)[1]
+        with tempfile.NamedTemporaryFile(suffix=suffix) as destination:
+            telegram_file = await uploaded_file.get_file()
+            await telegram_file.download_to_drive(destination.name)
+            seed = await run_sync(plant_document_seed, custom_user, destination.name, uploaded_file.file_name)
+
+        await update.message.reply_text(f"File uploaded and processed. Seed ID: {seed.pk}")
 
     except Exception as e:
-        update.message.reply_text(f"Error processing uploaded file: {str(e)}")
+        await update.message.reply_text(f"Error processing uploaded file: {str(e)}")
 
-def seed_detail(update: Update, context: CallbackContext) -> None:
-    seed_id = update.message.text.split()[-1]  # Assuming the seed ID is provided as the last word in the message
-    try:
-        seed_id = int(seed_id)
-    except ValueError:
-        update.message.reply_text("Invalid seed ID. Please provide a valid seed ID.")
+async def seed_detail(update: Update, context: CallbackContext, text: str = None) -> None:
+    # The seed ID comes first, optionally followed by the ordinal to continue after: /seed_detail <id> [<after>]
+    numbers = [int(word) for word in (text or update.message.text).split() if word.isdigit()]
+    if not numbers:
+        await update.message.reply_text("Invalid seed ID. Please provide a valid seed ID.")
+        return
+    seed_id = numbers[0]
+    after = numbers[1] if len(numbers) > 1 else None
+
+    custom_user = await require_user(update)
+    if custom_user is None:
         return
 
-    user = update.message.from_user
-    telegram_id = user.id
-    custom_user = User.objects.get(telegram_id=telegram_id)
-    
     try:
-        seed = Seed.objects.get(id=seed_id, garden__owner=custom_user)  # Ensure the seed belongs to the user
-        snippets = seed.snippet_set.all().order_by('id')
+        seed, snippets, has_next = await run_sync(seed_snippets_page, custom_user, seed_id, after)
 
         # Format seed and snippets as a text message
         message = f"**Seed** (ID: {seed.id})\nTitle: {seed.title}\n\n**Snippets:**\n"
         for snippet in snippets:
             message += f"{snippet.id}: {snippet.content}\n\n"
-        
-        update.message.reply_text(message, parse_mode='Markdown')
+        if has_next:
+            message += f"More: /seed_detail {seed.id} {snippets[-1].ordinal}"
+
+        await update.message.reply_text(message, parse_mode='Markdown')
     except Seed.DoesNotExist:
-        update.message.reply_text("No seed found with the provided ID.")
+        await update.message.reply_text("No seed found with the provided ID.")
 
-def default_message_handler(update: Update, context: CallbackContext) -> None:
+async def default_message_handler(update: Update, context: CallbackContext) -> None:
     user_message = update.message.text
-    user = update.message.from_user
-    telegram_id = user.id
-
-    try:
-        custom_user = User.objects.get(telegram_id=telegram_id)
-    except User.DoesNotExist:
-        update.message.reply_text("User not found. Please authenticate using /start.")
+    custom_user = await require_user(update)
+    if custom_user is None:
         return
 
     try:
-        action = get_user_intent(user_message, custom_user)
+        intent = await run_sync(route_intent, user_message, custom_user, has_attachment=bool(update.message.document))
+        logger.info(f"Routed message to {intent.action!r} by {intent.source}")
+        action, text = intent.action, intent.text
 
         # Determine and execute the appropriate action
-        if "list seeds" in action:
-            list_seeds(update, context)
-        elif "create seed" in action:
-            create_seed(update, context)
-        elif "search" in action:
-            search(update, context)
-        elif "find similar" in action:
-            find_similar(update, context)
-        elif "process youtube" in action:
-            process_youtube(update, context)
-        elif "upload file" in action:
-            upload_file(update, context)
-        elif "seed detail" in action:
-            seed_detail(update, context)
+        if action == "list seeds":
+            await list_seeds(update, context, text)
+        elif action == "create seed":
+            await create_seed(update, context, text)
+        elif action == "search":
+            await search(update, context, text)
+        elif action == "find similar":
+            await find_similar(update, context, text)
+        elif action == "process youtube":
+            await process_youtube(update, context, text)
+        elif action == "upload file":
+            await upload_file(update, context)
+        elif action == "seed detail":
+            await seed_detail(update, context, text)
         else:
-            update.message.reply_text("I'm not sure what you want to do. Try using /submit_content, /list_seeds, /create_seed, /search, /find_similar, /process_youtube, /upload_file, or /seed_detail.")
+            await update.message.reply_text("I'm not sure what you want to do. Try using /submit_content, /list_seeds, /create_seed, /search, /find_similar, /process_youtube, /upload_file, or /seed_detail.")
     except Exception as e:
         logger.error(f"Error processing message: {str(e)}")
-        update.message.reply_text("An error occurred while processing your request. Please try again later.")
+        await update.message.reply_text("An error occurred while processing your request. Please try again later.")
 
 
 def main() -> None:
     # Create the Application and pass it your bot's token.
+    # ConversationHandler needs updates processed in order, so the sign-in steps never race each other;
+    # the authenticated handlers don't block instead, so one user's slow import doesn't hold up everyone else
     application = ApplicationBuilder().token(TOKEN_TG).build()
 
     conv_handler = ConversationHandler(
@@ -362,15 +425,16 @@ def main() -> None:
             ASK_API_KEY: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_api_key)],
             ASK_PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_password)],
             AUTHENTICATED: [
-                MessageHandler(filters.COMMAND, authenticated),
-                CommandHandler('list_seeds', list_seeds),
-                CommandHandler('create_seed', create_seed),
-                CommandHandler('search', search),
-                CommandHandler('find_similar', find_similar),
-                CommandHandler('process_youtube', process_youtube),
-                CommandHandler('upload_file', upload_file),
-                CommandHandler('seed_detail', seed_detail),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, default_message_handler)
+                CommandHandler('list_seeds', list_seeds, block=False),
+                CommandHandler('create_seed', create_seed, block=False),
+                CommandHandler('search', search, block=False),
+                CommandHandler('find_similar', find_similar, block=False),
+                CommandHandler('process_youtube', process_youtube, block=False),
+                CommandHandler('upload_file', upload_file, block=False),
+                CommandHandler('seed_detail', seed_detail, block=False),
+                MessageHandler(filters.Document.ALL, upload_file, block=False),
+                MessageHandler(filters.COMMAND, authenticated, block=False),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, default_message_handler, block=False)
             ],
         },
         fallbacks=[CommandHandler('start', start)],
@@ -382,4 +446,4 @@ def main() -> None:
     application.run_polling()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,134 @@
+# telegram_bot/intents.py
+import logging
+import math
+import re
+import threading
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from thoughts.embedding_cache import normalize_text, text_hash
+from thoughts.LLM import get_embedder, get_embeddings, get_query_embedding, get_user_intent
+
+logger = logging.getLogger(__name__)
+
+# What the user asked for, and the part of the message it applies to (query, URL, title and content...)
+Intent = namedtuple('Intent', ['action', 'text', 'source'])
+
+LIST_SEEDS, CREATE_SEED, SEARCH, FIND_SIMILAR = 'list seeds', 'create seed', 'search', 'find similar'
+PROCESS_YOUTUBE, UPLOAD_FILE, SEED_DETAIL, UNKNOWN = 'process youtube', 'upload file', 'seed detail', 'unknown'
+ACTIONS = [LIST_SEEDS, CREATE_SEED, SEARCH, FIND_SIMILAR, PROCESS_YOUTUBE, UPLOAD_FILE, SEED_DETAIL]
+
+YOUTUBE_URL = re.compile(
+    r'https?://(?:www\.|m\.)?(?:youtube\.com/(?:watch\?\S*v=|shorts/|live/)|youtu\.be/)[\w-]{11}\S*', re.IGNORECASE
+)
+
+# Unambiguous phrasings, tried in order; the text of the intent is whatever follows the match
+RULES = [
+    (LIST_SEEDS, re.compile(r'^(?:please\s+)?(?:list|show)(?:\s+me)?(?:\s+(?:all|my))*\s+seeds\b', re.IGNORECASE)),
+    (SEED_DETAIL, re.compile(r'^(?:please\s+)?(?:show|open|read)(?:\s+me)?\s+seed\s+(?=\d)', re.IGNORECASE)),
+    (FIND_SIMILAR, re.compile(r'^(?:please\s+)?(?:find\s+)?(?:similar|more like)(?:\s+(?:to|snippets?))*\s+(?=\d)',
+                              re.IGNORECASE)),
+    (CREATE_SEED, re.compile(r'^(?:please\s+)?(?:create|plant|new)(?:\s+a)?\s+seed\b:?', re.IGNORECASE)),
+    (SEARCH, re.compile(r'^(?:please\s+)?(?:search|look\s+up|find)(?:\s+(?:for|about|my\s+seeds\s+for))?\b:?',
+                        re.IGNORECASE)),
+]
+
+# Example phrasings of each action, for messages that match no rule
+EXAMPLES = {
+    LIST_SEEDS: ["what seeds do I have", "which documents are in my garden", "my library", "what did I save so far"],
+    CREATE_SEED: ["save this note", "remember the following text", "add this to my garden", "store this thought"],
+    SEARCH: ["what did Marcus Aurelius say about death", "anything on stoicism", "where did I read about habits",
+             "quotes about courage"],
+    FIND_SIMILAR: ["what else is like snippet 12", "related passages to 40", "other ideas close to this snippet"],
+    PROCESS_YOUTUBE: ["import this video", "add the youtube video", "get the captions of this talk"],
+    UPLOAD_FILE: ["I want to upload a pdf", "can I send you a document", "import my book file"],
+    SEED_DETAIL: ["what is in seed 5", "details of document 3", "read seed number 8"],
+}
+
+_prototypes = {}
+_prototypes_lock = threading.Lock()
+
+
+def _normalize(vector):
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+def _prototypes_for(user, backend):
+    """Mean embedding of each action's examples, computed once per process and embedding model."""
+    model = get_embedder(backend).cache_model
+    with _prototypes_lock:
+        if model not in _prototypes:
+            texts = [example for action in ACTIONS for example in EXAMPLES.get(action, [])]
+            # Embeddings of the examples stay in the embedding cache, so only the very first process pays for them
+            embeddings = iter(get_embeddings(texts, user, backend=backend))
+            prototypes = {}
+            for action in ACTIONS:
+                vectors = [next(embeddings) for _ in EXAMPLES.get(action, [])]
+                if vectors:
+                    prototypes[action] = _normalize([sum(values) / len(vectors) for values in zip(*vectors)])
+            _prototypes[model] = prototypes
+        return _prototypes[model]
+
+
+def classify(text, user):
+    """The closest action by embedding similarity, or None when no action is clearly closest."""
+    backend = user.embedding_backend or settings.EMBEDDING_BACKEND
+    embedding = get_query_embedding(text, user, backend=backend)
+    if embedding is None:
+        return None
+    embedding = _normalize(embedding)
+    scores = sorted(
+        ((sum(a * b for a, b in zip(embedding, prototype)), action)
+         for action, prototype in _prototypes_for(user, backend).items()),
+        reverse=True,
+    )
+    (best, action), (runner_up, _) = scores[0], scores[1]
+    if best < settings.TELEGRAM_INTENT_MIN_SIMILARITY or best - runner_up < settings.TELEGRAM_INTENT_MIN_MARGIN:
+        return None
+    return action
+
+
+def route_intent(text, user, has_attachment=False):
+    """What a free-text message asks for, trying the cheap ways first: attachments, YouTube links,
+    keyword rules, then the embedding classifier; the chat model only decides what's left.
+    Classifier and chat model answers are cached per normalized message."""
+    text = text or ''
+    if has_attachment:
+        return Intent(UPLOAD_FILE, text, 'attachment')
+    url = YOUTUBE_URL.search(text)
+    if url:
+        return Intent(PROCESS_YOUTUBE, url.group(0), 'url')
+    stripped = text.strip()
+    for action, rule in RULES:
+        match = rule.match(stripped)
+        if match:
+            return Intent(action, stripped[match.end():].strip(), 'rule')
+
+    key = f"telegram-intent:{text_hash(text)}"
+    try:
+        action = cache.get(key)
+    except Exception as e:
+        logger.warning(f"Intent cache unavailable: {e}")
+        action = None
+    if action:
+        return Intent(action, stripped, 'cache')
+
+    source = 'classifier'
+    try:
+        action = classify(normalize_text(text), user)
+    except Exception as e:
+        logger.warning(f"Intent classifier failed, asking the chat model: {e}")
+    if action is None:
+        source = 'llm'
+        answer = get_user_intent(text, user)
+        # The model answers in a sentence at times, take the first action it names
+        action = next((action for action in ACTIONS if action in answer), UNKNOWN)
+
+    try:
+        cache.set(key, action, settings.TELEGRAM_INTENT_CACHE_TTL)
+    except Exception as e:
+        logger.warning(f"Intent cache unavailable: {e}")
+    return Intent(action, stripped, source)
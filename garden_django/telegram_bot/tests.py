@@ -1,3 +1,156 @@
-from django.test import TestCase
+import asyncio
+import threading
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from .intents import (
+    CREATE_SEED, FIND_SIMILAR, LIST_SEEDS, PROCESS_YOUTUBE, SEARCH, SEED_DETAIL, UNKNOWN, UPLOAD_FILE, route_intent,
+)
+
+# bot.py refuses to load without a bot token, which none of these tests use
+with override_settings(TOKEN_TG=settings.TOKEN_TG or '0:test'):
+    from . import bot
+
+
+class RunSyncTests(SimpleTestCase):
+    async def test_blocking_calls_run_at_once_on_the_pool(self):
+        # Each call waits for the other: run one after the other, the barrier would break
+        barrier = threading.Barrier(2, timeout=5)
+
+        def blocking():
+            barrier.wait()
+            return threading.current_thread().name
+
+        names = await asyncio.gather(bot.run_sync(blocking), bot.run_sync(blocking))
+        self.assertTrue(all(name.startswith('telegram') for name in names))
+        self.assertNotEqual(names[0], names[1])
+
+    async def test_stale_connections_are_dropped_around_each_call(self):
+        with mock.patch.object(bot, 'close_old_connections') as close_old_connections:
+            self.assertEqual(await bot.run_sync(lambda value: value * 2, 21), 42)
+        self.assertEqual(close_old_connections.call_count, 2)
+
+    async def test_errors_reach_the_handler(self):
+        def failing():
+            raise ValueError('no such seed')
+
+        with self.assertRaisesMessage(ValueError, 'no such seed'):
+            await bot.run_sync(failing)
+
+
+class UserCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create(username='tg_42', email='42@example.com', telegram_id='42')
+
+    def setUp(self):
+        bot._users.clear()
+        self.addCleanup(bot._users.clear)
+        # The test's transaction is only visible on its own thread, so look users up there
+        self.lookups = 0
+
+        async def run_sync(func, *args, **kwargs):
+            self.lookups += 1
+            return await sync_to_async(func)(*args, **kwargs)
+
+        patcher = mock.patch.object(bot, 'run_sync', run_sync)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_users_are_looked_up_once(self):
+        self.assertEqual(await bot.get_user(42), self.user)
+        self.assertEqual(await bot.get_user('42'), self.user)
+        self.assertEqual(self.lookups, 1)
+
+    async def test_unknown_accounts_are_not_cached(self):
+        self.assertIsNone(await bot.get_user(7))
+        self.assertIsNone(await bot.get_user(7))
+        self.assertEqual(self.lookups, 2)
+
+    async def test_entries_expire(self):
+        with mock.patch.object(bot.time, 'monotonic', return_value=1000.0):
+            await bot.get_user(42)
+        with mock.patch.object(bot.time, 'monotonic', return_value=1000.0 + settings.TELEGRAM_USER_CACHE_TTL + 1):
+            await bot.get_user(42)
+        self.assertEqual(self.lookups, 2)
+
+    @override_settings(TELEGRAM_USER_CACHE_SIZE=2)
+    async def test_least_recently_used_users_are_forgotten(self):
+        await bot.get_user(42)
+        bot.remember_user(1, mock.Mock())
+        # Using 42 again keeps it, 1 is now the oldest
+        await bot.get_user(42)
+        bot.remember_user(2, mock.Mock())
+        self.assertEqual(list(bot._users), ['42', '2'])
+        await bot.get_user(42)
+        self.assertEqual(self.lookups, 1)
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'intents'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RouteIntentTests(SimpleTestCase):
+    def setUp(self):
+        # Messages the rules settle must never reach the classifier or the chat model
+        classify = mock.patch('telegram_bot.intents.classify', side_effect=AssertionError('classifier called'))
+        get_user_intent = mock.patch('telegram_bot.intents.get_user_intent', side_effect=AssertionError('LLM called'))
+        self.classify, self.get_user_intent = classify.start(), get_user_intent.start()
+        self.addCleanup(mock.patch.stopall)
+        self.user = mock.Mock(embedding_backend='')
+        cache.clear()
+
+    def test_attachments_are_uploads(self):
+        self.assertEqual(route_intent('search for this', self.user, has_attachment=True),
+                         (UPLOAD_FILE, 'search for this', 'attachment'))
+
+    def test_youtube_links(self):
+        for text, url in [
+            ('please import https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=42s thanks',
+             'https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=42s'),
+            ('https://youtu.be/dQw4w9WgXcQ', 'https://youtu.be/dQw4w9WgXcQ'),
+            ('search https://m.youtube.com/shorts/dQw4w9WgXcQ', 'https://m.youtube.com/shorts/dQw4w9WgXcQ'),
+        ]:
+            self.assertEqual(route_intent(text, self.user), (PROCESS_YOUTUBE, url, 'url'))
+
+    def test_other_links_are_not_youtube(self):
+        intent = route_intent('search https://example.com/watch?v=dQw4w9WgXcQ', self.user)
+        self.assertEqual(intent.action, SEARCH)
+
+    def test_rules(self):
+        for text, action, rest in [
+            ('list my seeds', LIST_SEEDS, ''),
+            ('Please show me all seeds', LIST_SEEDS, ''),
+            ('show seed 12', SEED_DETAIL, '12'),
+            ('similar to 40', FIND_SIMILAR, '40'),
+            ('find more like snippet 7', FIND_SIMILAR, '7'),
+            ('create a seed: Courage is a habit', CREATE_SEED, 'Courage is a habit'),
+            ('search for stoicism and death', SEARCH, 'stoicism and death'),
+            ('  look up habits ', SEARCH, 'habits'),
+        ]:
+            self.assertEqual(route_intent(text, self.user), (action, rest, 'rule'), text)
+
+    def test_rules_match_at_the_start_only(self):
+        self.classify.side_effect = None
+        self.classify.return_value = CREATE_SEED
+        self.assertEqual(route_intent('I want to search for a seed', self.user).action, CREATE_SEED)
+
+    def test_classifier_answers_are_cached(self):
+        self.classify.side_effect = None
+        self.classify.return_value = SEARCH
+        self.assertEqual(route_intent('anything on courage?', self.user), (SEARCH, 'anything on courage?', 'classifier'))
+        self.assertEqual(route_intent('anything  on courage? ', self.user).source, 'cache')
+        self.classify.assert_called_once()
+
+    def test_chat_model_decides_when_the_classifier_does_not(self):
+        self.classify.side_effect = None
+        self.classify.return_value = None
+        self.get_user_intent.side_effect = None
+        self.get_user_intent.return_value = 'The user wants to list seeds.'
+        self.assertEqual(route_intent('hmm', self.user), (LIST_SEEDS, 'hmm', 'llm'))
+        self.get_user_intent.return_value = 'no idea'
+        self.assertEqual(route_intent('hmm?!', self.user).action, UNKNOWN)
@@ -1,5 +1,28 @@
 import os
-from openai import AzureOpenAI, OpenAI
+import asyncio
+import functools
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import httpx
+from asgiref.sync import sync_to_async
+from openai import (
+    APIConnectionError, AsyncAzureOpenAI, AsyncOpenAI, AzureOpenAI, InternalServerError, OpenAI, RateLimitError,
+)
+from django.conf import settings
+from django.core.cache import caches
+
+from .embedding_cache import text_hash, get_cached_embeddings, cache_embeddings
+from .embedding_backends import EmbeddingBackend, register_backend, get_backend
+from .rate_limits import (
+    EMBEDDING_RATE_LIMIT_RETRIES, EMBEDDING_TRANSIENT_RETRIES, wait_for_capacity, await_capacity, back_off, retry_after,
+    transient_delay,
+)
+
+logger = logging.getLogger(__name__)
 
 # Convert the environment variable to a boolean
 USE_AZURE = os.getenv('USE_AZURE', 'False').lower() in ('true', '1', 't')
@@ -11,17 +34,101 @@ DEPLOYMENT = os.getenv('GPT_DEPLOYMENT', "")
 # Adjust the default embedding model based on the desired default behavior
 EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', "text-embedding-ada-002")
 
+# Upper bounds for a single embeddings request (the API accepts up to 2048 inputs and ~300k tokens)
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 256))
+EMBEDDING_BATCH_TOKENS = int(os.getenv('EMBEDDING_BATCH_TOKENS', 200000))
+# Longest input of the OpenAI embedding models in tokens
+OPENAI_EMBEDDING_MAX_TOKENS = int(os.getenv('OPENAI_EMBEDDING_MAX_TOKENS', 8191))
+
+
+# HTTP settings of the pooled clients
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', 60))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', 5))
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', 20))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv('OPENAI_KEEPALIVE_EXPIRY', 60))
+# Clients kept alive at once, one per distinct API key in use
+OPENAI_MAX_CLIENTS = int(os.getenv('OPENAI_MAX_CLIENTS', 64))
+
+# Process-wide registry of clients, keyed by (api key, endpoint, azure flag)
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+_clients_pid = os.getpid()
+# Async clients can only be used on the event loop that created them, so each loop has a registry of its own
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _http_options():
+    return {
+        'timeout': httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+        'limits': httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+    }
+
+
+def _create_client(api_key):
+    http_client = httpx.Client(**_http_options())
+    if USE_AZURE:
+        return AzureOpenAI(
+            api_key=api_key,
+            azure_endpoint=ENDPOINT,
+            api_version=DEPLOYMENT,
+            http_client=http_client,
+        )
+    else:
+        return OpenAI(api_key=api_key, http_client=http_client)
+
 
 def get_client(user):
+    """Return a client for the user's API key, reusing its connection pool across calls and threads."""
+    global _clients_pid
     api_key = get_api_key(user)
+    key = (api_key, ENDPOINT if USE_AZURE else None, USE_AZURE)
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            # Forked django-q worker: sockets inherited from the parent must not be shared with it
+            _clients.clear()
+            _clients_pid = os.getpid()
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = _create_client(api_key)
+            if len(_clients) > OPENAI_MAX_CLIENTS:
+                # Forget the least recently used one, its connections go away once in-flight calls finish
+                _clients.popitem(last=False)
+        else:
+            _clients.move_to_end(key)
+    return client
+
+
+def _create_async_client(api_key):
+    http_client = httpx.AsyncClient(**_http_options())
     if USE_AZURE:
-        return AzureOpenAI(
+        return AsyncAzureOpenAI(
             api_key=api_key,
             azure_endpoint=ENDPOINT,
-            api_version=DEPLOYMENT
+            api_version=DEPLOYMENT,
+            http_client=http_client,
         )
     else:
-        return OpenAI(api_key=api_key)
+        return AsyncOpenAI(api_key=api_key, http_client=http_client)
+
+
+def get_async_client(user):
+    """Async counterpart of get_client, for coroutines running on the current event loop."""
+    api_key = get_api_key(user)
+    key = (api_key, ENDPOINT if USE_AZURE else None, USE_AZURE)
+    # Only the loop's own thread touches its registry, no lock needed
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), OrderedDict())
+    client = clients.get(key)
+    if client is None:
+        client = clients[key] = _create_async_client(api_key)
+        if len(clients) > OPENAI_MAX_CLIENTS:
+            clients.popitem(last=False)
+    else:
+        clients.move_to_end(key)
+    return client
 
 def get_api_key(user):
     if user.use_system_api_key:
@@ -36,13 +143,282 @@ def get_api_key(user):
 
 
 
-def get_embedding(text: str, user, model: str = EMBEDDING_MODEL, USE_AZURE=USE_AZURE):
-    if len(str(text)) < 5 or len(str(text)) > 4000:
-        return [0.0] * 1536 
-    
-    client = get_client(user)
-    result = client.embeddings.create(model=model, input=str(text))
-    return result.data[0].embedding
+def get_embedding(text: str, user, model: str = EMBEDDING_MODEL, USE_AZURE=USE_AZURE, backend: str = None):
+    return get_embeddings([text], user, model=model, backend=backend)[0]
+
+
+async def aget_embedding(text: str, user, model: str = EMBEDDING_MODEL, backend: str = None):
+    """get_embedding for async code: the backend is awaited instead of blocking the event loop."""
+    text = str(text)
+    embedder = get_embedder(backend, model)
+    if not is_embeddable(text, embedder):
+        return [0.0] * settings.EMBEDDING_DIMENSIONS
+    key = text_hash(text)
+    cached = await sync_to_async(get_cached_embeddings)(embedder.cache_model, [key])
+    if key in cached:
+        return cached[key]
+    embedding = (await embedder.aembed([text], user))[0]
+    await sync_to_async(cache_embeddings)(embedder.cache_model, {key: embedding})
+    return embedding
+
+
+def query_embedding_key(text: str, model: str, backend: str = None) -> str:
+    return f"query-embedding:{get_embedder(backend, model).cache_model}:{text_hash(text)}"
+
+
+def get_query_embedding(text: str, user, model: str = EMBEDDING_MODEL, backend: str = None):
+    """Embedding of a search query, from the per-process or Redis cache when it was searched recently.
+
+    None when the query is too short (or too long) to embed: unlike a stored snippet, a query has no use for
+    the zero vector, whose cosine distance to anything is undefined. Search it by words instead.
+    """
+    if not is_embeddable(str(text), get_embedder(backend, model)):
+        return None
+    key = query_embedding_key(text, model, backend)
+    local_cache = caches['query_embeddings']
+    embedding = local_cache.get(key)
+    if embedding is not None:
+        return embedding
+
+    shared_cache = caches['default']
+    try:
+        embedding = shared_cache.get(key)
+    except Exception as e:
+        # Redis being down should only make search slower, not break it
+        logger.warning(f"Query embedding cache unavailable: {e}")
+
+    if embedding is None:
+        embedding = get_embedding(text, user, model=model, backend=backend)
+        try:
+            shared_cache.set(key, embedding, settings.QUERY_EMBEDDING_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"Query embedding cache unavailable: {e}")
+
+    local_cache.set(key, embedding)
+    return embedding
+
+
+async def aget_query_embedding(text: str, user, model: str = EMBEDDING_MODEL, backend: str = None):
+    """get_query_embedding for async views, which wait for the network without holding a thread."""
+    if not is_embeddable(str(text), get_embedder(backend, model)):
+        return None
+    key = query_embedding_key(text, model, backend)
+    local_cache = caches['query_embeddings']
+    embedding = local_cache.get(key)
+    if embedding is not None:
+        return embedding
+
+    shared_cache = caches['default']
+    try:
+        embedding = await shared_cache.aget(key)
+    except Exception as e:
+        logger.warning(f"Query embedding cache unavailable: {e}")
+
+    if embedding is None:
+        embedding = await aget_embedding(text, user, model=model, backend=backend)
+        try:
+            await shared_cache.aset(key, embedding, settings.QUERY_EMBEDDING_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"Query embedding cache unavailable: {e}")
+
+    local_cache.set(key, embedding)
+    return embedding
+
+
+def is_embeddable(text: str, embedder: EmbeddingBackend) -> bool:
+    # Shorter texts carry no meaning worth searching; the chunker keeps snippets within the model's context
+    if len(text) < 5:
+        return False
+    # Texts with fewer bytes than the limit have fewer tokens too, no need to tokenize them
+    return len(text.encode('utf-8')) + 2 <= embedder.max_tokens or embedder.count_tokens(text) <= embedder.max_tokens
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly 4 characters per token for English text; only used to size batches
+    return len(text) // 4 + 1
+
+
+def batch_for_embedding(texts: list, max_items: int = EMBEDDING_BATCH_SIZE, max_tokens: int = EMBEDDING_BATCH_TOKENS):
+    """Split (key, text) pairs into batches bounded by item count and estimated tokens."""
+    batch, batch_tokens = [], 0
+    for key, text in texts:
+        tokens = estimate_tokens(text)
+        if batch and (len(batch) >= max_items or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append((key, text))
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def supports_dimensions(model: str) -> bool:
+    # Only the text-embedding-3 models can return shortened embeddings
+    return model.startswith('text-embedding-3')
+
+
+@functools.lru_cache(maxsize=None)
+def token_encoding(model: str):
+    """tiktoken encoding of an OpenAI model, or None without tiktoken or its encoding files."""
+    try:
+        import tiktoken
+    except ImportError:
+        logger.warning("tiktoken is not installed, counting bytes instead of tokens: pip install tiktoken")
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Deployments (Azure) and new models go by any name, all embedding models share this encoding
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        # The encoding is downloaded on first use (or read from TIKTOKEN_CACHE_DIR)
+        logger.warning(f"No tiktoken encoding for {model}, counting bytes instead of tokens: {e}")
+        return None
+
+
+def embedding_cache_model(model: str) -> str:
+    """Name cached embeddings are filed under: the model, and the size when it is shortened."""
+    if supports_dimensions(model):
+        return f"{model}@{settings.EMBEDDING_DIMENSIONS}"
+    return model
+
+
+# Errors worth another try that aren't about the rate limit (APITimeoutError is an APIConnectionError)
+TRANSIENT_ERRORS = (APIConnectionError, InternalServerError)
+
+
+@register_backend
+class OpenAIEmbeddings(EmbeddingBackend):
+    """Embeds with the OpenAI (or Azure) API, with the user's or the system API key.
+
+    Calls of every worker share the key's rate limits (see rate_limits.py).
+    """
+    name = 'openai'
+    batch_size = EMBEDDING_BATCH_SIZE
+    max_tokens = OPENAI_EMBEDDING_MAX_TOKENS
+
+    def __init__(self, model: str = EMBEDDING_MODEL):
+        self.model = model
+
+    @property
+    def cache_model(self) -> str:
+        return embedding_cache_model(self.model)
+
+    def count_tokens(self, text: str) -> int:
+        encoding = token_encoding(self.model)
+        if encoding is None:
+            return super().count_tokens(text)
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def options(self) -> dict:
+        return {'dimensions': settings.EMBEDDING_DIMENSIONS} if supports_dimensions(self.model) else {}
+
+    def embed(self, texts: list, user) -> list:
+        options = self.options()
+        api_key = get_api_key(user)
+        tokens = sum(estimate_tokens(text) for text in texts)
+        # 429s are retried here, after the shared pause, rather than by each client on its own;
+        # so are transient errors, which the client would otherwise retry along with the 429s
+        client = get_client(user).with_options(max_retries=0)
+        rate_limited = failed = 0
+        while True:
+            wait_for_capacity(api_key, tokens)
+            try:
+                result = client.embeddings.create(model=self.model, input=texts, **options)
+                break
+            except RateLimitError as e:
+                if rate_limited == EMBEDDING_RATE_LIMIT_RETRIES:
+                    raise
+                back_off(api_key, retry_after(e.response), rate_limited)
+                rate_limited += 1
+            except TRANSIENT_ERRORS as e:
+                if failed == EMBEDDING_TRANSIENT_RETRIES:
+                    raise
+                logger.warning(f"Embedding call failed, trying again: {e}")
+                time.sleep(transient_delay(failed))
+                failed += 1
+        return self.read_embeddings(result, len(texts))
+
+    async def aembed(self, texts: list, user) -> list:
+        options = self.options()
+        api_key = get_api_key(user)
+        tokens = sum(estimate_tokens(text) for text in texts)
+        client = get_async_client(user).with_options(max_retries=0)
+        rate_limited = failed = 0
+        while True:
+            await await_capacity(api_key, tokens)
+            try:
+                result = await client.embeddings.create(model=self.model, input=texts, **options)
+                break
+            except RateLimitError as e:
+                if rate_limited == EMBEDDING_RATE_LIMIT_RETRIES:
+                    raise
+                await sync_to_async(back_off, thread_sensitive=False)(api_key, retry_after(e.response), rate_limited)
+                rate_limited += 1
+            except TRANSIENT_ERRORS as e:
+                if failed == EMBEDDING_TRANSIENT_RETRIES:
+                    raise
+                logger.warning(f"Embedding call failed, trying again: {e}")
+                await asyncio.sleep(transient_delay(failed))
+                failed += 1
+        return self.read_embeddings(result, len(texts))
+
+    def read_embeddings(self, result, count: int) -> list:
+        dimensions = settings.EMBEDDING_DIMENSIONS
+        embeddings = [None] * count
+        # The API echoes the position of each input, don't rely on response order
+        for item in result.data:
+            if len(item.embedding) != dimensions:
+                raise ValueError(f"{self.model} returned {len(item.embedding)} dimensions, "
+                                 f"settings.EMBEDDING_DIMENSIONS is {dimensions}")
+            embeddings[item.index] = item.embedding
+        return embeddings
+
+
+def get_embedder(backend: str = None, model: str = EMBEDDING_MODEL) -> EmbeddingBackend:
+    """The named backend (settings.EMBEDDING_BACKEND by default); model only applies to OpenAI."""
+    if (backend or settings.EMBEDDING_BACKEND) == OpenAIEmbeddings.name:
+        return OpenAIEmbeddings(model)
+    return get_backend(backend)
+
+
+def get_embeddings(texts: list, user, model: str = EMBEDDING_MODEL, backend: str = None) -> list:
+    """Embed many texts with as few backend calls as possible, returning vectors in input order.
+
+    Texts embedded before (by anyone, with the same backend and model) come from the embedding cache.
+    Embeddings have settings.EMBEDDING_DIMENSIONS dimensions.
+    """
+    embedder = get_embedder(backend, model)
+    embeddings = [None] * len(texts)
+    # Indexes of every input sharing the same normalized text, so repeated chunks are embedded once
+    positions = {}
+    for index, text in enumerate(texts):
+        text = str(text)
+        if not is_embeddable(text, embedder):
+            embeddings[index] = [0.0] * settings.EMBEDDING_DIMENSIONS
+        else:
+            positions.setdefault(text_hash(text), []).append(index)
+
+    if not positions:
+        return embeddings
+
+    cached = get_cached_embeddings(embedder.cache_model, list(positions))
+    missing = []
+    for key, indexes in positions.items():
+        if key in cached:
+            for index in indexes:
+                embeddings[index] = cached[key]
+        else:
+            missing.append((key, str(texts[indexes[0]])))
+
+    for batch in batch_for_embedding(missing, max_items=embedder.batch_size):
+        fresh = dict(zip([key for key, _ in batch], embedder.embed([text for _, text in batch], user)))
+        for key, embedding in fresh.items():
+            for index in positions[key]:
+                embeddings[index] = embedding
+        cache_embeddings(embedder.cache_model, fresh)
+    return embeddings
 
 
 #Get Ideas tags from the text
@@ -97,9 +473,12 @@ def get_user_intent(user_message: str, user) -> str:
             {"role": "user", "content": f"The user says: '{user_message}'. What do they want to do? \
              Options: they can upload new content by files, youtube links, or text. They can also search for a text. List seeds, seed detail or find similar. Also they can search.\
              Your goal to return the action they want to do. Commands are: \
-             list seeds, create seed, search, find similar, process youtube, upload file, seed detail, search"}
+             list seeds, create seed, search, find similar, process youtube, upload file, seed detail, search. \
+             Answer with the command only."}
         ],
-        max_tokens=5000
+        # A command is a couple of tokens
+        max_tokens=10,
+        temperature=0,
     )
-    action = response['choices'][0]['message']['content'].strip().lower()
-    return action
\ No newline at end of file
+    action = response.choices[0].message.content.strip().lower()
+    return action
@@ -1,7 +1,9 @@
 from django.contrib import admin
-from .models import Seed, Snippet, Garden
+from .models import Seed, Snippet, Garden, IngestionJob, EmbeddingBackfill
 
 # Register your models here.
 admin.site.register(Seed)
 admin.site.register(Snippet)
-admin.site.register(Garden)
\ No newline at end of file
+admin.site.register(Garden)
+admin.site.register(IngestionJob)
+admin.site.register(EmbeddingBackfill)
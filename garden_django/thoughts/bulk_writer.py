@@ -0,0 +1,170 @@
+import io
+import struct
+
+from django.db import DatabaseError, connection, transaction
+
+from .models import Snippet
+
+# Columns written for each snippet; the id comes from its identity column and search_vector from the trigger
+SNIPPET_COLUMNS = ['content', 'seed_id', 'garden_id', 'ordinal', 'start_time', 'page', 'embedding',
+                   'embedding_status', 'embedding_attempts']
+
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+COPY_TRAILER = struct.pack('>h', -1)
+NULL = struct.pack('>i', -1)
+
+
+def _text(value):
+    # Postgres text can't hold NUL, which PDF extraction produces now and then
+    return str(value).replace('\x00', '').encode('utf-8')
+
+
+def _vector(value, code):
+    # pgvector's binary format: dimensions, an unused short, then the values
+    return struct.pack(f'>HH{len(value)}{code}', len(value), 0, *value)
+
+
+# Binary COPY encoders by column type
+ENCODERS = {
+    'text': _text,
+    'character varying': _text,
+    'bigint': lambda value: struct.pack('>q', value),
+    'integer': lambda value: struct.pack('>i', value),
+    'smallint': lambda value: struct.pack('>h', value),
+    'vector': lambda value: _vector(value, 'f'),
+    'halfvec': lambda value: _vector(value, 'e'),
+}
+
+_encoders = None
+
+
+def snippet_encoders(cursor) -> list:
+    """Binary encoder of each SNIPPET_COLUMNS column, looked up once per process (until
+    forget_snippet_encoders), or None when a column has a type without one (then rows are sent as text)."""
+    global _encoders
+    if _encoders is None:
+        cursor.execute(
+            "SELECT attname, format_type(atttypid, NULL) FROM pg_attribute "
+            "WHERE attrelid = %s::regclass AND attname = ANY(%s)",
+            [Snippet._meta.db_table, SNIPPET_COLUMNS],
+        )
+        types = dict(cursor.fetchall())
+        encoders = [ENCODERS.get(types.get(column)) for column in SNIPPET_COLUMNS]
+        _encoders = encoders if all(encoders) else []
+    return _encoders or None
+
+
+def forget_snippet_encoders():
+    """Look the column types up again on the next COPY, e.g. once the embedding column changed from vector
+    to halfvec (see vector_storage.convert_embedding_storage)."""
+    global _encoders
+    _encoders = None
+
+
+def _binary_rows(rows, encoders):
+    yield COPY_SIGNATURE
+    field_count = struct.pack('>h', len(encoders))
+    for row in rows:
+        fields = [field_count]
+        for value, encode in zip(row, encoders):
+            if value is None:
+                fields.append(NULL)
+            else:
+                data = encode(value)
+                fields.append(struct.pack('>i', len(data)))
+                fields.append(data)
+        yield b''.join(fields)
+    yield COPY_TRAILER
+
+
+def _escape(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, (list, tuple)):
+        return '[' + ','.join(repr(float(number)) for number in value) + ']'
+    text = str(value).replace('\x00', '')
+    return text.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _text_rows(rows):
+    for row in rows:
+        yield ('\t'.join(_escape(value) for value in row) + '\n').encode('utf-8')
+
+
+class RowStream(io.RawIOBase):
+    """File object over an iterator of byte strings, so COPY reads rows as they are encoded."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            self.pending = next(self.chunks, None)
+            if self.pending is None:
+                self.pending = b''
+                return 0
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def copy_snippets(snippets) -> int:
+    """Store unsaved Snippet instances with a single COPY instead of an INSERT per row, in one transaction.
+
+    Every snippet needs its seed_id, garden_id and ordinal set; Snippet.save() and its defaults
+    are bypassed, and the instances don't get their ids. Returns the number of rows written.
+    """
+    rows = [
+        (snippet.content, snippet.seed_id, snippet.garden_id, snippet.ordinal, snippet.start_time, snippet.page,
+         None if snippet.embedding is None else [float(value) for value in snippet.embedding],
+         snippet.embedding_status, snippet.embedding_attempts)
+        for snippet in snippets
+    ]
+    if not rows:
+        return 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        try:
+            with transaction.atomic():
+                _copy_rows(cursor, rows)
+        except DatabaseError:
+            # Another process may have converted the embedding column since this one looked its type up
+            stale = _encoders
+            forget_snippet_encoders()
+            snippet_encoders(cursor)
+            if _encoders == stale:
+                raise
+            _copy_rows(cursor, rows)
+    return len(rows)
+
+
+def _copy_rows(cursor, rows):
+    columns = ', '.join(SNIPPET_COLUMNS)
+    encoders = snippet_encoders(cursor)
+    if encoders:
+        sql = f"COPY {Snippet._meta.db_table} ({columns}) FROM STDIN WITH (FORMAT binary)"
+        stream = RowStream(_binary_rows(rows, encoders))
+    else:
+        sql = f"COPY {Snippet._meta.db_table} ({columns}) FROM STDIN"
+        stream = RowStream(_text_rows(rows))
+    # copy_expert isn't wrapped by Django, which would turn driver errors into django.db ones
+    with connection.wrap_database_errors:
+        cursor.copy_expert(sql, io.BufferedReader(stream, buffer_size=1 << 20))
+
+
+def clone_snippets(source, seed) -> int:
+    """Copy the snippets of the source seed to seed with a single INSERT ... SELECT, so their text and
+    embeddings never leave the database. Returns the number of snippets copied."""
+    columns = ', '.join(column for column in SNIPPET_COLUMNS if column not in ['seed_id', 'garden_id'])
+    table = Snippet._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} (seed_id, garden_id, {columns}) "
+            f"SELECT %s, %s, {columns} FROM {table} WHERE seed_id = %s ORDER BY ordinal",
+            [seed.pk, seed.garden_id, source.pk],
+        )
+        return cursor.rowcount
@@ -0,0 +1,127 @@
+import re
+from collections import deque, namedtuple
+
+from django.conf import settings
+
+from .LLM import get_embedder
+
+# A sentence (or line) of the source with the whitespace after it, its size and where it sits in the source
+Unit = namedtuple('Unit', ['text', 'tokens', 'start', 'position'])
+
+# Sentences end at ., ? or ! followed by whitespace, lines at a newline; trailing whitespace stays with them
+SENTENCE = re.compile(r'.+?(?:[.?!]+(?=\s)|\n|$)\s*', re.DOTALL)
+WORD = re.compile(r'\S+\s*|\s+')
+
+
+def chunk_token_limit(backend: str = None) -> int:
+    """Most tokens in a chunk: settings.CHUNK_MAX_TOKENS, or less when the backend's model can't take that many."""
+    return min(settings.CHUNK_MAX_TOKENS, get_embedder(backend).max_tokens)
+
+
+def _pieces(text, count_tokens, max_tokens):
+    """Splits a sentence longer than max_tokens at words, and words longer than that into slices."""
+    piece, piece_tokens, offset = '', 0, 0
+    for word in WORD.finditer(text):
+        word_text, word_tokens = word.group(0), count_tokens(word.group(0))
+        if piece and piece_tokens + word_tokens > max_tokens:
+            yield offset, piece
+            offset, piece, piece_tokens = word.start(), '', 0
+        if word_tokens > max_tokens:
+            start = word.start()
+            while start < word.end():
+                # Shrink the slice in proportion until it fits; a single character always does
+                end = word.end()
+                while end - start > 1 and count_tokens(text[start:end]) > max_tokens:
+                    end = start + max(1, (end - start) * max_tokens // count_tokens(text[start:end]))
+                yield start, text[start:end]
+                start = end
+            offset = word.end()
+            continue
+        piece += word_text
+        piece_tokens += word_tokens
+    if piece:
+        yield offset, piece
+
+
+def _units(segments, count_tokens, max_tokens):
+    offset = 0
+    for text, position in segments:
+        for sentence in SENTENCE.finditer(text):
+            tokens = count_tokens(sentence.group(0))
+            if tokens <= max_tokens:
+                yield Unit(sentence.group(0), tokens, offset + sentence.start(), position)
+            else:
+                for start, piece in _pieces(sentence.group(0), count_tokens, max_tokens):
+                    yield Unit(piece, count_tokens(piece), offset + sentence.start() + start, position)
+        offset += len(text)
+
+
+def _chunk(units, count_tokens, max_tokens):
+    text = ''.join(unit.text for unit in units)
+    stripped = text.strip()
+    if not stripped:
+        return
+    start = units[0].start + len(text) - len(text.lstrip())
+    if count_tokens(stripped) > max_tokens:
+        # Tokens of joined sentences hardly ever outnumber those of the sentences apart, but they might
+        for offset, piece in _pieces(stripped, count_tokens, max_tokens):
+            if piece.strip():
+                yield _chunk_dict(piece.strip(), start + offset + len(piece) - len(piece.lstrip()), units[0])
+        return
+    yield _chunk_dict(stripped, start, units[0])
+
+
+def _chunk_dict(text, start, first):
+    return {'text': text, **first.position, 'char_start': start, 'char_end': start + len(text)}
+
+
+def iter_token_chunks(segments, backend: str = None, max_tokens: int = None, overlap_tokens: int = None,
+                      max_chars: int = None):
+    """Splits streamed text into chunks of whole sentences that the backend's model can embed, in one pass.
+
+    segments is an iterable of (text, position) pairs, position being a dict such as {'page': 3} or
+    {'start_time': 75} that the chunks starting in that text carry along. Chunks hold at most max_tokens
+    tokens of the model (chunk_token_limit() by default) and max_chars characters, and repeat about
+    overlap_tokens tokens of the end of the previous chunk (settings.CHUNK_OVERLAP_TOKENS). Sentences
+    too long for a chunk are split at words. Yields dicts with the chunk 'text', its position and its
+    'char_start' and 'char_end' offsets in the concatenated segments.
+    """
+    embedder = get_embedder(backend)
+    count_tokens = embedder.count_tokens
+    max_tokens = min(max_tokens or chunk_token_limit(backend), embedder.max_tokens)
+    overlap_tokens = settings.CHUNK_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens
+    max_chars = max_chars or float('inf')
+
+    window, tokens, chars, fresh = deque(), 0, 0, False
+    for unit in _units(segments, count_tokens, max_tokens):
+        while window and (tokens + unit.tokens > max_tokens or chars + len(unit.text.rstrip()) > max_chars):
+            if fresh:
+                yield from _chunk(list(window), count_tokens, max_tokens)
+                fresh = False
+            # Keep the tail of the chunk (at most overlap_tokens) to start the next one with
+            dropped = window.popleft()
+            tokens, chars = tokens - dropped.tokens, chars - len(dropped.text)
+            while window and tokens > overlap_tokens:
+                dropped = window.popleft()
+                tokens, chars = tokens - dropped.tokens, chars - len(dropped.text)
+        window.append(unit)
+        tokens, chars, fresh = tokens + unit.tokens, chars + len(unit.text), True
+    if fresh and window:
+        yield from _chunk(list(window), count_tokens, max_tokens)
+
+
+def fit_chunks(chunks, backend: str = None):
+    """The chunks (dicts with 'text') with those too long for the backend's model split up, so none is
+    left unembedded; the pieces keep the position (page, start_time...) of the chunk they come from."""
+    embedder = get_embedder(backend)
+    for chunk in chunks:
+        if embedder.count_tokens(chunk['text']) <= embedder.max_tokens:
+            yield chunk
+            continue
+        position = {key: value for key, value in chunk.items() if key not in ['text', 'char_start', 'char_end']}
+        offset = chunk.get('char_start') or 0
+        for piece in iter_token_chunks([(chunk['text'], position)], backend, max_tokens=embedder.max_tokens,
+                                       overlap_tokens=0):
+            piece['char_start'] += offset
+            piece['char_end'] += offset
+            yield piece
@@ -1,23 +1,371 @@
+import asyncio
+import logging
+
 from django.db.models import QuerySet
-from .models import Garden, Snippet, Seed
-from django.db.models import Q
+from .models import Garden, Snippet, Seed, SEED_LISTING_CACHE_KEY
+from django.db.models import Q, F, OuterRef, Subquery, prefetch_related_objects
+from django.db.models.functions import Left
+from django.db import connection, transaction
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from pgvector.django import L2Distance, CosineDistance, MaxInnerProduct
+
+from asgiref.sync import sync_to_async
+
+from .LLM import get_query_embedding, aget_query_embedding
+
+logger = logging.getLogger(__name__)
+
+# Distance function matching the operator class of the snippet HNSW index (see settings.VECTOR_DISTANCE)
+DISTANCE_FUNCTIONS = {
+    'cosine': CosineDistance,
+    'ip': MaxInnerProduct,
+    'l2': L2Distance,
+}
+
+# Text search configuration, must match the one of the search_vector triggers (migration 0017)
+SEARCH_CONFIG = 'english'
 
 def get_accessible_gardens(user):
     """Retrieve all gardens accessible to the given user."""
     # Combine queries using Q objects for any of the conditions being true
     accessible_gardens = Garden.objects.filter(
-        Q(owner=user) | 
+        Q(owner=user) |
         Q(gardenmembership__user=user)
     ).distinct()
 
     return accessible_gardens
 
-def filter_snippets_for_user(user) -> QuerySet:
+def get_accessible_garden_ids(user) -> list:
+    """Ids of the gardens accessible to the given user, fetched once per call."""
+    return list(get_accessible_gardens(user).values_list('id', flat=True))
+
+def get_garden_ids_by_backend(user) -> dict:
+    """Ids of the gardens accessible to the user, grouped by the embedding backend of their snippets.
+    Embeddings of different backends can't be compared, so each group is searched with its own query embedding."""
+    groups = {}
+    for garden_id, backend in get_accessible_gardens(user).values_list('id', 'embedding_backend'):
+        groups.setdefault(backend or settings.EMBEDDING_BACKEND, []).append(garden_id)
+    return groups
+
+async def aget_garden_ids_by_backend(user) -> dict:
+    """get_garden_ids_by_backend for async views."""
+    groups = {}
+    async for garden_id, backend in get_accessible_gardens(user).values_list('id', 'embedding_backend'):
+        groups.setdefault(backend or settings.EMBEDDING_BACKEND, []).append(garden_id)
+    return groups
+
+def filter_snippets_for_user(user, garden_ids=None) -> QuerySet:
     """Retrieve snippets from seeds that are in gardens accessible to the user."""
-    accessible_gardens = get_accessible_gardens(user)
-    return Snippet.objects.filter(seed__garden__in=accessible_gardens)
+    # A single garden_id = ANY(...) predicate on the snippets' own column, no join with seeds or gardens
+    if garden_ids is None:
+        garden_ids = get_accessible_garden_ids(user)
+    return Snippet.objects.filter(garden_id__in=garden_ids)
 
-def filter_seeds_for_user(user) -> QuerySet:
+def filter_seeds_for_user(user, garden_ids=None) -> QuerySet:
     """Retrieve seeds from gardens accessible to the user."""
+    if garden_ids is not None:
+        return Seed.objects.filter(garden_id__in=garden_ids)
     accessible_gardens = get_accessible_gardens(user)
-    return Seed.objects.filter(garden__in=accessible_gardens)
\ No newline at end of file
+    return Seed.objects.filter(garden__in=accessible_gardens)
+
+def list_seeds_page(user, before=None, per_page=None) -> tuple:
+    """One page of the user's seeds, newest first, as dicts of the columns a listing shows.
+
+    The page starts below the seed id `before` (the cursor returned with the previous page).
+    The first page is cached per user until a seed in one of their gardens changes.
+    Returns (seeds, cursor of the next page or None).
+    """
+    per_page = per_page or settings.SEEDS_PER_PAGE
+    cache_key = SEED_LISTING_CACHE_KEY.format(user_id=user.pk) if before is None else None
+    if cache_key:
+        try:
+            cached = cache.get(cache_key)
+        except Exception as e:
+            logger.warning(f"Seed listing cache unavailable: {e}")
+            cached = None
+        if cached is not None and cached[0] == per_page:
+            return cached[1], cached[2]
+
+    seeds = Seed.objects.filter(garden_id__in=get_accessible_garden_ids(user))
+    if before is not None:
+        seeds = seeds.filter(id__lt=before)
+    # Never the transcript or the embedding, and only the start of the description
+    page = list(seeds.order_by('-id').values(
+        'id', 'title', 'author', 'is_youtube', 'created_at', excerpt=Left('description', 500),
+    )[:per_page + 1])
+    cursor = page[per_page - 1]['id'] if len(page) > per_page else None
+    page = page[:per_page]
+
+    if cache_key:
+        try:
+            cache.set(cache_key, (per_page, page, cursor), settings.SEED_LISTING_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"Seed listing cache unavailable: {e}")
+    return page, cursor
+
+def page_snippets(seed, per_page=10, after=None, before=None, around=None, last=False):
+    """One page of the seed's snippets in reading order, found by ordinal on the (seed, ordinal) index.
+
+    The page starts after the ordinal `after`, ends before the ordinal `before`, is the last page,
+    or is the page holding the ordinal `around`; without any of those it is the first page.
+    Returns (snippets, has_previous, has_next).
+    """
+    snippets = seed.parts.defer('embedding', 'search_vector')
+    if around is not None:
+        # Pages are aligned on multiples of per_page, so the highlighted snippet's page is known up front
+        after = around - around % per_page - 1
+    if before is not None or last:
+        if before is not None:
+            snippets = snippets.filter(ordinal__lt=before)
+        page = list(snippets.order_by('-ordinal')[:per_page + 1])
+        has_previous = len(page) > per_page
+        page = page[:per_page][::-1]
+        has_next = before is not None
+    else:
+        if after is not None:
+            snippets = snippets.filter(ordinal__gt=after)
+        page = list(snippets.order_by('ordinal')[:per_page + 1])
+        has_next = len(page) > per_page
+        page = page[:per_page]
+        has_previous = after is not None and seed.parts.filter(ordinal__lte=after).exists()
+    return page, has_previous, has_next
+
+def vector_distance(embedding, field='embedding'):
+    """Distance expression that the HNSW index can serve."""
+    return DISTANCE_FUNCTIONS[settings.VECTOR_DISTANCE](field, embedding)
+
+def nearest(queryset, embedding, limit, ef_search=None) -> list:
+    """Return the `limit` rows of queryset closest to embedding, using the HNSW index.
+
+    ef_search trades recall for latency for this query only and defaults to settings.HNSW_EF_SEARCH.
+    """
+    # The index can never return more rows than its candidate list
+    ef_search = max(int(ef_search or settings.HNSW_EF_SEARCH), limit)
+    # SET LOCAL only lasts until the end of the transaction, so evaluate the queryset inside it
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL hnsw.ef_search = %s", [ef_search])
+        return list(queryset.annotate(distance=vector_distance(embedding)).order_by('distance')[:limit])
+
+def search_snippets(user, embedding, limit=15, ef_search=None, exclude_id=None, garden_ids=None) -> list:
+    """Retrieve the snippets accessible to the user that are closest to embedding.
+
+    garden_ids narrows the search to some of the user's gardens, e.g. those of one embedding backend.
+    """
+    snippets = filter_snippets_for_user(user, garden_ids).filter(embedding_status=Snippet.EMBEDDED).select_related('seed')
+    if exclude_id is not None:
+        snippets = snippets.exclude(id=exclude_id)
+    return nearest(snippets, embedding, limit, ef_search=ef_search)
+
+def search_similar_snippets(user, snippet, limit=6, ef_search=None) -> list:
+    """Retrieve the snippets accessible to the user closest to snippet, among those embedded by the same backend."""
+    if snippet.embedding is None:
+        return []
+    garden_ids = get_garden_ids_by_backend(user).get(snippet.garden.backend_name, [])
+    return search_snippets(user, snippet.embedding, limit=limit, ef_search=ef_search, exclude_id=snippet.pk,
+                           garden_ids=garden_ids)
+
+def search_seed_centroids(user, embedding, limit=15, ef_search=None, garden_ids=None) -> list:
+    """Retrieve the seeds accessible to the user whose centroid (mean snippet embedding) is closest to embedding."""
+    seeds = filter_seeds_for_user(user, garden_ids).filter(embedded_snippets__gt=0)
+    return nearest(seeds, embedding, limit, ef_search=ef_search)
+
+def search_snippets_coarse(user, embedding, limit=15, seeds=None, ef_search=None, garden_ids=None) -> list:
+    """Retrieve the snippets closest to embedding, looking only inside the `seeds` seeds whose
+    centroids are closest to it (settings.COARSE_SEEDS by default)."""
+    top_seeds = search_seed_centroids(user, embedding, limit=seeds or settings.COARSE_SEEDS, ef_search=ef_search,
+                                      garden_ids=garden_ids)
+    snippets = filter_snippets_for_user(user, garden_ids).filter(
+        seed_id__in=[seed.id for seed in top_seeds], embedding_status=Snippet.EMBEDDED
+    ).select_related('seed')
+    # Only a few seeds' snippets are left, so the planner ranks them exactly instead of walking the index
+    return list(snippets.annotate(distance=vector_distance(embedding)).order_by('distance')[:limit])
+
+def search_snippets_lexical(user, search_text, limit=15) -> list:
+    """Retrieve the snippets accessible to the user that best match search_text as words, in their content
+    or in their seed's title or author, the two fused by rank. Needs no embedding at all."""
+    content_hits = list(
+        _lexical_candidates(filter_snippets_for_user(user), search_text).select_related('seed').order_by('-rank')[:limit]
+    )
+    title_hits = list(_title_candidates(filter_seeds_for_user(user), search_text).order_by('-rank')[:limit])
+    parts = Snippet.objects.select_related('seed').in_bulk([seed.snippet_id for seed in title_hits])
+    for seed in title_hits:
+        parts[seed.snippet_id].rank = seed.rank
+    return fuse_by_rank([content_hits, [parts[seed.snippet_id] for seed in title_hits]], limit)
+
+def search_seeds_lexical(user, search_text, limit=15) -> list:
+    """The seeds of the snippets search_snippets_lexical finds, best first, for the 'seeds' mode when the
+    query can't be embedded. They have no distance to the query."""
+    seeds = {}
+    for part in search_snippets_lexical(user, search_text, limit=limit * 3):
+        seeds.setdefault(part.seed_id, part.seed)
+    for seed in seeds.values():
+        seed.distance = None
+    return list(seeds.values())[:limit]
+
+def _search_query(search_text) -> SearchQuery:
+    return SearchQuery(search_text, search_type='websearch', config=SEARCH_CONFIG)
+
+def _lexical_candidates(snippets, search_text) -> QuerySet:
+    """The snippets whose content matches search_text, with their rank."""
+    query = _search_query(search_text)
+    return snippets.filter(search_vector=query).annotate(rank=SearchRank(F('search_vector'), query))
+
+def _title_candidates(seeds, search_text) -> QuerySet:
+    """The seeds whose title or author match search_text, with their rank and the id of their opening
+    snippet (snippet_id): a seed that matches stands in the results once, not with every one of its snippets."""
+    query = _search_query(search_text)
+    opening = Snippet.objects.filter(seed=OuterRef('pk')).order_by('ordinal').values('id')[:1]
+    return seeds.filter(search_vector=query).annotate(
+        rank=SearchRank(F('search_vector'), query), snippet_id=Subquery(opening)
+    ).filter(snippet_id__isnull=False)
+
+def search_snippets_hybrid(user, search_text, embeddings, limit=15, ef_search=None) -> list:
+    """Retrieve the snippets accessible to the user ranked by reciprocal rank fusion of
+    the vector and the lexical top candidates, in a single query.
+
+    embeddings maps embedding backends to the query's embedding by that backend; the gardens of
+    each backend make a vector candidate list of their own.
+    """
+    candidates = settings.HYBRID_CANDIDATES
+    ef_search = max(int(ef_search or settings.HNSW_EF_SEARCH), candidates)
+
+    groups = get_garden_ids_by_backend(user)
+    if not groups:
+        # Nothing to search, and an empty IN list can't be compiled into the raw query below
+        return []
+    garden_ids = [garden_id for ids in groups.values() for garden_id in ids]
+    snippets = Snippet.objects.filter(garden_id__in=garden_ids)
+    seeds = Seed.objects.filter(garden_id__in=garden_ids)
+
+    ranked_lists, params = [], []
+    for backend, embedding in embeddings.items():
+        if not groups.get(backend):
+            continue
+        vector_sql, vector_params = Snippet.objects.filter(
+            garden_id__in=groups[backend], embedding_status=Snippet.EMBEDDED
+        ).annotate(
+            distance=vector_distance(embedding)
+        ).order_by('distance').values('id', 'distance')[:candidates].query.sql_with_params()
+        ranked_lists.append(f"SELECT id, row_number() OVER (ORDER BY distance) AS position FROM ({vector_sql}) AS vector_hits")
+        params.extend(vector_params)
+    lexical_sql, lexical_params = _lexical_candidates(snippets, search_text).order_by(
+        '-rank'
+    ).values('id', 'rank')[:candidates].query.sql_with_params()
+    ranked_lists.append(f"SELECT id, row_number() OVER (ORDER BY rank DESC) AS position FROM ({lexical_sql}) AS lexical_hits")
+    params.extend(lexical_params)
+    # Seeds matching by title or author make a list of their own, one snippet each
+    title_sql, title_params = _title_candidates(seeds, search_text).order_by(
+        '-rank'
+    ).values('snippet_id', 'rank')[:candidates].query.sql_with_params()
+    ranked_lists.append(f"SELECT snippet_id AS id, row_number() OVER (ORDER BY rank DESC) AS position FROM ({title_sql}) AS title_hits")
+    params.extend(title_params)
+
+    # Each list contributes 1 / (k + rank) for every snippet it found
+    sql = f"""
+        SELECT snippet.*, fused.score FROM {Snippet._meta.db_table} AS snippet
+        JOIN (
+            SELECT id, SUM(1.0 / (%s + position)) AS score FROM (
+                {" UNION ALL ".join(ranked_lists)}
+            ) AS ranked
+            GROUP BY id
+        ) AS fused ON fused.id = snippet.id
+        ORDER BY fused.score DESC
+        LIMIT %s
+    """
+    params = (settings.RRF_K, *params, limit)
+    # SET LOCAL only lasts until the end of the transaction, so evaluate the query inside it
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL hnsw.ef_search = %s", [ef_search])
+        parts = list(Snippet.objects.raw(sql, params))
+    prefetch_related_objects(parts, 'seed')
+    return parts
+
+def snippet_search_mode(mode=None) -> str:
+    """mode (settings.SEARCH_MODE by default) for callers that show snippets: 'seeds' becomes 'hybrid'."""
+    mode = mode or settings.SEARCH_MODE
+    return 'hybrid' if mode == 'seeds' else mode
+
+def run_search(user, search_text, mode=None, limit=15, ef_search=None, embeddings=None):
+    """Search the user's snippets in the given mode: 'hybrid', 'vector', 'coarse' (vector, within the
+    closest seeds only) or 'lexical'. The 'seeds' mode returns the closest seeds instead of snippets.
+
+    The query is embedded once per embedding backend used by the user's gardens, unless embeddings
+    ({backend: query embedding}) were computed beforehand. Queries too short to embed are searched
+    by words only, as are those hybrid search can't embed (e.g. API outage).
+    """
+    mode = mode or settings.SEARCH_MODE
+    if mode == 'lexical':
+        return search_snippets_lexical(user, search_text, limit=limit)
+
+    groups = get_garden_ids_by_backend(user)
+    if embeddings is None:
+        embeddings = {}
+        for backend in groups:
+            try:
+                embedding = get_query_embedding(search_text, user, backend=backend)
+            except Exception as e:
+                if mode != 'hybrid':
+                    raise
+                logger.warning(f"Embedding the query with {backend} failed, searching those gardens by words only: {e}")
+                continue
+            if embedding is not None:
+                embeddings[backend] = embedding
+    if groups and not embeddings:
+        if mode == 'seeds':
+            return search_seeds_lexical(user, search_text, limit=limit)
+        return search_snippets_lexical(user, search_text, limit=limit)
+
+    if mode == 'hybrid':
+        return search_snippets_hybrid(user, search_text, embeddings, limit=limit, ef_search=ef_search)
+    search = {
+        'vector': search_snippets,
+        'coarse': search_snippets_coarse,
+        'seeds': search_seed_centroids,
+    }[mode]
+    ranked_lists = [
+        search(user, embedding, limit=limit, ef_search=ef_search, garden_ids=groups[backend])
+        for backend, embedding in embeddings.items()
+    ]
+    if len(ranked_lists) == 1:
+        return ranked_lists[0][:limit]
+    return fuse_by_rank(ranked_lists, limit)
+
+def fuse_by_rank(ranked_lists, limit) -> list:
+    """Merge ranked results by reciprocal rank fusion, like search_snippets_hybrid. Distances in the vector
+    spaces of different embedding backends can't be compared, ranks in each list can."""
+    scores = {}
+    for ranked in ranked_lists:
+        for position, result in enumerate(ranked, start=1):
+            score, _ = scores.get(result.pk, (0.0, result))
+            scores[result.pk] = (score + 1.0 / (settings.RRF_K + position), result)
+    # sorted() is stable, so ties keep the order of the lists
+    fused = sorted(scores.values(), key=lambda item: item[0], reverse=True)
+    return [result for _, result in fused[:limit]]
+
+async def arun_search(user, search_text, mode=None, limit=15, ef_search=None):
+    """run_search for async views. The query is embedded by every backend at once without holding a
+    thread; only the index queries, which need SET LOCAL inside a transaction, run in a worker thread."""
+    mode = mode or settings.SEARCH_MODE
+    embeddings = None
+    if mode != 'lexical':
+        groups = await aget_garden_ids_by_backend(user)
+        results = await asyncio.gather(
+            *(aget_query_embedding(search_text, user, backend=backend) for backend in groups),
+            return_exceptions=True,
+        )
+        embeddings = {}
+        for backend, result in zip(groups, results):
+            if result is None:
+                continue
+            if not isinstance(result, Exception):
+                embeddings[backend] = result
+            elif mode == 'hybrid':
+                logger.warning(f"Embedding the query with {backend} failed, searching those gardens by words only: {result}")
+            else:
+                raise result
+    return await sync_to_async(run_search)(user, search_text, mode=mode, limit=limit, ef_search=ef_search,
+                                           embeddings=embeddings)
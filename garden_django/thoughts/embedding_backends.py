@@ -0,0 +1,149 @@
+import os
+import logging
+import threading
+from importlib.util import find_spec
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Local embedding model (a sentence-transformers model name or path), loaded once per process.
+# Its output size must match settings.EMBEDDING_DIMENSIONS, like every backend of a deployment.
+LOCAL_EMBEDDING_MODEL = os.getenv('LOCAL_EMBEDDING_MODEL', 'BAAI/bge-small-en-v1.5')
+# Output size of the local model (384 for bge-small-en-v1.5), known without loading it
+LOCAL_EMBEDDING_DIMENSIONS = int(os.getenv('LOCAL_EMBEDDING_DIMENSIONS', 384))
+# 'torch' or 'onnx' (needs the onnx extras of sentence-transformers)
+LOCAL_EMBEDDING_RUNTIME = os.getenv('LOCAL_EMBEDDING_RUNTIME', 'torch')
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv('LOCAL_EMBEDDING_BATCH_SIZE', 64))
+# CPU threads used for inference in each process
+LOCAL_EMBEDDING_THREADS = int(os.getenv('LOCAL_EMBEDDING_THREADS', min(4, os.cpu_count() or 1)))
+# Longest input of the local model in tokens (sentence-transformers cuts longer texts short)
+LOCAL_EMBEDDING_MAX_TOKENS = int(os.getenv('LOCAL_EMBEDDING_MAX_TOKENS', 512))
+
+BACKEND_CHOICES = [
+    ('openai', 'OpenAI'),
+    ('local', 'Local model'),
+]
+
+_backends = {}
+
+
+class EmbeddingBackend:
+    """Turns texts into embeddings. All backends of a deployment return settings.EMBEDDING_DIMENSIONS floats,
+    but each has its own vector space: a garden's snippets and the queries searching them must share a backend."""
+    name = None
+    # Most texts sent to embed() at once
+    batch_size = 256
+    # Longest text the model takes, in its tokens
+    max_tokens = 512
+
+    @property
+    def cache_model(self) -> str:
+        """Name the backend's embeddings are cached under."""
+        raise NotImplementedError
+
+    def embed(self, texts: list, user) -> list:
+        """Embeddings of texts, in order."""
+        raise NotImplementedError
+
+    async def aembed(self, texts: list, user) -> list:
+        """embed for async code; backends without a native async client embed in a worker thread."""
+        return await sync_to_async(self.embed, thread_sensitive=False)(texts, user)
+
+    @classmethod
+    def unavailable_reason(cls) -> str:
+        """Why the backend can't embed in this deployment, or None when it can."""
+        return None
+
+    def count_tokens(self, text: str) -> int:
+        """Tokens of the text for the model. Without the model's tokenizer, its UTF-8 bytes plus two:
+        subword tokens are at least a byte long, and some models add start and end markers."""
+        return len(text.encode('utf-8')) + 2
+
+
+def register_backend(backend_class):
+    _backends[backend_class.name] = backend_class
+    return backend_class
+
+
+def get_backend(name: str = None) -> EmbeddingBackend:
+    return _backends[name or settings.EMBEDDING_BACKEND]()
+
+
+_local_model = None
+_local_model_lock = threading.Lock()
+_local_tokenizer = None
+
+
+def load_local_model():
+    """The local model of this process, loaded on first use (after django-q forked its workers)."""
+    global _local_model
+    with _local_model_lock:
+        if _local_model is None:
+            try:
+                import torch
+                from sentence_transformers import SentenceTransformer
+            except ImportError as e:
+                raise ImportError("The local embedding backend needs sentence-transformers: "
+                                  "pip install sentence-transformers") from e
+            torch.set_num_threads(LOCAL_EMBEDDING_THREADS)
+            logger.info(f"Loading local embedding model {LOCAL_EMBEDDING_MODEL} ({LOCAL_EMBEDDING_RUNTIME})")
+            _local_model = SentenceTransformer(LOCAL_EMBEDDING_MODEL, device='cpu', backend=LOCAL_EMBEDDING_RUNTIME)
+        return _local_model
+
+
+def load_local_tokenizer():
+    """The tokenizer of the local model, without the model itself (chunking runs in processes that don't embed),
+    or None when transformers isn't installed or doesn't know the model."""
+    global _local_tokenizer
+    with _local_model_lock:
+        if _local_tokenizer is None:
+            try:
+                from transformers import AutoTokenizer
+                _local_tokenizer = AutoTokenizer.from_pretrained(LOCAL_EMBEDDING_MODEL)
+            except Exception as e:
+                logger.warning(f"No tokenizer for {LOCAL_EMBEDDING_MODEL}, counting bytes instead: {e}")
+                _local_tokenizer = False
+        return _local_tokenizer or None
+
+
+@register_backend
+class LocalEmbeddings(EmbeddingBackend):
+    """Embeds on this machine's CPU, in batches, without any network call."""
+    name = 'local'
+    batch_size = LOCAL_EMBEDDING_BATCH_SIZE
+    max_tokens = LOCAL_EMBEDDING_MAX_TOKENS
+
+    @property
+    def cache_model(self) -> str:
+        return f"local:{LOCAL_EMBEDDING_MODEL}"
+
+    @classmethod
+    def unavailable_reason(cls) -> str:
+        if find_spec('sentence_transformers') is None:
+            return "sentence-transformers isn't installed"
+        if LOCAL_EMBEDDING_DIMENSIONS != settings.EMBEDDING_DIMENSIONS:
+            return (f"{LOCAL_EMBEDDING_MODEL} returns {LOCAL_EMBEDDING_DIMENSIONS} dimensions, "
+                    f"settings.EMBEDDING_DIMENSIONS is {settings.EMBEDDING_DIMENSIONS}")
+        return None
+
+    def embed(self, texts: list, user) -> list:
+        model = load_local_model()
+        embeddings = model.encode(
+            texts,
+            batch_size=LOCAL_EMBEDDING_BATCH_SIZE,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        if embeddings.shape[1] != settings.EMBEDDING_DIMENSIONS:
+            raise ValueError(f"{LOCAL_EMBEDDING_MODEL} returned {embeddings.shape[1]} dimensions, "
+                             f"settings.EMBEDDING_DIMENSIONS is {settings.EMBEDDING_DIMENSIONS}")
+        return embeddings.tolist()
+
+    def count_tokens(self, text: str) -> int:
+        tokenizer = load_local_tokenizer()
+        if tokenizer is None:
+            return super().count_tokens(text)
+        return len(tokenizer(text, add_special_tokens=True, truncation=False, verbose=False)['input_ids'])
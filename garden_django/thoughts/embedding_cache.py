@@ -0,0 +1,56 @@
+import hashlib
+import logging
+import os
+import unicodedata
+
+from django.db.models import F
+from django.utils import timezone
+
+from .models import EmbeddingCache
+
+logger = logging.getLogger(__name__)
+
+# Least recently hit entries beyond this count are evicted
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', 1000000))
+
+
+def normalize_text(text: str) -> str:
+    """Collapse the differences that don't change meaning: unicode form and whitespace."""
+    return ' '.join(unicodedata.normalize('NFC', str(text)).split())
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+def get_cached_embeddings(model: str, hashes: list) -> dict:
+    """Return {text_hash: embedding} for the hashes already cached, recording the hits."""
+    cached = dict(
+        EmbeddingCache.objects.filter(model=model, text_hash__in=set(hashes)).values_list('text_hash', 'embedding')
+    )
+    if cached:
+        EmbeddingCache.objects.filter(model=model, text_hash__in=cached.keys()).update(
+            hits=F('hits') + 1, last_hit_at=timezone.now()
+        )
+    return {key: [float(value) for value in embedding] for key, embedding in cached.items()}
+
+
+def cache_embeddings(model: str, embeddings: dict):
+    """Store freshly computed {text_hash: embedding} pairs. The cache is kept to size by a scheduled
+    prune_embedding_cache, so inserts never count the table."""
+    EmbeddingCache.objects.bulk_create(
+        [EmbeddingCache(model=model, text_hash=key, embedding=embedding) for key, embedding in embeddings.items()],
+        ignore_conflicts=True,  # Another worker may have embedded the same text meanwhile
+    )
+
+
+def prune_embedding_cache(max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES) -> int:
+    """Evict the least recently hit entries above max_entries, returns the number of evicted rows.
+    Runs every hour as a django-q schedule (see migration 0027)."""
+    excess = EmbeddingCache.objects.count() - max_entries
+    if excess <= 0:
+        return 0
+    oldest = EmbeddingCache.objects.order_by('last_hit_at').values('id')[:excess]
+    deleted, _ = EmbeddingCache.objects.filter(id__in=oldest).delete()
+    logger.info("Evicted %s embedding cache entries", deleted)
+    return deleted
@@ -1,7 +1,10 @@
 import fitz  # PyMuPDF
-from django_q.tasks import async_task
 
-from .main_logic import create_seed_from
+from .main_logic import create_seed_from, tag_seed
+from .ingestion import start_ingestion_job, queue_chunks
+from .chunking import fit_chunks, iter_token_chunks
+from .models import IngestionJob
+from .sources import source_key_for_file, source_key_for_url
 
 from docx import Document
 from pytube import YouTube, extract
@@ -9,78 +12,257 @@ from youtube_transcript_api import YouTubeTranscriptApi
 from youtube_transcript_api.formatters import TextFormatter
 
 import requests
+from django.core.cache import cache
 from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
+from django.core.files.base import File
 import re
 
+from django.conf import settings
 from django.utils.text import slugify
 import datetime
+import io
+import itertools
 import uuid
 import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 logger = logging.getLogger(__name__)
 
 
 
-def split_text_into_chunks(text, max_chunk_size=600):
-    """Splits text into chunks not exceeding max_chunk_size, first by paragraphs, then by sentences, and finally by new lines if needed."""
-    chunks = []
-    current_chunk = ""
+def iter_chunks(pages, max_chunk_size=600, backend=None):
+    """Incrementally splits (page_number, text) pairs into chunks of whole sentences not exceeding max_chunk_size
+    characters nor the token limits of the backend's model (see thoughts.chunking.iter_token_chunks).
+    Yields dicts with the chunk 'text', the 'page' it starts on and its 'char_start' and 'char_end' offsets."""
+    segments = ((text, {'page': page_number}) for page_number, text in pages)
+    return iter_token_chunks(segments, backend, max_chars=max_chunk_size)
 
-    # Split text by paragraphs first
-    paragraphs = text.split('\n')
-    
-    for paragraph in paragraphs:
-        # Further split each paragraph by sentence-ending punctuation
-        sentences = re.split(r'(?<=[.?!])\s', paragraph)
-        for sentence in sentences:
-            if len(current_chunk) + len(sentence) + 1 > max_chunk_size:
-                if current_chunk:  # Ensure not to append empty strings
-                    chunks.append(current_chunk.strip())
-                current_chunk = sentence + " "
-            else:
-                current_chunk += sentence + " "
-    
-        # Add a newline at the end of each paragraph if it's not empty
-        if current_chunk and not current_chunk.endswith('\n'):
-            current_chunk += '\n'
-    
-    # Check if the last accumulated chunk needs to be added
-    if current_chunk.strip():
-        chunks.append(current_chunk.strip())
+def split_text_into_chunks(text, max_chunk_size=600, backend=None):
+    """Splits text into chunks not exceeding max_chunk_size characters (nor the backend's token limits), at sentence ends."""
+    return [chunk['text'] for chunk in iter_chunks([(None, text)], max_chunk_size, backend)]
 
-    return chunks
+def process_and_create_embeddings(text, seed_title, user, job=None, source_key=None, seed=None):
+    """Creates a seed and queues its embedding. text is either a string or an iterable of
+    (page_number, text) pairs such as iter_pdf_pages, which is consumed page by page while its
+    chunks are queued (see queue_chunks). Progress is recorded on job, a new IngestionJob if none
+    is given. source_key identifies the document (see thoughts.sources). A seed created beforehand
+    (see upload_and_process_file_view) is tagged instead of creating one."""
+    if job is None:
+        job = start_ingestion_job(user, seed_title)
 
-def process_and_create_embeddings(text, seed_title, user):
-    chunks = split_text_into_chunks(text, max_chunk_size=user.max_chunk_size_setting)
+    try:
+        job.advance(IngestionJob.CHUNK)
+        pages = [(None, text)] if isinstance(text, str) else text
+        chunks = iter_chunks(pages, max_chunk_size=user.max_chunk_size_setting)
+        # The opening chunk is what the seed gets tagged from, the rest are split as they are queued
+        first_chunk = next(chunks, None)
+        first_page_text = first_chunk['text'] if first_chunk else ""
+
+        job.advance(IngestionJob.TAG)
+        if seed is None:
+            seed = create_seed_from(seed_title, first_page_text, user, source_key=source_key)
+        else:
+            tag_seed(seed, first_page_text, user)
 
-    if chunks:
-        first_page_text = chunks[0]
-    else:
-        first_page_text = ""
-        
-    seed = create_seed_from(seed_title, first_page_text, user)
+        if seed:
+            # Queue a single Django Q task that embeds and stores every chunk of the seed
+            queue_chunks(job, seed, itertools.chain([first_chunk], chunks) if first_chunk else [])
+    except Exception as e:
+        job.fail(e)
+        raise
 
-    if seed:
-        for chunk in chunks:
-            # Queue a Django Q task for each chunk
-            async_task('thoughts.main_logic.create_snippet_from', chunk, seed, user, group=str(seed.pk))
+    if not seed:
+        job.fail("Seed could not be created.")
 
     return seed
 
 #PDF
+def _extract_pdf_page_range(path, start, stop):
+    """Process pool worker: text of pages [start, stop) of the PDF at path."""
+    with fitz.open(path) as doc:
+        return [doc[number].get_text() for number in range(start, stop)]
+
+def _iter_pdf_pages_parallel(path, page_count):
+    """Fans page ranges out to a process pool, yielding pages in order while keeping only a few ranges in flight."""
+    ranges = [(start, min(start + settings.PDF_PAGES_PER_TASK, page_count))
+              for start in range(0, page_count, settings.PDF_PAGES_PER_TASK)]
+    with ProcessPoolExecutor(max_workers=settings.PDF_WORKERS) as executor:
+        in_flight = deque()
+        for start, stop in ranges:
+            in_flight.append((start, executor.submit(_extract_pdf_page_range, path, start, stop)))
+            if len(in_flight) > settings.PDF_WORKERS * 2:
+                yield from _pages_of(*in_flight.popleft())
+        while in_flight:
+            yield from _pages_of(*in_flight.popleft())
+
+def _pages_of(start, future):
+    for offset, text in enumerate(future.result()):
+        yield start + offset + 1, text
+
+def iter_pdf_pages(pdf_file, parallel=True):
+    """Yields (page_number, text) for each page of a PDF, page numbers starting at 1.
+
+    Files already on disk (paths, large uploads) are read by PyMuPDF directly instead of being loaded
+    into memory, and big ones are split across a process pool unless parallel is False.
+    """
+    if isinstance(pdf_file, str):
+        path = pdf_file
+    elif hasattr(pdf_file, 'temporary_file_path'):
+        path = pdf_file.temporary_file_path()
+    else:
+        path = None
+
+    doc = fitz.open(path) if path else fitz.open(stream=pdf_file.read(), filetype="pdf")
+    page_count = doc.page_count
+    # Daemonic processes are not allowed to start a pool (django-q workers aren't, see Q_CLUSTER)
+    if (parallel and path and page_count >= settings.PDF_PARALLEL_MIN_PAGES and settings.PDF_WORKERS > 1
+            and not multiprocessing.current_process().daemon):
+        doc.close()
+        yield from _iter_pdf_pages_parallel(path, page_count)
+        return
+
+    with doc:
+        for page_number, page in enumerate(doc, start=1):
+            yield page_number, page.get_text()
+
 def extract_text_from_pdf(pdf_file):
     """Extracts text from a PDF file."""
-    text = ""
     try:
-        doc = fitz.open("pdf", pdf_file.read())  # Open the file from memory
-        for page in doc:
-            text += page.get_text()
-    except Exception as e:
-        print(f"Failed to extract text from PDF: {e}")
+        text = "".join(page_text for _, page_text in iter_pdf_pages(pdf_file))
+    except Exception:
+        logger.exception("Failed to extract text from PDF")
         text = None
     return text
 
+#UPLOADS
+def save_upload(uploaded_file, user) -> str:
+    """Store an uploaded document in default storage for the task that ingests it; returns its name there."""
+    safe_filename = slugify(uploaded_file.name.rsplit('.', 1)[0])[:50]
+    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    extension = uploaded_file.name.rsplit('.', 1)[-1] if '.' in uploaded_file.name else ''
+    return default_storage.save(
+        f"{user.username}/{safe_filename}_{timestamp}_{uuid.uuid4().hex[:8]}.{extension}", uploaded_file
+    )
+
+@contextmanager
+def local_copy(name):
+    """Path of a file in default storage on this machine: the file itself on local storage,
+    a temporary download of it on remote storage (S3)."""
+    try:
+        path = default_storage.path(name)
+    except NotImplementedError:
+        path = None
+    if path:
+        yield path
+        return
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(name)[1]) as temp:
+        with default_storage.open(name, 'rb') as stored:
+            shutil.copyfileobj(stored, temp)
+        temp.flush()
+        yield temp.name
+
+def ingest_uploaded_file(job_id, name, keep_file=False):
+    """django-q task: extract, split and queue the embedding of an uploaded PDF or DOCX stored as name
+    (see save_upload), so the web request only stores the file. The job's seed, created by the request
+    with the upload's title and source key, is tagged here. Big PDFs are extracted by a process pool
+    here. The file becomes the seed's reserve_file when keep_file, and is deleted otherwise."""
+    job = IngestionJob.objects.select_related('user', 'seed__garden').get(pk=job_id)
+    seed = None
+    try:
+        job.advance(IngestionJob.EXTRACT)
+        with local_copy(name) as path:
+            text = iter_pdf_pages(path) if name.endswith('.pdf') else extract_text_from_docx(path)
+            seed = process_and_create_embeddings(text, job.seed.title, job.user, job=job, seed=job.seed)
+    except Exception as e:
+        job.fail(e)
+        raise
+    finally:
+        if not (keep_file and seed):
+            default_storage.delete(name)
+    if keep_file and seed:
+        seed.reserve_file = name
+        seed.save()
+    return seed.pk if seed else None
+
+#LIBRARY IMPORT
+LIBRARY_EXTENSIONS = {'.pdf': 'pdf', '.docx': 'docx', '.txt': 'text', '.md': 'text'}
+
+def _document_source(item):
+    """Path of the document on disk, or a file object over its bytes when it sits in a ZIP archive."""
+    if item.get('archive'):
+        with zipfile.ZipFile(item['archive']) as archive:
+            return io.BytesIO(archive.read(item['path']))
+    return item['path']
+
+def document_source_key(item):
+    """Canonical key of a library item (see thoughts.sources), or None for inline text and unreadable files,
+    which extract_document then reports."""
+    try:
+        if item['kind'] == 'youtube':
+            return source_key_for_url(item['url'])
+        if 'path' in item and 'text' not in item:
+            return source_key_for_file(_document_source(item))
+    except OSError as e:
+        logger.warning(f"Can't read {item['path']}: {e}")
+    return None
+
+def extract_document(item, max_chunk_size=600, backend=None):
+    """Process pool worker of manage.py import_library: extracts and chunks one document.
+
+    item has the 'kind' of document ('pdf', 'docx', 'text' or 'youtube') and either a 'path' (inside
+    the ZIP 'archive' if given), a YouTube 'url' or the 'text' itself, plus optional seed fields such as
+    'title' or 'author'. Returns the item with its 'chunks', as iter_chunks yields them for the backend's
+    model, or an 'error'.
+    """
+    try:
+        kind = item['kind']
+        if kind == 'youtube':
+            captions = extract_text_from_youtube(item['url'])
+            if isinstance(captions, str):
+                raise ValueError(captions)
+            chunks = list(fit_chunks(captions[0], backend))
+            item = {'is_youtube': True, 'content_url': item['url'], **_youtube_metadata(item['url']), **item}
+        else:
+            if kind == 'pdf':
+                # Documents are spread across processes already
+                pages = iter_pdf_pages(_document_source(item), parallel=False)
+            elif kind == 'docx':
+                pages = [(None, extract_text_from_docx(_document_source(item)))]
+            elif 'text' in item:
+                pages = [(None, item['text'])]
+            else:
+                source = _document_source(item)
+                data = source.read() if hasattr(source, 'read') else open(source, 'rb').read()
+                pages = [(None, data.decode('utf-8', errors='replace'))]
+            chunks = list(iter_chunks(pages, max_chunk_size=max_chunk_size, backend=backend))
+        title = item.get('title') or os.path.splitext(os.path.basename(item.get('path') or ''))[0]
+        return {**item, 'title': (title or 'Untitled')[:255], 'chunks': chunks}
+    except Exception as e:
+        return {**item, 'error': f"{type(e).__name__}: {e}"}
+
+def _youtube_metadata(url):
+    try:
+        yt = YouTube(url)
+        return {
+            'title': yt.title,
+            'author': yt.author,
+            'description': yt.description,
+            'tags': ", ".join(yt.keywords),
+            'year': yt.publish_date.year if yt.publish_date else None,
+        }
+    except Exception as e:
+        # pytube breaks whenever YouTube changes its pages; the captions are what matters
+        logger.warning(f"No metadata for {url}: {e}")
+        return {}
+
 #DOCX
 def extract_text_from_docx(docx_path):
     """Extracts text from a DOCX file."""
@@ -189,6 +371,86 @@ def extract_text_from_youtube(youtube_url, video_id=None):
         return f"An error occurred: {str(e)}"
     
 
+@contextmanager
+def video_download_slot():
+    """Limits simultaneous video downloads across all workers to settings.VIDEO_DOWNLOAD_CONCURRENCY."""
+    if not settings.VIDEO_DOWNLOAD_CONCURRENCY:
+        yield
+        return
+
+    # Slots expire with the task timeout, so a killed worker can't hold one forever
+    slot_timeout = settings.Q_CLUSTER['timeout']
+    deadline = time.monotonic() + settings.VIDEO_DOWNLOAD_SLOT_WAIT
+    while True:
+        for slot in range(settings.VIDEO_DOWNLOAD_CONCURRENCY):
+            key = f"video-download-slot:{slot}"
+            try:
+                acquired = cache.add(key, os.getpid(), timeout=slot_timeout)
+            except Exception as e:
+                logger.warning(f"Video download slots unavailable, downloading without a limit: {e}")
+                yield
+                return
+            if acquired:
+                try:
+                    yield
+                finally:
+                    cache.delete(key)
+                return
+        if time.monotonic() > deadline:
+            raise IOError("No free video download slot.")
+        time.sleep(5)
+
+def download_to_file(url, destination):
+    """Streams url into the binary file destination in bounded chunks.
+
+    Whatever destination already holds is kept and the download continues from there with a Range request,
+    both after a dropped connection and when a previous attempt of the task left a partial file behind.
+    """
+    max_rate = settings.VIDEO_DOWNLOAD_MAX_BYTES_PER_SEC
+    for attempt in range(1, settings.VIDEO_DOWNLOAD_RETRIES + 1):
+        destination.seek(0, os.SEEK_END)
+        downloaded = destination.tell()
+        headers = {'Range': f'bytes={downloaded}-'} if downloaded else {}
+        try:
+            with requests.get(url, stream=True, headers=headers, timeout=30) as response:
+                if response.status_code == 416:
+                    # Nothing left past what we already have
+                    return downloaded
+                if response.status_code not in (200, 206):
+                    raise IOError(f"Failed to download video: HTTP {response.status_code}")
+                if response.status_code == 200 and downloaded:
+                    # The server ignored the Range header, start over
+                    destination.seek(0)
+                    destination.truncate()
+                    downloaded = 0
+
+                # Resumed downloads report the full size as Content-Range: bytes start-end/total
+                content_range = response.headers.get('Content-Range')
+                if content_range:
+                    total = content_range.rsplit('/', 1)[-1]
+                else:
+                    total = response.headers.get('Content-Length')
+                total = int(total) if total and total.isdigit() else None
+
+                started, received = time.monotonic(), 0
+                for chunk in response.iter_content(chunk_size=settings.VIDEO_DOWNLOAD_CHUNK_SIZE):
+                    destination.write(chunk)
+                    received += len(chunk)
+                    if max_rate:
+                        # Sleep off whatever we got ahead of the allowed rate
+                        ahead = received / max_rate - (time.monotonic() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+                downloaded += received
+
+            if total is None or downloaded >= total:
+                return downloaded
+            logger.warning(f"Video download ended early at {downloaded}/{total} bytes, resuming")
+        except requests.RequestException as e:
+            logger.warning(f"Video download interrupted at {destination.tell()} bytes (attempt {attempt}): {e}")
+            time.sleep(min(2 ** attempt, 30))
+    raise IOError("Failed to download video")
+
 def download_and_save_video_to_seed(youtube_url, seed):
     """Downloads a YouTube video and updates the corresponding Seed model instance."""
     try:
@@ -202,13 +464,6 @@ def download_and_save_video_to_seed(youtube_url, seed):
         if not video_stream:
             raise ValueError("No suitable video stream found.")
         
-        # Use requests to fetch the video content
-        response = requests.get(video_stream.url, stream=True)
-        
-        if response.status_code != 200:
-            raise IOError("Failed to download video")
-    
-        
         # Save the video file to Django's default storage
         username = seed.garden.owner.username
 
@@ -218,20 +473,28 @@ def download_and_save_video_to_seed(youtube_url, seed):
         unique_suffix = uuid.uuid4().hex[:8]  # Ensures uniqueness
         filename = f"{username}/youtube/{safe_title}_{timestamp}_{unique_suffix}.mp4"
 
-        try:
-            video_content = ContentFile(response.content)
-            file_path = default_storage.save(filename, video_content)
-            
-            # Update the Seed model instance
-            seed.reserve_file = file_path  
-            seed.save()
-        except Exception as e:
-            # Log the error or handle it appropriately
-            logger.error(f"Failed to save video for seed {seed.id}: {str(e)}")
-            # Optionally, re-raise the error or handle it as per your application's requirements
-            raise        # Save the video file to Django's default storage
-
-        
+        # The partial download is named after the seed, so a retried task picks up where the last one stopped
+        partial_path = os.path.join(settings.VIDEO_DOWNLOAD_DIR, f"seed_{seed.pk}.mp4.part")
+        os.makedirs(settings.VIDEO_DOWNLOAD_DIR, exist_ok=True)
+
+        with video_download_slot(), open(partial_path, 'ab+') as partial_file:
+            download_to_file(video_stream.url, partial_file)
+
+            try:
+                # Storage reads the file in chunks; on S3 this becomes a multipart upload
+                partial_file.seek(0)
+                file_path = default_storage.save(filename, File(partial_file))
+                
+                # Update the Seed model instance
+                seed.reserve_file = file_path  
+                seed.save()
+            except Exception as e:
+                # Log the error or handle it appropriately
+                logger.error(f"Failed to save video for seed {seed.id}: {str(e)}")
+                # Optionally, re-raise the error or handle it as per your application's requirements
+                raise
+
+        os.remove(partial_path)
         return "Video downloaded and saved successfully."
     except Exception as e:
         return f"Error processing YouTube URL: {str(e)}"
\ No newline at end of file
@@ -1,9 +1,21 @@
 from django import forms
+from django.conf import settings
 from .models import Seed
 
 
 class SearchForm(forms.Form):
     search_text = forms.CharField(label="Search", max_length=1000)
+    mode = forms.ChoiceField(
+        label="Mode",
+        required=False,
+        initial=settings.SEARCH_MODE,
+        choices=[
+            ('hybrid', 'Meaning and words'), ('vector', 'Meaning'), ('coarse', 'Meaning, closest documents first'),
+            ('lexical', 'Exact words'), ('seeds', 'Whole documents'),
+        ],
+    )
+    # Optional per-query recall knob for the vector index (hnsw.ef_search)
+    ef_search = forms.IntegerField(label="Recall", required=False, min_value=1, max_value=1000)
 
 class SeedForm(forms.Form):
     title = forms.CharField(
@@ -0,0 +1,204 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, JSONField, Value
+from django.db.models.expressions import CombinedExpression
+from django.utils import timezone
+from django_q.tasks import async_task
+
+from .LLM import get_embeddings, EMBEDDING_BATCH_SIZE
+from .bulk_writer import copy_snippets
+from .chunking import fit_chunks
+from .models import IngestionJob, Seed, Snippet
+
+logger = logging.getLogger(__name__)
+
+# Postgres advisory lock key held by the running sweep_unembedded_snippets
+SWEEPER_LOCK = 7_202_025
+# Chunks of a document being split that are held in memory before they are appended to its job
+CHUNKS_PER_WRITE = EMBEDDING_BATCH_SIZE
+
+
+def start_ingestion_job(user, source: str = '') -> IngestionJob:
+    """Record that a source is being ingested, before anything is fetched."""
+    return IngestionJob.objects.create(user=user, source=str(source)[:1024])
+
+
+def queue_chunks(job: IngestionJob, seed, chunks):
+    """Attach the seed and its chunks to the job and queue their embedding.
+
+    Chunks are plain strings or dicts with 'text' and optional 'start_time' or 'page', in any iterable:
+    a generator over a document still being extracted is consumed as it goes, and its chunks are
+    appended to the job CHUNKS_PER_WRITE at a time, so the document is never held whole in memory.
+    Those too long for the model of the seed's garden are split, the rest are numbered in order
+    after the seed's existing snippets.
+    """
+    job.seed = seed
+    job.chunks, job.total_chunks = [], 0
+    job.stage = IngestionJob.CHUNK
+    job.save()
+    first = seed.next_ordinal()
+    chunks = (chunk if isinstance(chunk, dict) else {'text': chunk} for chunk in chunks)
+    batch = []
+    try:
+        for chunk in fit_chunks(chunks, seed.garden.backend_name):
+            batch.append(dict(chunk, ordinal=first + job.total_chunks + len(batch)))
+            if len(batch) == CHUNKS_PER_WRITE:
+                _append_chunks(job, batch)
+                batch = []
+        if batch:
+            _append_chunks(job, batch)
+    except Exception:
+        # Half a document must not pass for a failed job to resume (see sources.settle_unfinished_source)
+        IngestionJob.objects.filter(pk=job.pk).update(chunks=[], total_chunks=0)
+        job.total_chunks = 0
+        raise
+    job.advance(IngestionJob.EMBED)
+    async_task('thoughts.ingestion.run_ingestion_job', job.pk, group=str(seed.pk))
+
+
+def _append_chunks(job: IngestionJob, batch: list):
+    # jsonb || appends to the stored list in place, without reading it back
+    IngestionJob.objects.filter(pk=job.pk).update(
+        chunks=CombinedExpression(F('chunks'), '||', Value(batch, output_field=JSONField())),
+        total_chunks=F('total_chunks') + len(batch),
+    )
+    job.total_chunks += len(batch)
+
+
+def run_ingestion_job(job_id: int):
+    """Embed and store the job's chunks batch by batch, starting after the last stored batch.
+
+    Every batch is stored together with the job's checkpoint, so a crashed or timed out run that is
+    started again never stores a chunk twice, and only re-embeds the batch it was working on
+    (which the embedding cache usually still has).
+    """
+    job = IngestionJob.objects.select_related('seed__garden', 'user').get(pk=job_id)
+    if job.status == IngestionJob.DONE:
+        return job.stored_chunks
+
+    try:
+        if job.status == IngestionJob.FAILED:
+            job.status = IngestionJob.RUNNING
+            job.error = ''
+            job.save(update_fields=['status', 'error', 'updated_at'])
+
+        while job.stored_chunks < job.total_chunks:
+            start = job.stored_chunks
+            batch = job.chunks[start:start + EMBEDDING_BATCH_SIZE]
+            job.advance(IngestionJob.EMBED)
+            embeddings = get_embeddings([chunk['text'] for chunk in batch], job.user, backend=job.seed.garden.backend_name)
+
+            job.advance(IngestionJob.STORE)
+            with transaction.atomic():
+                checkpoint = IngestionJob.objects.select_for_update().get(pk=job.pk)
+                if checkpoint.stored_chunks != start:
+                    # Another worker (e.g. a retry of this task) stored this batch meanwhile
+                    job.stored_chunks = checkpoint.stored_chunks
+                    continue
+                copy_snippets([
+                    Snippet(content=chunk['text'], seed=job.seed, garden_id=job.seed.garden_id,
+                            ordinal=chunk.get('ordinal', start + i), start_time=chunk.get('start_time'),
+                            page=chunk.get('page'), **Snippet.embedding_fields(embedding))
+                    for i, (chunk, embedding) in enumerate(zip(batch, embeddings))
+                ])
+                job.seed.add_to_centroid(embeddings)
+                job.stored_chunks = start + len(batch)
+                job.save(update_fields=['stored_chunks', 'updated_at'])
+
+        # The chunks are snippets now, no need to keep a second copy
+        job.chunks = []
+        job.stage = IngestionJob.DONE
+        job.status = IngestionJob.DONE
+        job.save(update_fields=['chunks', 'stage', 'status', 'updated_at'])
+        return job.stored_chunks
+    except Exception as e:
+        logger.error(f"Ingestion job {job.pk} failed at {job.stored_chunks}/{job.total_chunks} chunks: {e}")
+        job.fail(e)
+        raise
+
+
+def resume_stalled_jobs(stalled_after: timedelta = None) -> list:
+    """Queue again the jobs whose embedding failed or stopped making progress (e.g. a killed worker)."""
+    if stalled_after is None:
+        stalled_after = timedelta(seconds=settings.Q_CLUSTER['retry'])
+    jobs = IngestionJob.objects.filter(
+        stage__in=[IngestionJob.EMBED, IngestionJob.STORE],
+        updated_at__lt=timezone.now() - stalled_after,
+    ).exclude(status=IngestionJob.DONE)
+    resumed = []
+    for job in jobs:
+        async_task('thoughts.ingestion.run_ingestion_job', job.pk, group=str(job.seed_id))
+        resumed.append(job.pk)
+    return resumed
+
+
+def sweep_unembedded_snippets(limit: int = None) -> int:
+    """Embed up to `limit` snippets stored without an embedding: pending ones, and failed ones with attempts
+    left (settings.SNIPPET_EMBEDDING_MAX_ATTEMPTS), found on the partial index of unembedded snippets.
+    Returns how many snippets were tried.
+
+    The snippets are claimed in one short transaction, which counts the attempt and marks them failed until
+    their embeddings are written in another, so no transaction stays open while the API is called (and a
+    crash leaves them for the next sweep). One sweeper runs at a time, the others return at once.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", [SWEEPER_LOCK])
+        if not cursor.fetchone()[0]:
+            return 0
+    try:
+        with transaction.atomic():
+            ids = list(
+                Snippet.objects.filter(
+                    embedding_status__in=[Snippet.PENDING, Snippet.FAILED],
+                    embedding_attempts__lt=settings.SNIPPET_EMBEDDING_MAX_ATTEMPTS,
+                ).order_by('id').values_list('id', flat=True)[:limit or EMBEDDING_BATCH_SIZE]
+            )
+            Snippet.objects.filter(id__in=ids).update(
+                embedding_status=Snippet.FAILED, embedding_attempts=F('embedding_attempts') + 1
+            )
+        snippets = list(
+            Snippet.objects.filter(id__in=ids).select_related('garden__owner').defer('embedding', 'search_vector')
+        )
+
+        by_garden = {}
+        for snippet in snippets:
+            by_garden.setdefault(snippet.garden_id, []).append(snippet)
+        results, embedded = [], 0
+        for group in by_garden.values():
+            garden = group[0].garden
+            try:
+                embeddings = get_embeddings([snippet.content for snippet in group], garden.owner,
+                                            backend=garden.backend_name)
+            except Exception as e:
+                logger.warning(f"Embedding {len(group)} snippets of garden {garden.pk} failed: {e}")
+                continue
+            for snippet, embedding in zip(group, embeddings):
+                for field, value in Snippet.embedding_fields(embedding).items():
+                    setattr(snippet, field, value)
+                results.append(snippet)
+
+        with transaction.atomic():
+            # Leave out snippets changed meanwhile, e.g. those of a seed that moved to another backend's garden
+            claimed = set(
+                Snippet.objects.select_for_update().filter(
+                    id__in=[snippet.id for snippet in results], embedding_status=Snippet.FAILED
+                ).values_list('id', 'embedding_attempts')
+            )
+            results = [snippet for snippet in results if (snippet.id, snippet.embedding_attempts) in claimed]
+            Snippet.objects.bulk_update(results, ['embedding', 'embedding_status'])
+            by_seed = {}
+            for snippet in results:
+                if snippet.embedding is not None:
+                    by_seed.setdefault(snippet.seed_id, []).append(snippet.embedding)
+                    embedded += 1
+            for seed_id, seed_embeddings in by_seed.items():
+                Seed(pk=seed_id).add_to_centroid(seed_embeddings)
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", [SWEEPER_LOCK])
+    if snippets:
+        logger.info(f"Swept {len(snippets)} unembedded snippets, {embedded} embedded")
+    return len(snippets)
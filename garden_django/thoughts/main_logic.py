@@ -1,13 +1,16 @@
 from .models import Seed, Snippet, Garden
-from .LLM import get_embedding, get_tags
+from .LLM import get_embedding, get_embeddings, get_tags
+from .bulk_writer import copy_snippets
+from .sources import source_key_for_url
 from pytube import YouTube
 import json
 import requests
 from django.core.files.base import ContentFile
 from django.conf import settings
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 
-def create_seed_from(title: str, context: str = None, User: settings.AUTH_USER_MODEL = None):
+def tag_fields(context: str = None, User: settings.AUTH_USER_MODEL = None) -> dict:
+    """Seed fields (description, author, year...) the chat model extracts from context; blank when it can't."""
     try:
         # Replace single quotes with double quotes and attempt to load JSON
         llm_tags_str = get_tags(context, User).replace("'", "\"")
@@ -22,23 +25,36 @@ def create_seed_from(title: str, context: str = None, User: settings.AUTH_USER_M
         print(f"Unexpected error: {e}")
         llm_tags = {}  # Fallback to an empty dictionary to allow creation of a basic Seed
 
+    # Missing or malformed fields are left blank
+    return {
+        'description': llm_tags.get('Description', ""),
+        'content_url': llm_tags.get('Content URL', ""),
+        'thumbnail': llm_tags.get('Thumbnail', ""),
+        'transcript': llm_tags.get('Transcript', ""),
+        'author': llm_tags.get('Author', ""),
+        'language': llm_tags.get('Language', ""),
+        'topics': llm_tags.get('Topics', ""),
+        'tags': llm_tags.get('Tags', ""),
+        'year': int(llm_tags.get('Year', '0').strip()) if llm_tags.get('Year', '').strip().isdigit() else None,
+    }
+
+
+def tag_seed(seed: Seed, context: str = None, User: settings.AUTH_USER_MODEL = None):
+    """Fill in the tags of a seed created before its text was known, such as an upload still being extracted."""
+    fields = tag_fields(context, User)
+    for field, value in fields.items():
+        setattr(seed, field, value)
+    seed.save(update_fields=list(fields))
+
+
+def create_seed_from(title: str, context: str = None, User: settings.AUTH_USER_MODEL = None, source_key: str = None):
+    fields = tag_fields(context, User)
+
     try:
         garden = Garden.objects.filter(owner=User).first()
 
         # Create the Seed object, handling missing or malformed fields gracefully
-        seed = Seed.objects.create(
-            garden=garden,
-            title=title,
-            description=llm_tags.get('Description', ""),
-            content_url=llm_tags.get('Content URL', ""),
-            thumbnail=llm_tags.get('Thumbnail', ""),
-            transcript=llm_tags.get('Transcript', ""),
-            author=llm_tags.get('Author', ""),
-            language=llm_tags.get('Language', ""),
-            topics=llm_tags.get('Topics', ""),
-            tags=llm_tags.get('Tags', ""),
-            year=int(llm_tags.get('Year', '0').strip()) if llm_tags.get('Year', '').strip().isdigit() else None,
-        )
+        seed = Seed.objects.create(garden=garden, title=title, source_key=source_key, **fields)
         return seed
     except IntegrityError as e:
         # Handle database errors, such as uniqueness constraints being violated
@@ -75,6 +91,7 @@ def create_seed_from_youtube(url : str, video_text : str, user : settings.AUTH_U
         description=yt.description,
         is_youtube=True,
         content_url=url,
+        source_key=source_key_for_url(url),
         author=yt.author,
         transcript=video_text,
         tags=", ".join(yt.keywords),
@@ -90,6 +107,28 @@ def create_seed_from_youtube(url : str, video_text : str, user : settings.AUTH_U
 
 
 def create_snippet_from(text: str, seed: Seed, user: settings.AUTH_USER_MODEL = None, start_time: int = None):
-    embedding = get_embedding(text, user)
-    snippet = Snippet.objects.create(content=text, seed=seed, embedding=embedding, start_time=start_time)
-    return snippet
\ No newline at end of file
+    embedding = get_embedding(text, user, backend=seed.garden.backend_name)
+    snippet = Snippet.objects.create(content=text, seed=seed, start_time=start_time,
+                                     **Snippet.embedding_fields(embedding))
+    seed.add_to_centroid([embedding])
+    return snippet
+
+
+def create_snippets_from(chunks: list, seed: Seed, user: settings.AUTH_USER_MODEL = None):
+    """Embed all chunks of a seed in batches and store them with a single COPY.
+
+    Chunks are plain strings or dicts with 'text' and an optional 'start_time' or 'page',
+    like the captions returned by extract_text_from_youtube or the chunks of iter_chunks.
+    """
+    chunks = [chunk if isinstance(chunk, dict) else {'text': chunk} for chunk in chunks]
+    embeddings = get_embeddings([chunk['text'] for chunk in chunks], user, backend=seed.garden.backend_name)
+    first = seed.next_ordinal()
+    snippets = [
+        Snippet(content=chunk['text'], seed=seed, garden_id=seed.garden_id, ordinal=first + i,
+                start_time=chunk.get('start_time'), page=chunk.get('page'), **Snippet.embedding_fields(embedding))
+        for i, (chunk, embedding) in enumerate(zip(chunks, embeddings))
+    ]
+    with transaction.atomic():
+        copy_snippets(snippets)
+        seed.add_to_centroid(embeddings)
+    return len(snippets)
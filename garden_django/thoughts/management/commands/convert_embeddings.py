@@ -0,0 +1,23 @@
+# thoughts/management/commands/convert_embeddings.py
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from thoughts.vector_storage import convert_embedding_storage
+
+
+class Command(BaseCommand):
+    help = ('Convert stored embeddings to settings.EMBEDDING_DIMENSIONS and settings.VECTOR_STORAGE '
+            'and rebuild their indexes; run after changing either setting')
+
+    def handle(self, *args, **options):
+        target = f"{settings.VECTOR_STORAGE}({settings.EMBEDDING_DIMENSIONS})"
+        try:
+            with transaction.atomic():
+                converted = convert_embedding_storage(connection)
+        except ValueError as e:
+            raise CommandError(str(e))
+        if not converted:
+            self.stdout.write(f"Embeddings are already stored as {target}.")
+        for line in converted:
+            self.stdout.write(f"Converted {line}")
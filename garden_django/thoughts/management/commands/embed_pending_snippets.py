@@ -0,0 +1,24 @@
+# thoughts/management/commands/embed_pending_snippets.py
+from django.core.management.base import BaseCommand
+
+from thoughts.ingestion import sweep_unembedded_snippets
+from thoughts.models import Snippet
+
+
+class Command(BaseCommand):
+    help = ('Embed the snippets stored without an embedding (pending, or failed with attempts left), '
+            'like the scheduled sweeper does, until none is left')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='Snippets embedded per batch')
+
+    def handle(self, *args, **options):
+        tried = 0
+        # Every try counts against the snippet's attempts, so this stops even when embedding keeps failing
+        while True:
+            swept = sweep_unembedded_snippets(options['batch_size'])
+            if not swept:
+                break
+            tried += swept
+        left = Snippet.objects.exclude(embedding_status=Snippet.EMBEDDED).count()
+        self.stdout.write(f"Tried {tried} snippets, {left} left without an embedding")
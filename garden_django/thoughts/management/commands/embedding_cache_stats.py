@@ -0,0 +1,34 @@
+# thoughts/management/commands/embedding_cache_stats.py
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+
+from thoughts.embedding_cache import prune_embedding_cache, EMBEDDING_CACHE_MAX_ENTRIES
+from thoughts.models import EmbeddingCache
+
+
+class Command(BaseCommand):
+    help = 'Report embedding cache size and hit rates, optionally evicting least recently hit entries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prune', action='store_true', help='Evict entries above --max-entries first')
+        parser.add_argument('--max-entries', type=int, default=EMBEDDING_CACHE_MAX_ENTRIES)
+
+    def handle(self, *args, **options):
+        if options['prune']:
+            evicted = prune_embedding_cache(options['max_entries'])
+            self.stdout.write(f"Evicted {evicted} entries")
+
+        # Every entry was created by one miss, every later lookup of it is a hit.
+        # Counts of evicted entries are gone, so this describes the entries currently cached.
+        rows = EmbeddingCache.objects.values('model').annotate(entries=Count('id'), hits=Sum('hits')).order_by('model')
+        if not rows:
+            self.stdout.write("Embedding cache is empty")
+            return
+
+        self.stdout.write(f"{'model':<32} {'entries':>10} {'hits':>10} {'hit rate':>9}")
+        for row in rows:
+            hits = row['hits'] or 0
+            hit_rate = hits / (hits + row['entries'])
+            self.stdout.write(f"{row['model']:<32} {row['entries']:>10} {hits:>10} {hit_rate:>9.1%}")
+        never_hit = EmbeddingCache.objects.filter(hits=0).count()
+        self.stdout.write(f"Entries never hit: {never_hit}, capacity: {EMBEDDING_CACHE_MAX_ENTRIES}")
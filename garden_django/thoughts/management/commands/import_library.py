@@ -0,0 +1,178 @@
+# thoughts/management/commands/import_library.py
+import json
+import os
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from thoughts.LLM import get_embeddings
+from thoughts.bulk_writer import copy_snippets
+from thoughts.files import LIBRARY_EXTENSIONS, document_source_key, extract_document
+from thoughts.models import Garden, Seed, Snippet
+from thoughts.sources import ingest_known_source
+from thoughts.vector_storage import zero_embedding
+
+# Seed fields a JSONL manifest line may set
+SEED_FIELDS = ['title', 'description', 'author', 'language', 'topics', 'tags', 'year', 'content_url', 'is_youtube']
+
+
+def library_items(source):
+    """The documents of a directory, ZIP archive or JSONL manifest, as items for extract_document."""
+    if os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                kind = LIBRARY_EXTENSIONS.get(os.path.splitext(name)[1].lower())
+                if kind:
+                    yield {'kind': kind, 'path': os.path.join(root, name)}
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for name in archive.namelist():
+                kind = LIBRARY_EXTENSIONS.get(os.path.splitext(name)[1].lower())
+                if kind and not name.endswith('/'):
+                    yield {'kind': kind, 'path': name, 'archive': source}
+    else:
+        # One JSON object per line: {"path": ...}, {"url": <YouTube URL>} or {"text": ..., "title": ...},
+        # with any of SEED_FIELDS; relative paths are relative to the manifest
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source) as manifest:
+            for line in manifest:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                if 'url' in item:
+                    item['kind'] = 'youtube'
+                elif 'path' in item:
+                    item['path'] = os.path.join(base, item['path'])
+                    item['kind'] = LIBRARY_EXTENSIONS.get(os.path.splitext(item['path'])[1].lower(), 'text')
+                else:
+                    item['kind'] = 'text'
+                yield item
+
+
+def centroid(embeddings):
+    """Mean of the non-zero embeddings and how many there were, like Seed.add_to_centroid keeps it."""
+    vectors = [embedding for embedding in embeddings if any(embedding)]
+    if not vectors:
+        return zero_embedding(), 0
+    return [sum(values) / len(vectors) for values in zip(*vectors)], len(vectors)
+
+
+class Command(BaseCommand):
+    help = ('Import a library (a directory or ZIP of PDF/DOCX/text files, or a JSONL manifest that may also '
+            'list YouTube URLs) into a garden: text is extracted by a process pool, embedded in batches '
+            'and stored with bulk inserts and COPY. Documents already in the garden are skipped, so rerunning '
+            'an interrupted or partly failed import resumes it')
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='Directory, ZIP archive or JSONL manifest')
+        parser.add_argument('--user', required=True, help='Username owning the seeds, whose API key embeds them')
+        parser.add_argument('--garden', type=int, help="Garden id (defaults to the user's first garden)")
+        parser.add_argument('--workers', type=int, default=settings.PDF_WORKERS, help='Extraction processes')
+        parser.add_argument('--batch-documents', type=int, default=50,
+                            help='Documents embedded and stored together')
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user_model().objects.get(username=options['user'])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f"No user named {options['user']}")
+        gardens = Garden.objects.filter(owner=user)
+        garden = gardens.filter(pk=options['garden']).first() if options['garden'] else gardens.first()
+        if garden is None:
+            raise CommandError("No such garden of this user")
+
+        items = list(library_items(options['source']))
+        self.stdout.write(f"Importing {len(items)} documents into {garden} with {options['workers']} workers")
+
+        self.started, self.documents, self.snippets, self.total = time.monotonic(), 0, 0, len(items)
+        failures, batch, known, reused = [], [], set(), 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            # Extraction runs ahead of embedding by a few documents per worker, no further
+            in_flight = deque()
+            for item in items:
+                # Documents the user already has are linked or cloned, as are repeats within the library
+                item['source_key'] = document_source_key(item)
+                if item['source_key']:
+                    if item['source_key'] in known or ingest_known_source(user, item['source_key'], garden):
+                        reused += 1
+                        self.total -= 1
+                        continue
+                    known.add(item['source_key'])
+                in_flight.append(pool.submit(extract_document, item, user.max_chunk_size_setting, garden.backend_name))
+                if len(in_flight) >= options['workers'] * 4:
+                    batch = self.collect(in_flight.popleft().result(), batch, failures, user, garden, options)
+            while in_flight:
+                batch = self.collect(in_flight.popleft().result(), batch, failures, user, garden, options)
+        if batch:
+            self.store(batch, failures, user, garden)
+
+        for document in failures:
+            self.stderr.write(f"Failed: {document.get('path') or document.get('url') or document.get('title')}: "
+                              f"{document['error']}")
+        self.stdout.write(f"Done: {self.documents} documents, {self.snippets} snippets, {len(failures)} failed, "
+                          f"{reused} already in the library in {time.monotonic() - self.started:.0f}s")
+
+    def collect(self, document, batch, failures, user, garden, options):
+        if 'error' in document:
+            failures.append(document)
+            return batch
+        batch.append(document)
+        if len(batch) >= options['batch_documents']:
+            self.store(batch, failures, user, garden)
+            return []
+        return batch
+
+    def store(self, batch, failures, user, garden):
+        """Embed every chunk of the batch at once, then insert its seeds in bulk and COPY its snippets.
+
+        A batch that can't be embedded or stored is recorded in failures and the import goes on.
+        """
+        texts = [chunk['text'] for document in batch for chunk in document['chunks']]
+        try:
+            self.write_batch(batch, texts, user, garden)
+        except Exception as e:
+            for document in batch:
+                failures.append({**document, 'error': f"{type(e).__name__}: {e}"})
+            self.total -= len(batch)
+            self.stderr.write(f"A batch of {len(batch)} documents failed: {e}")
+            return
+
+        self.documents += len(batch)
+        self.snippets += len(texts)
+        rate = self.documents / (time.monotonic() - self.started)
+        eta = (self.total - self.documents) / rate if rate else 0
+        self.stdout.write(f"{self.documents}/{self.total} documents, {self.snippets} snippets, "
+                          f"{rate:.2f} docs/s, ETA {eta / 60:.1f} min")
+
+    def write_batch(self, batch, texts, user, garden):
+        embeddings = iter(get_embeddings(texts, user, backend=garden.backend_name))
+
+        seeds, snippets = [], []
+        for document in batch:
+            document_embeddings = [next(embeddings) for _ in document['chunks']]
+            seed_embedding, embedded_snippets = centroid(document_embeddings)
+            fields = {field: document[field] for field in SEED_FIELDS if document.get(field) is not None}
+            if 'description' not in fields and document['chunks']:
+                fields['description'] = document['chunks'][0]['text']
+            seeds.append(Seed(garden=garden, embedding=seed_embedding, embedded_snippets=embedded_snippets,
+                              source_key=document.get('source_key'), **fields))
+            snippets.append([
+                Snippet(content=chunk['text'], garden_id=garden.id, ordinal=ordinal, start_time=chunk.get('start_time'),
+                        page=chunk.get('page'), **Snippet.embedding_fields(embedding))
+                for ordinal, (chunk, embedding) in enumerate(zip(document['chunks'], document_embeddings))
+            ])
+
+        with transaction.atomic():
+            # Postgres returns the new primary keys, so the snippets can point at their seeds
+            Seed.objects.bulk_create(seeds, batch_size=500)
+            for seed, seed_snippets in zip(seeds, snippets):
+                for snippet in seed_snippets:
+                    snippet.seed = seed
+            copy_snippets([snippet for seed_snippets in snippets for snippet in seed_snippets])
+        garden.forget_seed_listings()
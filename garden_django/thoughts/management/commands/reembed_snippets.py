@@ -0,0 +1,118 @@
+# thoughts/management/commands/reembed_snippets.py
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from thoughts.LLM import get_embeddings, EMBEDDING_BATCH_SIZE
+from thoughts.models import EmbeddingBackfill, Garden, Seed, Snippet
+
+
+def embed_batch(snippets, gardens, user=None):
+    """Embed a batch of snippets, each with its garden's backend and its owner's API key (or user's)."""
+    try:
+        by_garden = {}
+        for snippet in snippets:
+            by_garden.setdefault(snippet.garden_id, []).append(snippet)
+        for garden_id, group in by_garden.items():
+            garden = gardens[garden_id]
+            embeddings = get_embeddings([snippet.content for snippet in group], user or garden.owner,
+                                        backend=garden.backend_name)
+            for snippet, embedding in zip(group, embeddings):
+                for field, value in Snippet.embedding_fields(embedding).items():
+                    setattr(snippet, field, value)
+        return snippets
+    finally:
+        # Runs in a pool thread, which has a database connection of its own for the embedding cache
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = ('Embed snippets again (e.g. after changing EMBEDDING_MODEL or to embed those left without one), '
+            'checkpointing every batch so that an interrupted run resumes where it stopped')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--name', default='reembed',
+                            help='Checkpoint name; running again with the same name resumes that run')
+        parser.add_argument('--restart', action='store_true', help='Forget the checkpoint and start from the first snippet')
+        parser.add_argument('--only-zero', action='store_true',
+                            help='Only snippets without an embedding (pending, failed or skipped)')
+        parser.add_argument('--garden', type=int, action='append', help='Only snippets of this garden id (repeatable)')
+        parser.add_argument('--seed', type=int, action='append', help='Only snippets of this seed id (repeatable)')
+        parser.add_argument('--user', help="Username whose API key embeds everything, instead of each garden owner's")
+        parser.add_argument('--batch-size', type=int, default=EMBEDDING_BATCH_SIZE)
+        parser.add_argument('--concurrency', type=int, default=4, help='Batches being embedded at once')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        user = None
+        if options['user']:
+            try:
+                user = get_user_model().objects.get(username=options['user'])
+            except get_user_model().DoesNotExist:
+                raise CommandError(f"No user named {options['user']}")
+
+        checkpoint, _ = EmbeddingBackfill.objects.get_or_create(name=options['name'])
+        if options['restart']:
+            checkpoint.last_snippet_id, checkpoint.processed, checkpoint.done = 0, 0, False
+            checkpoint.save()
+        elif checkpoint.done:
+            self.stdout.write(f"{checkpoint} is already done, use --restart to run it again")
+            return
+
+        snippets = Snippet.objects.filter(id__gt=checkpoint.last_snippet_id)
+        if options['only_zero']:
+            snippets = snippets.exclude(embedding_status=Snippet.EMBEDDED)
+        if options['garden']:
+            snippets = snippets.filter(garden_id__in=options['garden'])
+        if options['seed']:
+            snippets = snippets.filter(seed_id__in=options['seed'])
+        total = snippets.count()
+        self.stdout.write(f"Embedding {total} snippets after #{checkpoint.last_snippet_id}, "
+                          f"{batch_size} per batch, {options['concurrency']} batches at once")
+
+        gardens = {garden.pk: garden for garden in Garden.objects.select_related('owner')}
+        started, done, seed_ids = time.monotonic(), 0, set()
+        pending = deque()
+
+        def store(batch):
+            # Batches are stored in id order, so the checkpoint never skips an unstored snippet
+            nonlocal done
+            batch_seed_ids = {snippet.seed_id for snippet in batch}
+            with transaction.atomic():
+                Snippet.objects.bulk_update(batch, ['embedding', 'embedding_status'])
+                # Centroids are means of the old embeddings: compute those of the batch's seeds again along
+                # with the checkpoint, so that no seed is left behind when an interrupted run resumes
+                Seed.recompute_centroids(batch_seed_ids)
+                checkpoint.last_snippet_id = batch[-1].id
+                checkpoint.processed += len(batch)
+                checkpoint.save(update_fields=['last_snippet_id', 'processed', 'updated_at'])
+            seed_ids.update(batch_seed_ids)
+            done += len(batch)
+            rate = done / (time.monotonic() - started)
+            eta = (total - done) / rate if rate else 0
+            self.stdout.write(f"{done}/{total} snippets, {rate:.1f}/s, ETA {eta / 60:.1f} min (up to #{batch[-1].id})")
+
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            batch = []
+            # A server-side cursor streams the rows without holding the whole table in memory
+            rows = snippets.order_by('id').only('id', 'content', 'garden_id', 'seed_id').iterator(chunk_size=batch_size)
+            for snippet in rows:
+                batch.append(snippet)
+                if len(batch) < batch_size:
+                    continue
+                if len(pending) >= options['concurrency']:
+                    store(pending.popleft().result())
+                pending.append(pool.submit(embed_batch, batch, gardens, user))
+                batch = []
+            if batch:
+                pending.append(pool.submit(embed_batch, batch, gardens, user))
+            while pending:
+                store(pending.popleft().result())
+
+        checkpoint.done = True
+        checkpoint.save(update_fields=['done', 'updated_at'])
+        self.stdout.write(f"Done: {done} snippets of {len(seed_ids)} seeds")
@@ -0,0 +1,20 @@
+# thoughts/management/commands/resume_ingestion_jobs.py
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from thoughts.ingestion import resume_stalled_jobs
+
+
+class Command(BaseCommand):
+    help = 'Queue again ingestion jobs that failed or stopped making progress, continuing from their last stored batch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stalled-after', type=int, default=None,
+                            help='Seconds without progress before a running job counts as stalled '
+                                 '(defaults to the task queue retry delay)')
+
+    def handle(self, *args, **options):
+        stalled_after = options['stalled_after']
+        resumed = resume_stalled_jobs(timedelta(seconds=stalled_after) if stalled_after is not None else None)
+        self.stdout.write(f"Resumed {len(resumed)} ingestion jobs: {resumed}")
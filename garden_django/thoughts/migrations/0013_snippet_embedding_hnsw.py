@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+import pgvector.django
+
+VECTOR_OPCLASSES = {
+    'cosine': 'vector_cosine_ops',
+    'ip': 'vector_ip_ops',
+    'l2': 'vector_l2_ops',
+}
+
+
+class Migration(migrations.Migration):
+    # Building the HNSW index on a large table takes a while; don't lock snippet writes meanwhile.
+    atomic = False
+
+    dependencies = [
+        ('thoughts', '0012_seed_is_youtube'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='snippet',
+            index=pgvector.django.HnswIndex(
+                ef_construction=64,
+                fields=['embedding'],
+                m=16,
+                name='snippet_embedding_hnsw',
+                opclasses=[VECTOR_OPCLASSES[settings.VECTOR_DISTANCE]],
+            ),
+        ),
+    ]
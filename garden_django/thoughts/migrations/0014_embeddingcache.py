@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:58
+
+from django.db import migrations, models
+import pgvector.django
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thoughts', '0013_snippet_embedding_hnsw'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmbeddingCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=255)),
+                ('text_hash', models.CharField(max_length=64)),
+                ('embedding', pgvector.django.VectorField()),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_hit_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'unique_together': {('model', 'text_hash')},
+            },
+        ),
+    ]
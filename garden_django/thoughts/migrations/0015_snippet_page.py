@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thoughts', '0014_embeddingcache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snippet',
+            name='page',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
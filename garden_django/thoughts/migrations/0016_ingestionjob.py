@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:02
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('thoughts', '0015_snippet_page'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(blank=True, max_length=1024)),
+                ('stage', models.CharField(choices=[('fetch', 'Fetching'), ('extract', 'Extracting text'), ('chunk', 'Splitting into snippets'), ('tag', 'Tagging'), ('embed', 'Embedding'), ('store', 'Storing snippets'), ('done', 'Done')], default='fetch', max_length=20)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('failed', 'Failed'), ('done', 'Done')], default='running', max_length=20)),
+                ('error', models.TextField(blank=True)),
+                ('chunks', models.JSONField(blank=True, default=list)),
+                ('total_chunks', models.IntegerField(default=0)),
+                ('stored_chunks', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('seed', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='ingestion_jobs', to='thoughts.seed')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ingestion_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
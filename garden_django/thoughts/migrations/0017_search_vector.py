@@ -0,0 +1,54 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:04
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thoughts', '0016_ingestionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='seed',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='snippet',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(blank=True, editable=False, null=True),
+        ),
+        # Keep the vectors in sync on every write path, including bulk inserts, then fill existing rows
+        migrations.RunSQL(
+            sql=[
+                """
+                CREATE TRIGGER thoughts_seed_search_vector_update
+                BEFORE INSERT OR UPDATE OF title, author ON thoughts_seed
+                FOR EACH ROW EXECUTE FUNCTION tsvector_update_trigger(search_vector, 'pg_catalog.english', title, author);
+                """,
+                """
+                CREATE TRIGGER thoughts_snippet_search_vector_update
+                BEFORE INSERT OR UPDATE OF content ON thoughts_snippet
+                FOR EACH ROW EXECUTE FUNCTION tsvector_update_trigger(search_vector, 'pg_catalog.english', content);
+                """,
+                "UPDATE thoughts_seed SET search_vector = to_tsvector('pg_catalog.english', coalesce(title, '') || ' ' || coalesce(author, ''));",
+                "UPDATE thoughts_snippet SET search_vector = to_tsvector('pg_catalog.english', content);",
+            ],
+            reverse_sql=[
+                "DROP TRIGGER IF EXISTS thoughts_seed_search_vector_update ON thoughts_seed;",
+                "DROP TRIGGER IF EXISTS thoughts_snippet_search_vector_update ON thoughts_snippet;",
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='seed',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='seed_search_vector_gin'),
+        ),
+        migrations.AddIndex(
+            model_name='snippet',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='snippet_search_vector_gin'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.30 on 2026-10-18 21:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thoughts', '0017_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snippet',
+            name='garden',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='snippets', to='thoughts.garden'),
+        ),
+        migrations.RunSQL(
+            sql="""
+                UPDATE thoughts_snippet SET garden_id = seed.garden_id
+                FROM thoughts_seed AS seed WHERE seed.id = thoughts_snippet.seed_id;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name='snippet',
+            name='garden',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='snippets', to='thoughts.garden'),
+        ),
+        migrations.AddIndex(
+            model_name='snippet',
+            index=models.Index(fields=['garden', 'seed'], name='snippet_garden_seed_idx'),
+        ),
+    ]
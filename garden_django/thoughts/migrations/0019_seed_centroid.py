@@ -0,0 +1,49 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:11
+
+from django.conf import settings
+from django.db import migrations, models
+import pgvector.django
+
+VECTOR_OPCLASSES = {
+    'cosine': 'vector_cosine_ops',
+    'ip': 'vector_ip_ops',
+    'l2': 'vector_l2_ops',
+}
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thoughts', '0018_snippet_garden'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='seed',
+            name='embedded_snippets',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        # Start the centroids of existing seeds from the snippets they already have
+        migrations.RunSQL(
+            sql="""
+                UPDATE thoughts_seed SET embedding = centroids.embedding, embedded_snippets = centroids.count
+                FROM (
+                    SELECT seed_id, avg(embedding) AS embedding, count(*) AS count FROM thoughts_snippet
+                    WHERE vector_norm(embedding) > 0
+                    GROUP BY seed_id
+                ) AS centroids
+                WHERE centroids.seed_id = thoughts_seed.id;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='seed',
+            index=pgvector.django.HnswIndex(
+                ef_construction=64,
+                fields=['embedding'],
+                m=16,
+                name='seed_embedding_hnsw',
+                opclasses=[VECTOR_OPCLASSES[settings.VECTOR_DISTANCE]],
+            ),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thoughts', '0019_seed_centroid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snippet',
+            name='ordinal',
+            field=models.IntegerField(default=0),
+        ),
+        # Number the existing snippets of each seed in the order they were stored
+        migrations.RunSQL(
+            sql="""
+                UPDATE thoughts_snippet SET ordinal = numbered.ordinal
+                FROM (
+                    SELECT id, row_number() OVER (PARTITION BY seed_id ORDER BY id) - 1 AS ordinal FROM thoughts_snippet
+                ) AS numbered
+                WHERE numbered.id = thoughts_snippet.id;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='snippet',
+            index=models.Index(fields=['seed', 'ordinal'], name='snippet_seed_ordinal_idx'),
+        ),
+    ]
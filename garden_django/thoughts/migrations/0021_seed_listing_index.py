@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thoughts', '0020_snippet_ordinal'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='seed',
+            index=models.Index(fields=['garden', '-id'], name='seed_garden_listing_idx'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:16
+
+from django.conf import settings
+from django.db import migrations
+import pgvector.django
+import thoughts.vector_storage
+
+
+def convert_embeddings(apps, schema_editor):
+    # Size and type the embedding columns after settings.EMBEDDING_DIMENSIONS and settings.VECTOR_STORAGE
+    thoughts.vector_storage.convert_embedding_storage(schema_editor.connection)
+
+
+def restore_embeddings(apps, schema_editor):
+    thoughts.vector_storage.convert_embedding_storage(schema_editor.connection, dimensions=1536, storage='vector')
+
+
+def hnsw_index(name):
+    return pgvector.django.HnswIndex(
+        ef_construction=64,
+        fields=['embedding'],
+        m=16,
+        name=name,
+        opclasses=[thoughts.vector_storage.embedding_opclass(settings.VECTOR_DISTANCE, settings.VECTOR_STORAGE)],
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thoughts', '0021_seed_listing_index'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(convert_embeddings, restore_embeddings),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='seed',
+                    name='embedding',
+                    field=thoughts.vector_storage.EmbeddingField(default=thoughts.vector_storage.zero_embedding),
+                ),
+                migrations.AlterField(
+                    model_name='snippet',
+                    name='embedding',
+                    field=thoughts.vector_storage.EmbeddingField(default=thoughts.vector_storage.zero_embedding),
+                ),
+                # The indexes' operator class follows the storage type too
+                migrations.RemoveIndex(model_name='seed', name='seed_embedding_hnsw'),
+                migrations.AddIndex(model_name='seed', index=hnsw_index('seed_embedding_hnsw')),
+                migrations.RemoveIndex(model_name='snippet', name='snippet_embedding_hnsw'),
+                migrations.AddIndex(model_name='snippet', index=hnsw_index('snippet_embedding_hnsw')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thoughts', '0022_embedding_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='garden',
+            name='embedding_backend',
+            field=models.CharField(blank=True, choices=[('openai', 'OpenAI'), ('local', 'Local model')], max_length=20),
+        ),
+    ]
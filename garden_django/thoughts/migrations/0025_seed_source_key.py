@@ -0,0 +1,44 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thoughts', '0024_embeddingbackfill'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='seed',
+            name='source_key',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        # Key the existing YouTube seeds by video id; where a garden has the same video twice, the oldest seed gets it
+        migrations.RunSQL(
+            sql=r"""
+                UPDATE thoughts_seed SET source_key = keyed.source_key
+                FROM (
+                    SELECT id, source_key, row_number() OVER (PARTITION BY garden_id, source_key ORDER BY id) AS copy
+                    FROM (
+                        SELECT id, garden_id, 'youtube:' || substring(
+                            content_url FROM '(?i)(?:youtube\.com/(?:watch\?(?:\S*&)?v=|shorts/|live/|embed/)|youtu\.be/)([\w-]{11})'
+                        ) AS source_key
+                        FROM thoughts_seed WHERE is_youtube
+                    ) AS found
+                    WHERE source_key IS NOT NULL
+                ) AS keyed
+                WHERE keyed.id = thoughts_seed.id AND keyed.copy = 1;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='seed',
+            index=models.Index(fields=['source_key'], name='seed_source_key_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='seed',
+            constraint=models.UniqueConstraint(fields=('garden', 'source_key'), name='seed_garden_source_key_uniq'),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 4.2.30 on 2026-10-18 21:05
+
+from django.conf import settings
+from django.db import migrations, models
+import pgvector.django
+import thoughts.vector_storage
+
+SWEEPER = 'thoughts.ingestion.sweep_unembedded_snippets'
+
+
+def schedule_sweeper(apps, schema_editor):
+    Schedule = apps.get_model('django_q', 'Schedule')
+    Schedule.objects.get_or_create(
+        func=SWEEPER,
+        defaults={'name': 'Embed unembedded snippets', 'schedule_type': 'I', 'minutes': 10, 'repeats': -1},
+    )
+
+
+def unschedule_sweeper(apps, schema_editor):
+    apps.get_model('django_q', 'Schedule').objects.filter(func=SWEEPER).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_q', '0019_alter_task_options_alter_ormq_key_alter_ormq_lock_and_more'),
+        ('thoughts', '0025_seed_source_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snippet',
+            name='embedding_status',
+            field=models.CharField(choices=[('pending', 'Waiting to be embedded'), ('embedded', 'Embedded'), ('skipped', 'Not embeddable'), ('failed', 'Embedding failed')], default='pending', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='snippet',
+            name='embedding_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='snippet',
+            name='embedding',
+            field=thoughts.vector_storage.EmbeddingField(blank=True, null=True),
+        ),
+        # Drop the full index first, or the UPDATE below inserts every rewritten row into it
+        migrations.RemoveIndex(model_name='snippet', name='snippet_embedding_hnsw'),
+        # Zero vectors stood for snippets that weren't embedded; those too short to embed are skipped for good
+        migrations.RunSQL(
+            sql=r"""
+                UPDATE thoughts_snippet SET embedding_status = 'embedded'
+                WHERE embedding::text !~ '^\[0(,0)*\]$';
+                UPDATE thoughts_snippet
+                SET embedding = NULL, embedding_status = CASE WHEN length(content) < 5 THEN 'skipped' ELSE 'pending' END
+                WHERE embedding_status <> 'embedded';
+            """,
+            reverse_sql=[(
+                "UPDATE thoughts_snippet SET embedding = %s WHERE embedding IS NULL",
+                ['[' + ','.join('0' for _ in thoughts.vector_storage.zero_embedding()) + ']'],
+            )],
+        ),
+        migrations.AddIndex(
+            model_name='snippet',
+            index=pgvector.django.HnswIndex(
+                condition=models.Q(embedding_status='embedded'),
+                ef_construction=64,
+                fields=['embedding'],
+                m=16,
+                name='snippet_embedding_hnsw',
+                opclasses=[thoughts.vector_storage.embedding_opclass(settings.VECTOR_DISTANCE, settings.VECTOR_STORAGE)],
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='snippet',
+            index=models.Index(condition=models.Q(embedding_status__in=['pending', 'failed']), fields=['id'], name='snippet_unembedded_idx'),
+        ),
+        migrations.RunPython(schedule_sweeper, unschedule_sweeper),
+    ]
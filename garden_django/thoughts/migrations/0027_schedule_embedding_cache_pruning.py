@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-18 22:40
+
+from django.db import migrations
+
+PRUNER = 'thoughts.embedding_cache.prune_embedding_cache'
+
+
+def schedule_pruning(apps, schema_editor):
+    Schedule = apps.get_model('django_q', 'Schedule')
+    Schedule.objects.get_or_create(
+        func=PRUNER,
+        defaults={'name': 'Prune the embedding cache', 'schedule_type': 'H', 'repeats': -1},
+    )
+
+
+def unschedule_pruning(apps, schema_editor):
+    apps.get_model('django_q', 'Schedule').objects.filter(func=PRUNER).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_q', '0019_alter_task_options_alter_ormq_key_alter_ormq_lock_and_more'),
+        ('thoughts', '0026_snippet_embedding_status'),
+    ]
+
+    operations = [
+        migrations.RunPython(schedule_pruning, unschedule_pruning),
+    ]
@@ -1,16 +1,54 @@
-from django.db import models
-from pgvector.django import VectorField 
+from django.db import connection, models, transaction
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from pgvector.django import VectorField, HnswIndex
 from django.conf import settings
+from django.core.cache import cache
+import logging
+
+from .embedding_backends import BACKEND_CHOICES
+from .vector_storage import EmbeddingField, embedding_opclass, zero_embedding
+
+logger = logging.getLogger(__name__)
+
+
+# Cache key of the first page of a user's seed listing (see db_walker.list_seeds_page)
+SEED_LISTING_CACHE_KEY = "seed-listing:{user_id}"
 
 
 class Garden(models.Model):
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='owned_gardens')
     name = models.CharField(max_length=255)
     visitors = models.ManyToManyField(settings.AUTH_USER_MODEL, through='GardenMembership', related_name='visited_gardens')
+    # Backend embedding this garden's snippets (and the queries searching them); blank means settings.EMBEDDING_BACKEND
+    embedding_backend = models.CharField(max_length=20, choices=BACKEND_CHOICES, blank=True)
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        if self._state.adding and not self.embedding_backend:
+            # New gardens follow their owner's preference; existing snippets pin the backend afterwards
+            self.embedding_backend = getattr(self.owner, 'embedding_backend', '')
+        super().save(*args, **kwargs)
+
+    @property
+    def backend_name(self) -> str:
+        return self.embedding_backend or settings.EMBEDDING_BACKEND
+
+    def forget_seed_listings(self):
+        """Drop the cached seed listings of everyone who can see this garden, once the transaction commits."""
+        user_ids = {self.owner_id, *self.gardenmembership_set.values_list('user_id', flat=True)}
+        keys = [SEED_LISTING_CACHE_KEY.format(user_id=user_id) for user_id in user_ids]
+
+        def forget():
+            try:
+                cache.delete_many(keys)
+            except Exception as e:
+                logger.warning(f"Seed listing cache unavailable: {e}")
+
+        transaction.on_commit(forget)
+
 class GardenMembership(models.Model):
     garden = models.ForeignKey(Garden, on_delete=models.CASCADE)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -22,6 +60,14 @@ class GardenMembership(models.Model):
     def __str__(self):
         return f"{self.user}'s role in {self.garden.name}"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.garden.forget_seed_listings()
+
+    def delete(self, *args, **kwargs):
+        self.garden.forget_seed_listings()
+        return super().delete(*args, **kwargs)
+
 class Seed(models.Model):
     garden = models.ForeignKey(Garden, on_delete=models.CASCADE, related_name='seeds')
     title = models.CharField(max_length=255)
@@ -33,9 +79,13 @@ class Seed(models.Model):
     reserve_file = models.FileField(upload_to='reserves/', blank=True, null=True)
     thumbnail = models.ImageField(upload_to='thumbnails/', blank=True, null=True)
     transcript = models.TextField(blank=True, null=True)
+    # Canonical identity of the source (see thoughts.sources), so that it is ingested once per garden
+    source_key = models.CharField(max_length=255, blank=True, null=True)
     
     # Embedding and search
-    embedding =  VectorField(dimensions=1536, default = [0]*1536) 
+    # Centroid of the seed's snippet embeddings, kept up to date by add_to_centroid as snippets are stored
+    embedding = EmbeddingField(default=zero_embedding)
+    embedded_snippets = models.IntegerField(default=0, editable=False)
     
     # Metadata
     author = models.CharField(max_length=255, blank=True, null=True)
@@ -44,18 +94,264 @@ class Seed(models.Model):
     tags = models.TextField(blank=True, null=True)
     year = models.IntegerField(blank=True, null=True)
     
+    # Full-text search over title and author, maintained by a database trigger
+    search_vector = SearchVectorField(blank=True, null=True, editable=False)
+
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Seed listings page through a garden's seeds newest first
+            models.Index(name='seed_garden_listing_idx', fields=['garden', '-id']),
+            # Finds the source in the other gardens a user can read
+            models.Index(name='seed_source_key_idx', fields=['source_key']),
+            GinIndex(name='seed_search_vector_gin', fields=['search_vector']),
+            HnswIndex(
+                name='seed_embedding_hnsw',
+                fields=['embedding'],
+                m=16,
+                ef_construction=64,
+                opclasses=[embedding_opclass()],
+            ),
+        ]
+        constraints = [
+            models.UniqueConstraint(name='seed_garden_source_key_uniq', fields=['garden', 'source_key']),
+        ]
+
     def __str__(self):
         return self.title
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored garden so save() can tell when the seed moves
+        instance._stored_garden_id = instance.__dict__.get('garden_id')
+        return instance
+
+    def save(self, *args, **kwargs):
+        stored_garden_id = getattr(self, '_stored_garden_id', self.garden_id)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if stored_garden_id != self.garden_id:
+                # Snippets carry a copy of their seed's garden for cheap permission filtering
+                self.parts.update(garden_id=self.garden_id)
+                if stored_garden_id is not None:
+                    stored_garden = Garden.objects.get(pk=stored_garden_id)
+                    stored_garden.forget_seed_listings()
+                    if stored_garden.backend_name != self.garden.backend_name:
+                        self.forget_embeddings()
+            self.garden.forget_seed_listings()
+        self._stored_garden_id = self.garden_id
+
+    def delete(self, *args, **kwargs):
+        self.garden.forget_seed_listings()
+        return super().delete(*args, **kwargs)
+
+    def forget_embeddings(self):
+        """Drop the embeddings of the seed's snippets and its centroid, e.g. once it moved to a garden with
+        another embedding backend, whose vector space they mean nothing in. The unembedded snippets
+        sweeper (thoughts.ingestion.sweep_unembedded_snippets) embeds them again with the garden's backend."""
+        self.parts.exclude(embedding_status=Snippet.SKIPPED).update(
+            embedding=None, embedding_status=Snippet.PENDING, embedding_attempts=0
+        )
+        self.embedding, self.embedded_snippets = zero_embedding(), 0
+        Seed.objects.filter(pk=self.pk).update(embedding=self.embedding, embedded_snippets=0)
+
+    def next_ordinal(self) -> int:
+        """Ordinal for a snippet appended after the seed's current ones."""
+        last = self.parts.order_by('-ordinal').values_list('ordinal', flat=True).first()
+        return 0 if last is None else last + 1
+
+    def add_to_centroid(self, embeddings):
+        """Fold the embeddings of newly stored snippets into the seed's centroid (their running mean).
+
+        Zero vectors, which stand for text that couldn't be embedded, are left out.
+        """
+        vectors = [[float(x) for x in embedding] for embedding in embeddings]
+        vectors = [vector for vector in vectors if any(vector)]
+        if not vectors:
+            return
+        with transaction.atomic():
+            # Lock the row so that concurrent batches of the same seed don't lose each other's snippets
+            stored = Seed.objects.select_for_update().only('embedding', 'embedded_snippets').get(pk=self.pk)
+            count = stored.embedded_snippets + len(vectors)
+            totals = [sum(column) for column in zip(*vectors)]
+            if stored.embedded_snippets:
+                totals = [total + float(x) * stored.embedded_snippets for total, x in zip(totals, stored.embedding)]
+            centroid = [total / count for total in totals]
+            Seed.objects.filter(pk=self.pk).update(embedding=centroid, embedded_snippets=count)
+        self.embedding = centroid
+        self.embedded_snippets = count
+
+    @classmethod
+    def recompute_centroids(cls, seed_ids):
+        """Compute the centroids of the given seeds again from scratch, e.g. after their snippets were re-embedded."""
+        zero = '[' + ','.join('0' for _ in zero_embedding()) + ']'
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE thoughts_seed SET embedding = coalesce(centroids.embedding, %s), embedded_snippets = coalesce(centroids.count, 0)
+                FROM thoughts_seed AS seed LEFT JOIN (
+                    SELECT seed_id, avg(embedding) AS embedding, count(*) AS count FROM thoughts_snippet
+                    WHERE seed_id = ANY(%s) AND embedding_status = %s
+                    GROUP BY seed_id
+                ) AS centroids ON centroids.seed_id = seed.id
+                WHERE seed.id = thoughts_seed.id AND seed.id = ANY(%s)
+                """,
+                [zero, list(seed_ids), Snippet.EMBEDDED, list(seed_ids)],
+            )
     
 class Snippet(models.Model):
+    PENDING, EMBEDDED, SKIPPED, FAILED = 'pending', 'embedded', 'skipped', 'failed'
+    EMBEDDING_STATUS_CHOICES = [
+        (PENDING, 'Waiting to be embedded'),
+        (EMBEDDED, 'Embedded'),
+        # The text can't be embedded (e.g. too short), retrying won't help
+        (SKIPPED, 'Not embeddable'),
+        (FAILED, 'Embedding failed'),
+    ]
+
     seed = models.ForeignKey(Seed, related_name='parts', on_delete=models.CASCADE)
+    # Always the seed's garden, denormalized so searches filter snippets without joining seeds
+    garden = models.ForeignKey(Garden, related_name='snippets', on_delete=models.CASCADE, db_index=False)
     content = models.TextField()
-    embedding = VectorField(dimensions=1536, default = [0]*1536)
+    # Position of the snippet in its seed, in reading order
+    ordinal = models.IntegerField(default=0)
+    # NULL until embedded, so only embedded snippets are in the vector index and searched
+    embedding = EmbeddingField(blank=True, null=True)
+    embedding_status = models.CharField(max_length=10, choices=EMBEDDING_STATUS_CHOICES, default=PENDING)
+    # Times the sweeper (thoughts.ingestion.sweep_unembedded_snippets) tried to embed the snippet
+    embedding_attempts = models.PositiveSmallIntegerField(default=0)
     start_time = models.IntegerField(blank=True, null=True)
+    page = models.IntegerField(blank=True, null=True)
+    # Full-text search over content, maintained by a database trigger
+    search_vector = SearchVectorField(blank=True, null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(name='snippet_garden_seed_idx', fields=['garden', 'seed']),
+            models.Index(name='snippet_seed_ordinal_idx', fields=['seed', 'ordinal']),
+            GinIndex(name='snippet_search_vector_gin', fields=['search_vector']),
+            # Searches filter on embedding_status=EMBEDDED, which lets them use this index
+            HnswIndex(
+                name='snippet_embedding_hnsw',
+                fields=['embedding'],
+                m=16,
+                ef_construction=64,
+                opclasses=[embedding_opclass()],
+                condition=models.Q(embedding_status='embedded'),
+            ),
+            # The few snippets the sweeper has to embed, without scanning the embedded ones
+            models.Index(
+                name='snippet_unembedded_idx',
+                fields=['id'],
+                condition=models.Q(embedding_status__in=['pending', 'failed']),
+            ),
+        ]
+
+    def __str__(self):
+        return f"Part of {self.seed.title}"
+
+    @classmethod
+    def embedding_fields(cls, embedding) -> dict:
+        """Field values storing an embedding returned by get_embeddings, whose zero vector means
+        the text couldn't be embedded."""
+        if embedding is None or not any(embedding):
+            return {'embedding': None, 'embedding_status': cls.SKIPPED}
+        return {'embedding': embedding, 'embedding_status': cls.EMBEDDED}
+
+    def save(self, *args, **kwargs):
+        if self.garden_id is None:
+            self.garden_id = self.seed.garden_id
+        if self._state.adding and self.embedding is not None and self.embedding_status == self.PENDING:
+            self.embedding_status = self.EMBEDDED
+        if self._state.adding and not self.ordinal:
+            self.ordinal = self.seed.next_ordinal()
+        super().save(*args, **kwargs)
+
+class EmbeddingCache(models.Model):
+    """Embeddings already paid for, shared across seeds and users, keyed by model and normalized text hash."""
+    model = models.CharField(max_length=255)
+    text_hash = models.CharField(max_length=64)
+    embedding = VectorField()
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_hit_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = ('model', 'text_hash')
+
+    def __str__(self):
+        return f"{self.model}:{self.text_hash[:12]}"
+
+
+class IngestionJob(models.Model):
+    """Progress of turning a source into a seed and its snippets, checkpointed per stored batch of chunks."""
+    FETCH, EXTRACT, CHUNK, TAG, EMBED, STORE, DONE = 'fetch', 'extract', 'chunk', 'tag', 'embed', 'store', 'done'
+    STAGE_CHOICES = [
+        (FETCH, 'Fetching'),
+        (EXTRACT, 'Extracting text'),
+        (CHUNK, 'Splitting into snippets'),
+        (TAG, 'Tagging'),
+        (EMBED, 'Embedding'),
+        (STORE, 'Storing snippets'),
+        (DONE, 'Done'),
+    ]
+    RUNNING, FAILED = 'running', 'failed'
+    STATUS_CHOICES = [
+        (RUNNING, 'Running'),
+        (FAILED, 'Failed'),
+        (DONE, 'Done'),
+    ]
+
+    # The seed only exists once the tag stage has created it
+    seed = models.ForeignKey(Seed, on_delete=models.CASCADE, related_name='ingestion_jobs', blank=True, null=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='ingestion_jobs')
+    source = models.CharField(max_length=1024, blank=True)
+    stage = models.CharField(max_length=20, choices=STAGE_CHOICES, default=FETCH)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=RUNNING)
+    error = models.TextField(blank=True)
+
+    # Chunks waiting to be embedded; chunks[:stored_chunks] are already saved as snippets
+    chunks = models.JSONField(default=list, blank=True)
+    total_chunks = models.IntegerField(default=0)
+    stored_chunks = models.IntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.source or self.seed} ({self.stage}, {self.status})"
+
+    @property
+    def progress(self):
+        """Percentage of chunks stored as snippets."""
+        if self.status == self.DONE:
+            return 100
+        if not self.total_chunks:
+            return 0
+        return int(100 * self.stored_chunks / self.total_chunks)
+
+    def advance(self, stage):
+        self.stage = stage
+        self.save(update_fields=['stage', 'updated_at'])
+
+    def fail(self, error):
+        self.status = self.FAILED
+        self.error = str(error)
+        self.save(update_fields=['status', 'error', 'updated_at'])
+
+
+class EmbeddingBackfill(models.Model):
+    """Checkpoint of a `manage.py reembed_snippets` run: snippets up to last_snippet_id are done."""
+    name = models.CharField(max_length=100, unique=True)
+    last_snippet_id = models.BigIntegerField(default=0)
+    processed = models.BigIntegerField(default=0)
+    done = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
-        return f"Part of {self.seed.title}"
\ No newline at end of file
+        return f"{self.name} ({self.processed} snippets, up to #{self.last_snippet_id})"
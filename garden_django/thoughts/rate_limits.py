@@ -0,0 +1,192 @@
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+
+import redis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# Provider limits of each API key, shared by every worker through Redis; 0 disables a limit
+EMBEDDING_REQUESTS_PER_MINUTE = int(os.getenv('EMBEDDING_REQUESTS_PER_MINUTE', 3000))
+EMBEDDING_TOKENS_PER_MINUTE = int(os.getenv('EMBEDDING_TOKENS_PER_MINUTE', 1000000))
+# Seconds of unused capacity that may be spent at once
+EMBEDDING_RATE_LIMIT_BURST = float(os.getenv('EMBEDDING_RATE_LIMIT_BURST', 10))
+# Longest a call waits for capacity before giving up
+EMBEDDING_RATE_LIMIT_MAX_WAIT = float(os.getenv('EMBEDDING_RATE_LIMIT_MAX_WAIT', 300))
+# Rejected (429) calls tried again before the error reaches the caller
+EMBEDDING_RATE_LIMIT_RETRIES = int(os.getenv('EMBEDDING_RATE_LIMIT_RETRIES', 6))
+# Calls failed by a connection error, timeout or 5xx response tried again (as the OpenAI client would)
+EMBEDDING_TRANSIENT_RETRIES = int(os.getenv('EMBEDDING_TRANSIENT_RETRIES', 2))
+
+# A 429 halves the rate of the key, down to this share of the configured limits...
+MIN_RATE_SCALE = 0.1
+# ...and it climbs back linearly, from half to the full limits in this many seconds
+RATE_RECOVERY_SECONDS = 60
+# Pause after a 429 without Retry-After: doubles with every attempt, up to the cap
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 60
+
+# Takes a request and `tokens` from the key's buckets, or returns the milliseconds to wait before asking again.
+# Both buckets refill continuously at the configured rates times the key's scale. Times come from Redis.
+ACQUIRE_SCRIPT = """
+local pause = redis.call('PTTL', KEYS[2])
+if pause > 0 then
+    return pause
+end
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local state = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'at', 'scale')
+local request_rate, request_capacity = tonumber(ARGV[1]), tonumber(ARGV[2])
+local token_rate, token_capacity = tonumber(ARGV[3]), tonumber(ARGV[4])
+local needed = math.min(tonumber(ARGV[5]), token_capacity)
+local elapsed = math.max(0, now - (tonumber(state[3]) or now))
+local scale = math.min(1, (tonumber(state[4]) or 1) + elapsed * tonumber(ARGV[6]))
+local requests = math.min(request_capacity, (tonumber(state[1]) or request_capacity) + elapsed * request_rate * scale)
+local tokens = math.min(token_capacity, (tonumber(state[2]) or token_capacity) + elapsed * token_rate * scale)
+local wait = 0
+if request_rate > 0 and requests < 1 then
+    wait = math.max(wait, (1 - requests) / (request_rate * scale))
+end
+if token_rate > 0 and tokens < needed then
+    wait = math.max(wait, (needed - tokens) / (token_rate * scale))
+end
+if wait == 0 then
+    requests = requests - 1
+    tokens = tokens - needed
+end
+redis.call('HSET', KEYS[1], 'requests', requests, 'tokens', tokens, 'at', now, 'scale', scale)
+redis.call('PEXPIRE', KEYS[1], ARGV[7])
+return math.ceil(wait)
+"""
+
+# After a 429: halve the key's rate, empty its buckets and pause every caller of the key for ARGV[1] milliseconds
+BACKOFF_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local scale = tonumber(redis.call('HGET', KEYS[1], 'scale')) or 1
+scale = math.max(tonumber(ARGV[2]), scale / 2)
+-- Nothing refills or recovers until the pause is over
+redis.call('HSET', KEYS[1], 'requests', 0, 'tokens', 0, 'scale', scale, 'at', now + tonumber(ARGV[1]))
+redis.call('PEXPIRE', KEYS[1], ARGV[3])
+if tonumber(ARGV[1]) > redis.call('PTTL', KEYS[2]) then
+    redis.call('SET', KEYS[2], 1, 'PX', ARGV[1])
+end
+return 0
+"""
+
+
+def _keys(api_key: str):
+    # The API key itself never reaches Redis
+    digest = hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+    return [cache.make_key(f"embedding-rate:{digest}"), cache.make_key(f"embedding-rate-pause:{digest}")]
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _redis():
+    """Client of settings.REDIS_URL shared by the process's threads; its pool reconnects in forked workers."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = redis.Redis.from_url(settings.REDIS_URL)
+        return _client
+
+
+def _bucket_ttl() -> int:
+    # Idle buckets are full again after the burst window, so Redis may forget them by then
+    return int((EMBEDDING_RATE_LIMIT_BURST + RATE_RECOVERY_SECONDS) * 1000)
+
+
+def _acquire(api_key: str, tokens: int) -> int:
+    """Milliseconds to wait before the API key may send a request of `tokens` tokens, 0 once it may."""
+    request_rate = EMBEDDING_REQUESTS_PER_MINUTE / 60000
+    token_rate = EMBEDDING_TOKENS_PER_MINUTE / 60000
+    args = [
+        request_rate, max(1, request_rate * EMBEDDING_RATE_LIMIT_BURST * 1000),
+        token_rate, max(1, token_rate * EMBEDDING_RATE_LIMIT_BURST * 1000),
+        tokens, 0.5 / (RATE_RECOVERY_SECONDS * 1000), _bucket_ttl(),
+    ]
+    try:
+        return _redis().eval(ACQUIRE_SCRIPT, 2, *_keys(api_key), *args)
+    except Exception as e:
+        logger.warning(f"Embedding rate limiter unavailable, calling without a limit: {e}")
+        return 0
+
+
+def _pause(wait: int, deadline: float) -> float:
+    if time.monotonic() + wait / 1000 > deadline:
+        raise IOError(f"No embedding capacity within {EMBEDDING_RATE_LIMIT_MAX_WAIT}s.")
+    # Jitter keeps the workers of a key from waking up all at once
+    return wait / 1000 * random.uniform(1, 1.2)
+
+
+def wait_for_capacity(api_key: str, tokens: int):
+    """Block until the API key may send an embeddings request of `tokens` tokens, across all workers.
+
+    Without Redis, calls go through unthrottled.
+    """
+    if not (EMBEDDING_REQUESTS_PER_MINUTE or EMBEDDING_TOKENS_PER_MINUTE):
+        return
+    deadline = time.monotonic() + EMBEDDING_RATE_LIMIT_MAX_WAIT
+    while True:
+        wait = _acquire(api_key, tokens)
+        if wait <= 0:
+            return
+        time.sleep(_pause(wait, deadline))
+
+
+async def await_capacity(api_key: str, tokens: int):
+    """wait_for_capacity for async code, sleeping without holding a thread."""
+    if not (EMBEDDING_REQUESTS_PER_MINUTE or EMBEDDING_TOKENS_PER_MINUTE):
+        return
+    deadline = time.monotonic() + EMBEDDING_RATE_LIMIT_MAX_WAIT
+    while True:
+        wait = await sync_to_async(_acquire, thread_sensitive=False)(api_key, tokens)
+        if wait <= 0:
+            return
+        await asyncio.sleep(_pause(wait, deadline))
+
+
+def back_off(api_key: str, retry_after: float = None, attempt: int = 0):
+    """Record a 429 for the API key: every worker pauses for retry_after seconds (or an exponential
+    backoff when the provider didn't say) and then resumes at a reduced rate."""
+    if retry_after is None:
+        retry_after = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)
+    logger.info(f"Embeddings rate limited, pausing for {retry_after:.1f}s")
+    try:
+        _redis().eval(BACKOFF_SCRIPT, 2, *_keys(api_key), int(retry_after * 1000), MIN_RATE_SCALE,
+                     int(retry_after * 1000) + _bucket_ttl())
+    except Exception as e:
+        logger.warning(f"Embedding rate limiter unavailable: {e}")
+        time.sleep(retry_after * random.uniform(1, 1.2))
+
+
+def transient_delay(attempt: int) -> float:
+    """Seconds before trying a call again after a connection error, timeout or 5xx response. Those say
+    nothing about the key's rate limit, so only the failed call waits: an exponential backoff with jitter."""
+    return min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt) * random.uniform(1, 1.2)
+
+
+def retry_after(response) -> float:
+    """Seconds the provider asked to wait in a 429 response, or None."""
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000
+        if 'retry-after' in headers:
+            return float(headers['retry-after'])
+    except ValueError:
+        # An HTTP date, which the API doesn't send
+        pass
+    return None
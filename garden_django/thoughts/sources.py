@@ -0,0 +1,169 @@
+import hashlib
+import logging
+import re
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, OuterRef
+from django_q.tasks import async_task
+
+from .bulk_writer import clone_snippets
+from .db_walker import filter_seeds_for_user
+from .models import Garden, IngestionJob, Seed, Snippet
+
+logger = logging.getLogger(__name__)
+
+YOUTUBE_ID = re.compile(
+    r'(?:youtube\.com/(?:watch\?(?:\S*&)?v=|shorts/|live/|embed/)|youtu\.be/)([\w-]{11})', re.IGNORECASE
+)
+# Query parameters that say where a link was shared, not what it points to
+TRACKING_PARAMS = re.compile(r'^(?:utm_\w+|fbclid|gclid|yclid|mc_cid|mc_eid|ref|si)$', re.IGNORECASE)
+# Seed.source_key is this long at most; longer URLs are keyed by their hash
+MAX_KEY_LENGTH = 255
+
+# Seed columns a clone shares with its original
+CLONED_SEED_FIELDS = [
+    'title', 'description', 'is_youtube', 'content_url', 'reserve_file', 'thumbnail', 'transcript',
+    'embedding', 'embedded_snippets', 'author', 'language', 'topics', 'tags', 'year', 'source_key',
+]
+
+
+def youtube_video_id(url: str):
+    match = YOUTUBE_ID.search(url or '')
+    return match.group(1) if match else None
+
+
+def normalize_url(url: str) -> str:
+    """The URL without what doesn't change the page: case of scheme and host, www., default port,
+    fragment, tracking parameters, parameter order and trailing slash."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower() or 'https'
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    if parts.port and (scheme, parts.port) not in [('http', 80), ('https', 443)]:
+        host = f"{host}:{parts.port}"
+    query = urlencode(sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                             if not TRACKING_PARAMS.match(key)))
+    return urlunsplit((scheme, host, parts.path.rstrip('/'), query, ''))
+
+
+def source_key_for_url(url: str) -> str:
+    """'youtube:<video id>' for YouTube links, whatever their form, else 'url:<normalized URL>'."""
+    video_id = youtube_video_id(url)
+    if video_id:
+        return f"youtube:{video_id}"
+    key = f"url:{normalize_url(url)}"
+    if len(key) > MAX_KEY_LENGTH:
+        key = f"url-sha256:{hashlib.sha256(key.encode('utf-8')).hexdigest()}"
+    return key
+
+
+def source_key_for_file(file) -> str:
+    """'sha256:<digest>' of a file's bytes; file is a path or a file object (uploads included),
+    which is rewound afterwards for the extractors."""
+    digest = hashlib.sha256()
+    if isinstance(file, str):
+        with open(file, 'rb') as stream:
+            for block in iter(lambda: stream.read(1024 * 1024), b''):
+                digest.update(block)
+    else:
+        file.seek(0)
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+        file.seek(0)
+    return f"sha256:{digest.hexdigest()}"
+
+
+def clone_seed(seed: Seed, garden: Garden) -> Seed:
+    """Copy of the seed and its snippets in another garden, embeddings included, without embedding anything."""
+    with transaction.atomic():
+        clone = Seed(garden=garden, **{field: getattr(seed, field) for field in CLONED_SEED_FIELDS})
+        clone.save()
+        clone_snippets(seed, clone)
+    return clone
+
+
+def _finished(seeds):
+    # Seeds still being embedded, or whose import failed before storing any snippet, would be reused half done
+    return seeds.exclude(ingestion_jobs__status__in=[IngestionJob.RUNNING, IngestionJob.FAILED]).filter(
+        Exists(Snippet.objects.filter(seed=OuterRef('pk')))
+    )
+
+
+def find_known_source(user, key: str, garden: Garden):
+    """A finished seed of the source: the garden's own, or one in another garden the user can read whose
+    snippets were embedded by the garden's backend. None when the source is new to the user."""
+    seeds = _finished(filter_seeds_for_user(user).filter(source_key=key))
+    own = seeds.filter(garden=garden).first()
+    if own is not None:
+        return own
+    return (
+        seeds.filter(garden__embedding_backend__in=_backend_values(garden.backend_name))
+        .order_by('id')
+        .first()
+    )
+
+
+def settle_unfinished_source(key: str, garden: Garden):
+    """The garden's seed of the source when its import is still running or can be resumed (a failed job
+    with its chunks queued, which is queued again). A seed whose import failed before that is deleted,
+    and None returned, so that the source is ingested afresh under its key."""
+    seed = Seed.objects.filter(garden=garden, source_key=key).first()
+    if seed is None:
+        return None
+    job = seed.ingestion_jobs.filter(status__in=[IngestionJob.RUNNING, IngestionJob.FAILED]).order_by('-id').first()
+    if job is not None and job.status == IngestionJob.RUNNING:
+        return seed
+    if job is not None and job.total_chunks:
+        logger.info(f"Resuming the failed import of seed {seed.pk} ({key}) from chunk {job.stored_chunks}")
+        async_task('thoughts.ingestion.run_ingestion_job', job.pk, group=str(seed.pk))
+        return seed
+    logger.info(f"Replacing seed {seed.pk} ({key}), whose import failed")
+    seed.delete()
+    return None
+
+
+def _backend_values(backend: str) -> list:
+    # Gardens with no backend of their own use the default one
+    return [backend, ''] if backend == settings.EMBEDDING_BACKEND else [backend]
+
+
+def ingest_known_source(user, key: str, garden: Garden = None, job: IngestionJob = None):
+    """Seed of the user's garden for a source the user already has, linked or cloned instead of fetched,
+    split and embedded again. None when the source is new (or SOURCE_DEDUP is off): ingest it as usual.
+
+    The job, when given, is finished with the seed, or deleted when the seed's own import is still under
+    way (see settle_unfinished_source).
+    """
+    if not settings.SOURCE_DEDUP or not key:
+        return None
+    if garden is None:
+        garden = Garden.objects.filter(owner=user).first()
+        if garden is None:
+            return None
+    known = find_known_source(user, key, garden)
+    if known is None or known.garden_id != garden.id:
+        # The garden may have the source already, half imported
+        unfinished = settle_unfinished_source(key, garden)
+        if unfinished is not None:
+            if job is not None:
+                # The seed's own job reports its progress
+                job.delete()
+            return unfinished
+    if known is None:
+        return None
+    seed = known
+    if known.garden_id != garden.id:
+        try:
+            seed = clone_seed(known, garden)
+        except IntegrityError:
+            # Another request added the source to this garden meanwhile
+            seed = Seed.objects.get(garden=garden, source_key=key)
+        logger.info(f"Cloned seed {known.pk} ({key}) into garden {garden.pk} as seed {seed.pk}")
+    if job is not None:
+        job.seed = seed
+        job.stage = job.status = IngestionJob.DONE
+        job.save(update_fields=['seed', 'stage', 'status', 'updated_at'])
+    return seed
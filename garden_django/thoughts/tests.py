@@ -1,3 +1,857 @@
-from django.test import TestCase
+import struct
+import uuid
+from unittest import mock
 
-# Create your tests here.
+import fitz
+import redis
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache, caches
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import ingestion, rate_limits
+from .bulk_writer import COPY_SIGNATURE, COPY_TRAILER, ENCODERS, NULL, _binary_rows
+from .chunking import fit_chunks, iter_token_chunks
+from .db_walker import arun_search, list_seeds_page, page_snippets, run_search, search_snippets
+from .embedding_backends import EmbeddingBackend
+from .files import ingest_uploaded_file
+from .ingestion import sweep_unembedded_snippets
+from .LLM import EMBEDDING_MODEL, aget_query_embedding, batch_for_embedding, get_query_embedding, query_embedding_key
+from .management.commands.import_library import centroid
+from .models import EmbeddingBackfill, Garden, GardenMembership, IngestionJob, SEED_LISTING_CACHE_KEY, Seed, Snippet
+from .sources import find_known_source, normalize_url, source_key_for_url
+from .vector_storage import zero_embedding
+
+# Redis isn't needed to test anything here
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'query_embeddings': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'query-embeddings'},
+}
+
+TEXT = ' '.join(f"Sentence number {i} is about gardens and the seeds in them." for i in range(40))
+
+
+def embedding(*values):
+    """An embedding of settings.EMBEDDING_DIMENSIONS dimensions starting with values, zeros after them."""
+    return list(values) + [0.0] * (settings.EMBEDDING_DIMENSIONS - len(values))
+
+
+class ByteEmbeddings(EmbeddingBackend):
+    """Counts UTF-8 bytes as tokens, whatever tokenizers are installed."""
+    name = 'bytes'
+    max_tokens = 400
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class GardenTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        User = get_user_model()
+        cls.user = User.objects.create(username='reader', email='reader@example.com', api_key='sk-test')
+        cls.other = User.objects.create(username='other', email='other@example.com')
+        cls.garden = Garden.objects.create(owner=cls.user, name='Library')
+        cls.other_garden = Garden.objects.create(owner=cls.other, name='Shared')
+
+    def setUp(self):
+        cache.clear()
+        caches['query_embeddings'].clear()
+
+
+class NearestSnippetsTests(GardenTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        seed = Seed.objects.create(garden=cls.garden, title='Ethics')
+        cls.north = Snippet.objects.create(seed=seed, content='North', embedding=embedding(1.0))
+        cls.east = Snippet.objects.create(seed=seed, content='East', embedding=embedding(0.0, 1.0))
+        cls.north_east = Snippet.objects.create(seed=seed, content='North east', embedding=embedding(1.0, 0.5))
+        Snippet.objects.create(seed=seed, content='Pending')
+        hidden = Seed.objects.create(garden=cls.other_garden, title='Private')
+        Snippet.objects.create(seed=hidden, content='Exactly north', embedding=embedding(1.0))
+
+    def ef_search_of(self, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            results = search_snippets(self.user, embedding(1.0), **kwargs)
+        [statement] = [query['sql'] for query in queries if 'hnsw.ef_search' in query['sql']]
+        return results, int(statement.split('=')[1])
+
+    def test_closest_first(self):
+        results = search_snippets(self.user, embedding(1.0), limit=2)
+        self.assertEqual(results, [self.north, self.north_east])
+        self.assertAlmostEqual(results[0].distance, 0.0)
+
+    def test_only_embedded_snippets_of_accessible_gardens(self):
+        results = search_snippets(self.user, embedding(1.0))
+        self.assertEqual(results, [self.north, self.north_east, self.east])
+
+    def test_excluded_snippet(self):
+        results = search_snippets(self.user, embedding(1.0), exclude_id=self.north.pk)
+        self.assertEqual(results, [self.north_east, self.east])
+
+    def test_ef_search_defaults_to_the_setting(self):
+        _, ef_search = self.ef_search_of()
+        self.assertEqual(ef_search, settings.HNSW_EF_SEARCH)
+
+    def test_ef_search_per_query(self):
+        results, ef_search = self.ef_search_of(ef_search=200)
+        self.assertEqual(ef_search, 200)
+        self.assertEqual(results[0], self.north)
+
+    def test_ef_search_is_never_below_the_limit(self):
+        _, ef_search = self.ef_search_of(limit=100, ef_search=10)
+        self.assertEqual(ef_search, 100)
+
+
+class SimilarSnippetsViewTests(GardenTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        seed = Seed.objects.create(garden=cls.garden, title='Ethics')
+        cls.snippet = Snippet.objects.create(seed=seed, content='North', embedding=embedding(1.0))
+
+    def ef_search_for(self, query):
+        self.client.force_login(self.user)
+        # The page shows six snippets
+        with mock.patch('thoughts.views.search_similar_snippets', return_value=[self.snippet] * 6) as search:
+            response = self.client.get(f'/seeds/similar/{self.snippet.pk}/{query}')
+        self.assertEqual(response.status_code, 200)
+        return search.call_args.kwargs['ef_search']
+
+    def test_ef_search_from_the_query_string(self):
+        self.assertEqual(self.ef_search_for('?ef_search=200'), 200)
+
+    def test_ef_search_is_capped(self):
+        self.assertEqual(self.ef_search_for('?ef_search=100000'), 1000)
+
+    def test_invalid_ef_search_is_ignored(self):
+        for query in ['', '?ef_search=0', '?ef_search=-5', '?ef_search=many']:
+            self.assertIsNone(self.ef_search_for(query), query)
+
+
+class BatchForEmbeddingTests(SimpleTestCase):
+    def test_batches_are_bounded_by_items(self):
+        texts = [(i, 'word') for i in range(7)]
+        batches = list(batch_for_embedding(texts, max_items=3, max_tokens=1000))
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 1])
+        self.assertEqual([pair for batch in batches for pair in batch], texts)
+
+    def test_batches_are_bounded_by_tokens(self):
+        # 39 characters estimate to 10 tokens
+        texts = [(i, 'x' * 39) for i in range(5)]
+        batches = list(batch_for_embedding(texts, max_items=100, max_tokens=25))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+
+    def test_text_over_the_token_bound_gets_a_batch_of_its_own(self):
+        texts = [(0, 'short'), (1, 'x' * 400), (2, 'short')]
+        batches = list(batch_for_embedding(texts, max_items=100, max_tokens=50))
+        self.assertEqual(batches, [[(0, 'short')], [(1, 'x' * 400)], [(2, 'short')]])
+
+    def test_no_texts_no_batches(self):
+        self.assertEqual(list(batch_for_embedding([])), [])
+
+
+class QueryEmbeddingCacheTests(GardenTestCase):
+    query = 'the meaning of life'
+
+    def test_backend_is_called_once_per_query(self):
+        with mock.patch('thoughts.LLM.get_embedding', return_value=embedding(1.0)) as get_embedding:
+            first = get_query_embedding(self.query, self.user)
+            second = get_query_embedding(self.query, self.user)
+        self.assertEqual(first, second)
+        get_embedding.assert_called_once()
+
+    def test_other_processes_share_the_embedding(self):
+        with mock.patch('thoughts.LLM.get_embedding', return_value=embedding(1.0)):
+            get_query_embedding(self.query, self.user)
+        # Another process starts with an empty local cache
+        caches['query_embeddings'].clear()
+        with mock.patch('thoughts.LLM.get_embedding') as get_embedding:
+            self.assertEqual(get_query_embedding(self.query, self.user), embedding(1.0))
+        get_embedding.assert_not_called()
+        self.assertEqual(caches['query_embeddings'].get(query_embedding_key(self.query, EMBEDDING_MODEL)),
+                         embedding(1.0))
+
+    def test_queries_are_cached_apart(self):
+        with mock.patch('thoughts.LLM.get_embedding', side_effect=[embedding(1.0), embedding(0.0, 1.0)]):
+            self.assertEqual(get_query_embedding(self.query, self.user), embedding(1.0))
+            self.assertEqual(get_query_embedding('the meaning of death', self.user), embedding(0.0, 1.0))
+
+    def test_search_survives_the_shared_cache_being_down(self):
+        shared_cache = caches['default']
+        with mock.patch.object(shared_cache, 'get', side_effect=ConnectionError), \
+                mock.patch.object(shared_cache, 'set', side_effect=ConnectionError), \
+                mock.patch('thoughts.LLM.get_embedding', return_value=embedding(1.0)) as get_embedding:
+            self.assertEqual(get_query_embedding(self.query, self.user), embedding(1.0))
+            self.assertEqual(get_query_embedding(self.query, self.user), embedding(1.0))
+        get_embedding.assert_called_once()
+
+    async def test_async_views_share_the_cache(self):
+        with mock.patch('thoughts.LLM.aget_embedding', return_value=embedding(1.0)) as aget_embedding:
+            self.assertEqual(await aget_query_embedding(self.query, self.user), embedding(1.0))
+        aget_embedding.assert_awaited_once()
+        with mock.patch('thoughts.LLM.get_embedding') as get_embedding:
+            self.assertEqual(get_query_embedding(self.query, self.user), embedding(1.0))
+        get_embedding.assert_not_called()
+
+
+def pdf_bytes(pages):
+    document = fitz.open()
+    for number in range(pages):
+        document.new_page().insert_text((72, 72), f"Page {number + 1} is about gardens. It has two sentences.")
+    return document.tobytes()
+
+
+@mock.patch('thoughts.ingestion.async_task')
+class QueueChunksTests(GardenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.seed = Seed.objects.create(garden=self.garden, title='Long read')
+        self.job = ingestion.start_ingestion_job(self.user, 'long.pdf')
+
+    def test_chunks_are_appended_to_the_job_as_they_come(self, async_task):
+        produced = []
+
+        def chunks():
+            for number in range(20):
+                produced.append(number)
+                yield f"Chunk {number}"
+
+        writes = []
+        append_chunks = ingestion._append_chunks
+
+        def recording_append(job, batch):
+            writes.append((len(batch), len(produced)))
+            append_chunks(job, batch)
+
+        with mock.patch.object(ingestion, 'CHUNKS_PER_WRITE', 7), \
+                mock.patch.object(ingestion, '_append_chunks', recording_append):
+            ingestion.queue_chunks(self.job, self.seed, chunks())
+        # Each write holds only the chunks produced since the last one
+        self.assertEqual(writes, [(7, 7), (7, 14), (6, 20)])
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.total_chunks, 20)
+        self.assertEqual([chunk['text'] for chunk in self.job.chunks], [f"Chunk {number}" for number in range(20)])
+        self.assertEqual([chunk['ordinal'] for chunk in self.job.chunks], list(range(20)))
+        self.assertEqual(self.job.stage, IngestionJob.EMBED)
+
+    def test_embedding_is_queued_once_every_chunk_is_in(self, async_task):
+        ingestion.queue_chunks(self.job, self.seed, ['One chunk.', 'Another chunk.'])
+        async_task.assert_called_once_with('thoughts.ingestion.run_ingestion_job', self.job.pk, group=str(self.seed.pk))
+
+    def test_document_failing_halfway_leaves_no_chunks(self, async_task):
+        def chunks():
+            yield 'Page one.'
+            raise ValueError('damaged page')
+
+        with mock.patch.object(ingestion, 'CHUNKS_PER_WRITE', 1), self.assertRaises(ValueError):
+            ingestion.queue_chunks(self.job, self.seed, chunks())
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.total_chunks, self.job.chunks), (0, []))
+        async_task.assert_not_called()
+
+
+@override_settings(SOURCE_DEDUP=True)
+class UploadTests(GardenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def upload(self, name='notes.pdf', data=None, title='Field notes'):
+        with mock.patch('thoughts.views.async_task') as async_task:
+            response = self.client.post(reverse('upload_file'), {
+                'title': title, 'file': SimpleUploadedFile(name, data or pdf_bytes(3)),
+            })
+        return response, async_task
+
+    def test_upload_creates_the_seed_and_shows_its_progress(self):
+        response, async_task = self.upload()
+        seed = Seed.objects.get(garden=self.garden)
+        self.assertRedirects(response, reverse('seed_detail_view', kwargs={'pk': seed.pk}), fetch_redirect_response=False)
+        self.assertEqual(seed.title, 'Field notes')
+        self.assertTrue(seed.source_key.startswith('sha256:'))
+        job = seed.ingestion_jobs.get()
+        task, job_id, name, keep_file = async_task.call_args.args
+        self.assertEqual((task, job_id, keep_file), ('thoughts.files.ingest_uploaded_file', job.pk, False))
+        self.addCleanup(default_storage.delete, name)
+
+        page = self.client.get(reverse('seed_detail_view', kwargs={'pk': seed.pk}))
+        self.assertContains(page, '0 of 0 snippets stored')
+
+    def test_uploading_the_file_again_follows_the_first_upload(self):
+        data = pdf_bytes(2)
+        first, async_task = self.upload(data=data)
+        self.addCleanup(default_storage.delete, async_task.call_args.args[2])
+        again, async_task = self.upload(data=data, title='Same notes')
+        self.assertEqual(again['Location'], first['Location'])
+        async_task.assert_not_called()
+        self.assertEqual(IngestionJob.objects.count(), 1)
+
+    def test_unsupported_files_are_refused(self):
+        response, async_task = self.upload(name='notes.odt', data=b'not a PDF')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Seed.objects.exists())
+
+    def test_worker_tags_the_seed_and_queues_its_chunks(self):
+        # A snippet per page
+        get_user_model().objects.filter(pk=self.user.pk).update(max_chunk_size_setting=60)
+        _, async_task = self.upload(data=pdf_bytes(3))
+        job_id, name = async_task.call_args.args[1:3]
+        tags = '{"Author": "A. Gardener", "Year": "2024"}'
+        with mock.patch('thoughts.main_logic.get_tags', return_value=tags), \
+                mock.patch('thoughts.ingestion.async_task') as queue:
+            seed_id = ingest_uploaded_file(job_id, name)
+        seed = Seed.objects.get(pk=seed_id)
+        self.assertEqual((seed.title, seed.author, seed.year), ('Field notes', 'A. Gardener', 2024))
+        job = IngestionJob.objects.get(pk=job_id)
+        self.assertEqual(job.seed, seed)
+        self.assertEqual([chunk['page'] for chunk in job.chunks], [1, 2, 3])
+        queue.assert_called_once()
+        self.assertFalse(default_storage.exists(name))
+
+
+class PageSnippetsTests(GardenTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.seed = Seed.objects.create(garden=cls.garden, title='Meditations')
+        for ordinal in range(1, 26):
+            Snippet.objects.create(seed=cls.seed, content=f"Snippet {ordinal}", ordinal=ordinal)
+
+    def ordinals(self, page):
+        return [snippet.ordinal for snippet in page]
+
+    def test_first_page(self):
+        page, has_previous, has_next = page_snippets(self.seed)
+        self.assertEqual(self.ordinals(page), list(range(1, 11)))
+        self.assertEqual((has_previous, has_next), (False, True))
+
+    def test_page_after(self):
+        page, has_previous, has_next = page_snippets(self.seed, after=20)
+        self.assertEqual(self.ordinals(page), list(range(21, 26)))
+        self.assertEqual((has_previous, has_next), (True, False))
+
+    def test_page_before(self):
+        page, has_previous, has_next = page_snippets(self.seed, before=11)
+        self.assertEqual(self.ordinals(page), list(range(1, 11)))
+        self.assertEqual((has_previous, has_next), (False, True))
+
+    def test_last_page(self):
+        page, has_previous, has_next = page_snippets(self.seed, last=True)
+        self.assertEqual(self.ordinals(page), list(range(16, 26)))
+        self.assertEqual((has_previous, has_next), (True, False))
+
+    def test_page_around(self):
+        page, has_previous, has_next = page_snippets(self.seed, around=14)
+        self.assertEqual(self.ordinals(page), list(range(10, 20)))
+        self.assertEqual((has_previous, has_next), (True, True))
+
+
+class SeedListingTests(GardenTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.seeds = [Seed.objects.create(garden=cls.garden, title=f"Seed {i}", description='x' * 600) for i in range(5)]
+        Seed.objects.create(garden=cls.other_garden, title='Not shared')
+
+    def titles(self, page):
+        return [seed['title'] for seed in page]
+
+    def test_pages_newest_first(self):
+        page, cursor = list_seeds_page(self.user, per_page=2)
+        self.assertEqual(self.titles(page), ['Seed 4', 'Seed 3'])
+        page, cursor = list_seeds_page(self.user, before=cursor, per_page=2)
+        self.assertEqual(self.titles(page), ['Seed 2', 'Seed 1'])
+        page, cursor = list_seeds_page(self.user, before=cursor, per_page=2)
+        self.assertEqual(self.titles(page), ['Seed 0'])
+        self.assertIsNone(cursor)
+
+    def test_listing_holds_only_an_excerpt(self):
+        page, _ = list_seeds_page(self.user)
+        self.assertEqual(len(page[0]['excerpt']), 500)
+        self.assertNotIn('description', page[0])
+
+    def test_first_page_is_cached(self):
+        first, _ = list_seeds_page(self.user)
+        with self.assertNumQueries(0):
+            cached, _ = list_seeds_page(self.user)
+        self.assertEqual(cached, first)
+        # Later pages are not
+        with self.assertNumQueries(2):
+            list_seeds_page(self.user, before=self.seeds[2].pk)
+
+    def test_cached_page_of_another_size_is_not_used(self):
+        list_seeds_page(self.user, per_page=2)
+        page, _ = list_seeds_page(self.user, per_page=3)
+        self.assertEqual(self.titles(page), ['Seed 4', 'Seed 3', 'Seed 2'])
+
+    def test_new_seed_is_listed_once_committed(self):
+        list_seeds_page(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            Seed.objects.create(garden=self.garden, title='Seed 5')
+        page, _ = list_seeds_page(self.user)
+        self.assertEqual(page[0]['title'], 'Seed 5')
+
+    def test_deleted_seed_leaves_the_listing(self):
+        list_seeds_page(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.seeds[4].delete()
+        page, _ = list_seeds_page(self.user)
+        self.assertEqual(page[0]['title'], 'Seed 3')
+
+    def test_visitors_listings_are_forgotten(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            GardenMembership.objects.create(garden=self.garden, user=self.other)
+        list_seeds_page(self.other)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.seeds[0].save()
+        self.assertIsNone(cache.get(SEED_LISTING_CACHE_KEY.format(user_id=self.other.pk)))
+
+    def test_new_visitor_sees_the_garden(self):
+        page, _ = list_seeds_page(self.other)
+        self.assertEqual(self.titles(page), ['Not shared'])
+        with self.captureOnCommitCallbacks(execute=True):
+            GardenMembership.objects.create(garden=self.garden, user=self.other)
+        page, _ = list_seeds_page(self.other)
+        self.assertEqual(len(page), 6)
+
+    def test_moved_seed_leaves_the_old_garden_listings(self):
+        list_seeds_page(self.user)
+        seed = self.seeds[4]
+        seed.garden = self.other_garden
+        with self.captureOnCommitCallbacks(execute=True):
+            seed.save()
+        page, _ = list_seeds_page(self.user)
+        self.assertEqual(page[0]['title'], 'Seed 3')
+
+    def test_listing_json(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/seeds.json', {'before': self.seeds[4].pk})
+        data = response.json()
+        self.assertEqual([seed['title'] for seed in data['seeds']], ['Seed 3', 'Seed 2', 'Seed 1', 'Seed 0'])
+        self.assertEqual(data['seeds'][0]['url'], f'/seeds/{self.seeds[3].pk}/')
+        self.assertIsNone(data['next'])
+
+
+class ReembedSnippetsTests(GardenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.seed = Seed.objects.create(garden=self.garden, title='Notes')
+        self.snippets = [
+            Snippet.objects.create(seed=self.seed, content=f"Note number {i}", embedding=embedding(1.0))
+            for i in range(5)
+        ]
+        Seed.recompute_centroids([self.seed.pk])
+        self.embedded = []
+
+    def new_model(self, texts, user, backend=None):
+        self.embedded.extend(texts)
+        return [embedding(0.0, 1.0) for _ in texts]
+
+    def reembed(self, get_embeddings, **options):
+        with mock.patch('thoughts.management.commands.reembed_snippets.get_embeddings', side_effect=get_embeddings):
+            call_command('reembed_snippets', batch_size=2, concurrency=1, stdout=mock.Mock(), **options)
+
+    def test_interrupted_run_resumes_from_its_checkpoint(self):
+        def failing_second_batch(texts, user, backend=None):
+            if self.embedded:
+                raise RuntimeError('API down')
+            return self.new_model(texts, user, backend)
+
+        with self.assertRaises(RuntimeError):
+            self.reembed(failing_second_batch)
+        checkpoint = EmbeddingBackfill.objects.get(name='reembed')
+        self.assertEqual((checkpoint.last_snippet_id, checkpoint.processed, checkpoint.done),
+                         (self.snippets[1].pk, 2, False))
+        # The centroid already counts the batch that was stored
+        self.seed.refresh_from_db()
+        self.assertEqual([round(float(x), 6) for x in self.seed.embedding[:2]], [0.6, 0.4])
+
+        self.embedded = []
+        self.reembed(self.new_model)
+        self.assertEqual(self.embedded, [snippet.content for snippet in self.snippets[2:]])
+        checkpoint.refresh_from_db()
+        self.assertEqual((checkpoint.last_snippet_id, checkpoint.processed, checkpoint.done),
+                         (self.snippets[-1].pk, 5, True))
+        self.seed.refresh_from_db()
+        self.assertEqual(list(self.seed.embedding[:2]), [0.0, 1.0])
+        self.assertEqual(self.seed.embedded_snippets, 5)
+
+    def test_finished_run_is_not_run_again(self):
+        self.reembed(self.new_model)
+        self.embedded = []
+        self.reembed(self.new_model)
+        self.assertEqual(self.embedded, [])
+        self.reembed(self.new_model, restart=True)
+        self.assertEqual(len(self.embedded), 5)
+
+    def test_only_snippets_without_an_embedding(self):
+        Snippet.objects.filter(pk=self.snippets[3].pk).update(embedding=None, embedding_status=Snippet.FAILED)
+        self.reembed(self.new_model, only_zero=True)
+        self.assertEqual(self.embedded, [self.snippets[3].content])
+        self.assertEqual(Snippet.objects.get(pk=self.snippets[3].pk).embedding_status, Snippet.EMBEDDED)
+
+
+class RateLimiterTests(SimpleTestCase):
+    """The token buckets in Redis; skipped without a Redis server at settings.REDIS_URL."""
+
+    def setUp(self):
+        try:
+            rate_limits._redis().ping()
+        except redis.RedisError as e:
+            self.skipTest(f"Redis unavailable: {e}")
+        self.api_key = f"sk-{uuid.uuid4()}"
+        self.addCleanup(lambda: rate_limits._redis().delete(*rate_limits._keys(self.api_key)))
+
+    def limits(self, requests_per_minute=0, tokens_per_minute=0, burst=1):
+        for name, value in [('EMBEDDING_REQUESTS_PER_MINUTE', requests_per_minute),
+                            ('EMBEDDING_TOKENS_PER_MINUTE', tokens_per_minute), ('EMBEDDING_RATE_LIMIT_BURST', burst)]:
+            patcher = mock.patch.object(rate_limits, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_requests_beyond_the_burst_wait(self):
+        # One request a second, two at once
+        self.limits(requests_per_minute=60, burst=2)
+        self.assertEqual(rate_limits._acquire(self.api_key, 10), 0)
+        self.assertEqual(rate_limits._acquire(self.api_key, 10), 0)
+        self.assertTrue(0 < rate_limits._acquire(self.api_key, 10) <= 1000)
+
+    def test_tokens_are_limited_too(self):
+        # 100 tokens a second, a second's worth at once
+        self.limits(tokens_per_minute=6000)
+        self.assertEqual(rate_limits._acquire(self.api_key, 80), 0)
+        # 20 tokens are left, the other 60 take 600 ms to come back
+        self.assertTrue(500 < rate_limits._acquire(self.api_key, 80) <= 600)
+
+    def test_api_keys_have_buckets_of_their_own(self):
+        self.limits(requests_per_minute=60)
+        self.assertEqual(rate_limits._acquire(self.api_key, 1), 0)
+        self.assertGreater(rate_limits._acquire(self.api_key, 1), 0)
+        other_key = f"sk-{uuid.uuid4()}"
+        self.addCleanup(lambda: rate_limits._redis().delete(*rate_limits._keys(other_key)))
+        self.assertEqual(rate_limits._acquire(other_key, 1), 0)
+
+    def test_back_off_pauses_every_caller_and_halves_the_rate(self):
+        self.limits(requests_per_minute=600, burst=10)
+        rate_limits.back_off(self.api_key, retry_after=2)
+        self.assertTrue(1500 < rate_limits._acquire(self.api_key, 1) <= 2000)
+        bucket, _ = rate_limits._keys(self.api_key)
+        self.assertEqual(float(rate_limits._redis().hget(bucket, 'scale')), 0.5)
+        rate_limits.back_off(self.api_key, retry_after=1)
+        rate_limits.back_off(self.api_key, retry_after=1)
+        rate_limits.back_off(self.api_key, retry_after=1)
+        rate_limits.back_off(self.api_key, retry_after=1)
+        self.assertEqual(float(rate_limits._redis().hget(bucket, 'scale')), rate_limits.MIN_RATE_SCALE)
+
+
+class RateLimitWaitTests(SimpleTestCase):
+    def test_calls_go_through_without_redis(self):
+        with mock.patch.object(rate_limits, '_redis', side_effect=redis.ConnectionError('refused')):
+            self.assertEqual(rate_limits._acquire('sk-test', 100), 0)
+            with mock.patch.object(rate_limits.time, 'sleep') as sleep:
+                rate_limits.back_off('sk-test', retry_after=3)
+        self.assertTrue(3 <= sleep.call_args.args[0] <= 3.6)
+
+    def test_waits_until_there_is_capacity(self):
+        with mock.patch.object(rate_limits, '_acquire', side_effect=[250, 100, 0]), \
+                mock.patch.object(rate_limits.time, 'sleep') as sleep:
+            rate_limits.wait_for_capacity('sk-test', 100)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertTrue(0.25 <= sleep.call_args_list[0].args[0] <= 0.3)
+
+    def test_gives_up_past_the_longest_wait(self):
+        with mock.patch.object(rate_limits, '_acquire', return_value=60_000), \
+                mock.patch.object(rate_limits, 'EMBEDDING_RATE_LIMIT_MAX_WAIT', 30):
+            with self.assertRaises(IOError):
+                rate_limits.wait_for_capacity('sk-test', 100)
+
+    def test_retry_after(self):
+        self.assertEqual(rate_limits.retry_after(mock.Mock(headers={'retry-after-ms': '1500'})), 1.5)
+        self.assertEqual(rate_limits.retry_after(mock.Mock(headers={'retry-after': '3'})), 3.0)
+        self.assertIsNone(rate_limits.retry_after(mock.Mock(headers={'retry-after': 'Wed, 21 Oct 2026 07:28:00 GMT'})))
+        self.assertIsNone(rate_limits.retry_after(mock.Mock(headers={})))
+        self.assertIsNone(rate_limits.retry_after(None))
+
+    def test_transient_delay_doubles_up_to_the_cap(self):
+        self.assertTrue(1 <= rate_limits.transient_delay(0) <= 1.2)
+        self.assertTrue(4 <= rate_limits.transient_delay(2) <= 4.8)
+        self.assertLessEqual(rate_limits.transient_delay(20), rate_limits.BACKOFF_MAX_SECONDS * 1.2)
+
+
+class CentroidTests(SimpleTestCase):
+    def test_mean_of_the_non_zero_embeddings(self):
+        self.assertEqual(centroid([[1.0, 3.0], [0.0, 0.0], [3.0, 5.0]]), ([2.0, 4.0], 2))
+
+    def test_no_embeddings_give_the_zero_embedding(self):
+        self.assertEqual(centroid([]), (zero_embedding(), 0))
+        self.assertEqual(centroid([[0.0, 0.0]]), (zero_embedding(), 0))
+
+
+class BinaryRowsTests(SimpleTestCase):
+    def test_rows_are_encoded_in_the_binary_copy_format(self):
+        encoders = [ENCODERS['text'], ENCODERS['integer'], ENCODERS['smallint'], ENCODERS['vector']]
+        rows = [['café\x00', 7, None, [0.5, -1.0]]]
+        data = b''.join(_binary_rows(rows, encoders))
+
+        self.assertTrue(data.startswith(COPY_SIGNATURE))
+        self.assertTrue(data.endswith(COPY_TRAILER))
+        row = data[len(COPY_SIGNATURE):-len(COPY_TRAILER)]
+        self.assertEqual(struct.unpack('>h', row[:2])[0], 4)
+        expected = (
+            struct.pack('>i', 5) + 'café'.encode('utf-8')
+            + struct.pack('>i', 4) + struct.pack('>i', 7)
+            + NULL
+            + struct.pack('>i', 12) + struct.pack('>HH2f', 2, 0, 0.5, -1.0)
+        )
+        self.assertEqual(row[2:], expected)
+
+    def test_halfvec_values_take_two_bytes(self):
+        data = b''.join(_binary_rows([[[1.0, 2.0, 3.0]]], [ENCODERS['halfvec']]))
+        row = data[len(COPY_SIGNATURE):-len(COPY_TRAILER)]
+        self.assertEqual(row[2:], struct.pack('>i', 10) + struct.pack('>HH3e', 3, 0, 1.0, 2.0, 3.0))
+
+    def test_no_rows(self):
+        self.assertEqual(b''.join(_binary_rows([], [ENCODERS['text']])), COPY_SIGNATURE + COPY_TRAILER)
+
+
+class SourceKeyTests(SimpleTestCase):
+    def test_normalize_url_drops_what_does_not_change_the_page(self):
+        self.assertEqual(
+            normalize_url(' HTTPS://www.Example.com:443/a/b/?utm_source=x&b=2&fbclid=y&a=1#section '),
+            'https://example.com/a/b?a=1&b=2',
+        )
+
+    def test_normalize_url_keeps_other_ports_and_blank_parameters(self):
+        self.assertEqual(normalize_url('http://example.com:8080/?q=&page=2'), 'http://example.com:8080?page=2&q=')
+
+    def test_youtube_links_share_a_key(self):
+        urls = ['https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=42s', 'https://youtu.be/dQw4w9WgXcQ?si=abc',
+                'https://youtube.com/shorts/dQw4w9WgXcQ', 'https://m.youtube.com/watch?feature=share&v=dQw4w9WgXcQ']
+        self.assertEqual({source_key_for_url(url) for url in urls}, {'youtube:dQw4w9WgXcQ'})
+
+    def test_other_links_are_keyed_by_their_normalized_url(self):
+        self.assertEqual(source_key_for_url('https://www.example.com/post/?utm_medium=mail'),
+                         'url:https://example.com/post')
+        self.assertEqual(source_key_for_url('https://example.com/post'),
+                         source_key_for_url('HTTPS://EXAMPLE.COM/post/'))
+
+    def test_long_urls_are_keyed_by_their_hash(self):
+        key = source_key_for_url('https://example.com/' + 'a' * 400)
+        self.assertTrue(key.startswith('url-sha256:'))
+        self.assertLessEqual(len(key), 255)
+        self.assertEqual(key, source_key_for_url('https://www.example.com/' + 'a' * 400 + '/'))
+
+
+@override_settings(SOURCE_DEDUP=True)
+class FindKnownSourceTests(GardenTestCase):
+    key = 'url:https://example.com/post'
+
+    def seed(self, garden, job_status=None, snippets=1):
+        seed = Seed.objects.create(garden=garden, title='Post', source_key=self.key)
+        for ordinal in range(1, snippets + 1):
+            Snippet.objects.create(seed=seed, content=f"Part {ordinal}", ordinal=ordinal)
+        if job_status:
+            IngestionJob.objects.create(seed=seed, user=garden.owner, source=self.key, status=job_status)
+        return seed
+
+    def test_unknown_source(self):
+        self.assertIsNone(find_known_source(self.user, self.key, self.garden))
+
+    def test_own_seed_comes_first(self):
+        Seed.objects.create(garden=Garden.objects.create(owner=self.user, name='Older'), source_key=self.key)
+        own = self.seed(self.garden)
+        self.assertEqual(find_known_source(self.user, self.key, self.garden), own)
+
+    def test_seed_of_another_readable_garden(self):
+        self.other_garden.visitors.add(self.user)
+        shared = self.seed(self.other_garden)
+        self.assertEqual(find_known_source(self.user, self.key, self.garden), shared)
+
+    def test_seed_of_an_unreadable_garden(self):
+        self.seed(self.other_garden)
+        self.assertIsNone(find_known_source(self.user, self.key, self.garden))
+
+    def test_seed_of_a_garden_with_another_backend(self):
+        self.other_garden.visitors.add(self.user)
+        self.other_garden.embedding_backend = 'local'
+        self.other_garden.save()
+        self.seed(self.other_garden)
+        self.assertIsNone(find_known_source(self.user, self.key, self.garden))
+
+    def test_unfinished_seeds_are_not_reused(self):
+        self.seed(self.garden, job_status=IngestionJob.RUNNING)
+        self.assertIsNone(find_known_source(self.user, self.key, self.garden))
+        Seed.objects.all().delete()
+        self.seed(self.garden, job_status=IngestionJob.FAILED)
+        self.assertIsNone(find_known_source(self.user, self.key, self.garden))
+        Seed.objects.all().delete()
+        self.seed(self.garden, snippets=0)
+        self.assertIsNone(find_known_source(self.user, self.key, self.garden))
+
+    def test_seed_whose_import_finished(self):
+        seed = self.seed(self.garden, job_status=IngestionJob.DONE)
+        self.assertEqual(find_known_source(self.user, self.key, self.garden), seed)
+
+
+@mock.patch('thoughts.chunking.get_embedder', lambda backend=None: ByteEmbeddings())
+class ChunkingTests(SimpleTestCase):
+    count_tokens = ByteEmbeddings().count_tokens
+
+    def test_chunks_respect_the_token_cap(self):
+        chunks = list(iter_token_chunks([(TEXT, {})], max_tokens=100, overlap_tokens=0))
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(self.count_tokens(chunk['text']), 100)
+
+    def test_offsets_slice_back_to_the_chunk_text(self):
+        segments = [(TEXT[:700], {'page': 1}), (TEXT[700:], {'page': 2})]
+        chunks = list(iter_token_chunks(segments, max_tokens=100, overlap_tokens=30))
+        for chunk in chunks:
+            self.assertEqual(TEXT[chunk['char_start']:chunk['char_end']], chunk['text'])
+        self.assertEqual(chunks[0]['page'], 1)
+        self.assertEqual(chunks[-1]['page'], 2)
+
+    def test_chunks_cover_the_text_without_overlap(self):
+        chunks = list(iter_token_chunks([(TEXT, {})], max_tokens=100, overlap_tokens=0))
+        for previous, chunk in zip(chunks, chunks[1:]):
+            self.assertGreaterEqual(chunk['char_start'], previous['char_end'])
+        self.assertEqual(' '.join(chunk['text'] for chunk in chunks), TEXT)
+
+    def test_chunks_repeat_the_end_of_the_previous_one(self):
+        chunks = list(iter_token_chunks([(TEXT, {})], max_tokens=200, overlap_tokens=70))
+        for previous, chunk in zip(chunks, chunks[1:]):
+            self.assertLess(chunk['char_start'], previous['char_end'])
+            self.assertGreater(chunk['char_start'], previous['char_start'])
+            overlap = TEXT[chunk['char_start']:previous['char_end']]
+            self.assertLessEqual(self.count_tokens(overlap), 70 + 2)
+
+    def test_words_longer_than_the_cap_are_sliced(self):
+        text = 'Short start. ' + 'x' * 300 + ' and an end.'
+        chunks = list(iter_token_chunks([(text, {})], max_tokens=50, overlap_tokens=0))
+        for chunk in chunks:
+            self.assertLessEqual(self.count_tokens(chunk['text']), 50)
+            self.assertEqual(text[chunk['char_start']:chunk['char_end']], chunk['text'])
+        self.assertEqual(''.join(chunk['text'] for chunk in chunks).count('x'), 300)
+
+    def test_cap_never_exceeds_the_model_limit(self):
+        chunks = list(iter_token_chunks([(TEXT, {})], max_tokens=10_000, overlap_tokens=0))
+        for chunk in chunks:
+            self.assertLessEqual(self.count_tokens(chunk['text']), ByteEmbeddings.max_tokens)
+
+    def test_fit_chunks_splits_only_chunks_too_long(self):
+        text = TEXT[:1000]
+        chunks = [{'text': 'A short one.', 'page': 1, 'char_start': 0, 'char_end': 12},
+                  {'text': text, 'page': 3, 'char_start': 100, 'char_end': 100 + len(text)}]
+        fitted = list(fit_chunks(chunks))
+        self.assertEqual(fitted[0], chunks[0])
+        pieces = fitted[1:]
+        self.assertGreater(len(pieces), 1)
+        for piece in pieces:
+            self.assertEqual(piece['page'], 3)
+            self.assertLessEqual(self.count_tokens(piece['text']), ByteEmbeddings.max_tokens)
+            self.assertEqual(text[piece['char_start'] - 100:piece['char_end'] - 100], piece['text'])
+
+
+class ShortQueryTests(GardenTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.seed = Seed.objects.create(garden=cls.garden, title='Critique of Pure Reason')
+        Snippet.objects.create(seed=cls.seed, content='Kant wrote about the limits of reason', embedding=embedding(1.0))
+        Snippet.objects.create(seed=cls.seed, content='Hume woke him from his slumber', embedding=embedding(0.0, 1.0))
+
+    def test_short_queries_have_no_embedding(self):
+        with mock.patch('thoughts.LLM.get_embeddings') as get_embeddings:
+            self.assertIsNone(get_query_embedding('war', self.user))
+        get_embeddings.assert_not_called()
+
+    async def test_short_queries_have_no_embedding_in_async_code(self):
+        with mock.patch('thoughts.LLM.aget_embedding') as aget_embedding:
+            self.assertIsNone(await aget_query_embedding('war', self.user))
+        aget_embedding.assert_not_called()
+
+    def test_short_queries_are_searched_by_words(self):
+        for mode in ['vector', 'coarse', 'hybrid']:
+            results = run_search(self.user, 'Kant', mode=mode)
+            self.assertEqual([part.content for part in results], ['Kant wrote about the limits of reason'], mode)
+
+    def test_short_queries_find_seeds_by_words(self):
+        self.assertEqual(run_search(self.user, 'Kant', mode='seeds'), [self.seed])
+
+    async def test_short_queries_are_searched_by_words_in_async_code(self):
+        results = await arun_search(self.user, 'Hume', mode='vector')
+        self.assertEqual([part.content for part in results], ['Hume woke him from his slumber'])
+
+
+class SweepUnembeddedSnippetsTests(GardenTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.seed = Seed.objects.create(garden=cls.garden, title='Notes')
+
+    def snippet(self, content, **fields):
+        return Snippet.objects.create(seed=self.seed, content=content, **fields)
+
+    def fake_embeddings(self, texts, user, backend=None):
+        return [embedding(1.0, 0.0) if text != 'empty' else embedding() for text in texts]
+
+    def test_pending_snippets_are_embedded(self):
+        pending = self.snippet('first note')
+        skipped = self.snippet('empty')
+        done = self.snippet('done', embedding=embedding(0.0, 1.0))
+        with mock.patch('thoughts.ingestion.get_embeddings', side_effect=self.fake_embeddings) as get_embeddings:
+            self.assertEqual(sweep_unembedded_snippets(), 2)
+        self.assertEqual(sorted(get_embeddings.call_args.args[0]), ['empty', 'first note'])
+
+        pending.refresh_from_db()
+        self.assertEqual(pending.embedding_status, Snippet.EMBEDDED)
+        self.assertEqual(pending.embedding_attempts, 1)
+        self.assertEqual(list(pending.embedding[:2]), [1.0, 0.0])
+        skipped.refresh_from_db()
+        self.assertEqual(skipped.embedding_status, Snippet.SKIPPED)
+        done.refresh_from_db()
+        self.assertEqual(done.embedding_attempts, 0)
+        self.seed.refresh_from_db()
+        self.assertEqual(self.seed.embedded_snippets, 1)
+
+    def test_failed_embedding_counts_an_attempt(self):
+        snippet = self.snippet('unlucky')
+        with mock.patch('thoughts.ingestion.get_embeddings', side_effect=RuntimeError('API down')):
+            self.assertEqual(sweep_unembedded_snippets(), 1)
+        snippet.refresh_from_db()
+        self.assertEqual((snippet.embedding_status, snippet.embedding_attempts), (Snippet.FAILED, 1))
+        self.assertIsNone(snippet.embedding)
+
+    @override_settings(SNIPPET_EMBEDDING_MAX_ATTEMPTS=2)
+    def test_snippets_out_of_attempts_are_left_alone(self):
+        self.snippet('hopeless', embedding_status=Snippet.FAILED, embedding_attempts=2)
+        with mock.patch('thoughts.ingestion.get_embeddings', side_effect=self.fake_embeddings) as get_embeddings:
+            self.assertEqual(sweep_unembedded_snippets(), 0)
+        get_embeddings.assert_not_called()
+
+    def test_limit(self):
+        for i in range(3):
+            self.snippet(f"note {i}")
+        with mock.patch('thoughts.ingestion.get_embeddings', side_effect=self.fake_embeddings):
+            self.assertEqual(sweep_unembedded_snippets(limit=2), 2)
+        self.assertEqual(Snippet.objects.filter(embedding_status=Snippet.PENDING).count(), 1)
+
+    def test_snippets_changed_meanwhile_are_not_overwritten(self):
+        snippet = self.snippet('moving')
+
+        def reset_while_embedding(texts, user, backend=None):
+            # The seed moves to a garden of another backend, which resets its snippets
+            Snippet.objects.filter(pk=snippet.pk).update(embedding_status=Snippet.PENDING, embedding_attempts=0)
+            return self.fake_embeddings(texts, user, backend)
+
+        with mock.patch('thoughts.ingestion.get_embeddings', side_effect=reset_while_embedding):
+            sweep_unembedded_snippets()
+        snippet.refresh_from_db()
+        self.assertEqual((snippet.embedding_status, snippet.embedding_attempts), (Snippet.PENDING, 0))
+        self.assertIsNone(snippet.embedding)
@@ -5,9 +5,11 @@ from django.conf.urls.static import static
 
 urlpatterns = [
     path('', views.seeds_list, name='seeds_list'),
+    path('seeds.json', views.seeds_list_json, name='seeds_list_json'),
     path("home/", views.home, name='home'),
     path('create/', views.submit_content, name='submit_content'),
     path('search/', views.search_seeds, name='search_seeds'),
+    path('search.json', views.search_json, name='search_json'),
     
     path('seeds/<int:pk>/', views.seed_detail_view, name='seed_detail_view'),
     path('seeds/<int:pk>/edit/', views.seed_edit_view, name='seed_edit_view'),
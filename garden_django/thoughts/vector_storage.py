@@ -0,0 +1,105 @@
+import logging
+
+from django.conf import settings
+from pgvector.django import VectorField
+
+logger = logging.getLogger(__name__)
+
+# Embedding columns and the HNSW index over each of them
+# Table, column, HNSW index and the rows it covers (its partial index condition, if any)
+EMBEDDING_COLUMNS = [
+    ('thoughts_seed', 'embedding', 'seed_embedding_hnsw', ''),
+    ('thoughts_snippet', 'embedding', 'snippet_embedding_hnsw', "WHERE embedding_status = 'embedded'"),
+]
+
+# pgvector operator class suffix for each supported settings.VECTOR_DISTANCE
+DISTANCE_OPS = {
+    'cosine': 'cosine_ops',
+    'ip': 'ip_ops',
+    'l2': 'l2_ops',
+}
+
+
+def embedding_opclass(distance: str = None, storage: str = None) -> str:
+    """Operator class of the HNSW indexes, e.g. 'vector_cosine_ops' or 'halfvec_ip_ops'."""
+    return f"{storage or settings.VECTOR_STORAGE}_{DISTANCE_OPS[distance or settings.VECTOR_DISTANCE]}"
+
+
+def zero_embedding() -> list:
+    """Placeholder for text that can't be embedded; matches nothing."""
+    return [0.0] * settings.EMBEDDING_DIMENSIONS
+
+
+class EmbeddingField(VectorField):
+    """Embedding column sized and typed by settings.EMBEDDING_DIMENSIONS and settings.VECTOR_STORAGE.
+
+    Both are left out of migrations: changing them on an existing database is a data conversion,
+    done by convert_embedding_storage (manage.py convert_embeddings).
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs['dimensions'] = settings.EMBEDDING_DIMENSIONS
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        del kwargs['dimensions']
+        return name, path, args, kwargs
+
+    def db_type(self, connection):
+        # halfvec reads and writes the same '[1,2,3]' text as vector, so the rest of VectorField applies
+        return f"{settings.VECTOR_STORAGE}({self.dimensions})"
+
+
+def column_type(cursor, table: str, column: str) -> str:
+    cursor.execute(
+        "SELECT format_type(atttypid, atttypmod) FROM pg_attribute WHERE attrelid = %s::regclass AND attname = %s",
+        [table, column],
+    )
+    return cursor.fetchone()[0]
+
+
+def convert_embedding_storage(connection, dimensions: int = None, storage: str = None) -> list:
+    """Convert the embedding columns in place to `storage`(`dimensions`) and rebuild their HNSW indexes.
+
+    Shrinking keeps the leading dimensions and normalizes them again, which is how shortened
+    embeddings of text-embedding-3 models are made; it is refused for other models, whose embeddings
+    must be computed again instead. Growing is impossible without embedding everything again.
+    Returns a line per converted column.
+    """
+    # LLM imports the models, which import this module
+    from .LLM import EMBEDDING_MODEL, supports_dimensions
+
+    dimensions = dimensions or settings.EMBEDDING_DIMENSIONS
+    storage = storage or settings.VECTOR_STORAGE
+    target = f"{storage}({dimensions})"
+    converted = []
+    with connection.cursor() as cursor:
+        for table, column, index, condition in EMBEDDING_COLUMNS:
+            current = column_type(cursor, table, column)
+            if current == target:
+                continue
+            current_dimensions = int(current[current.index('(') + 1:-1])
+            if current_dimensions < dimensions:
+                raise ValueError(f"Can't grow {table}.{column} from {current} to {target}, embed the texts again instead.")
+            if current_dimensions > dimensions and not supports_dimensions(EMBEDDING_MODEL):
+                raise ValueError(f"Can't shrink {table}.{column} from {current} to {target}: {EMBEDDING_MODEL} "
+                                 f"embeddings can't be shortened, embed the texts again instead.")
+
+            value = f"{column}::vector"
+            if current_dimensions > dimensions:
+                value = f"l2_normalize(subvector({value}, 1, {dimensions}))"
+            logger.info(f"Converting {table}.{column} from {current} to {target}")
+            # The index can't survive a change of type, and rebuilding it once at the end is faster anyway
+            cursor.execute(f"DROP INDEX IF EXISTS {index}")
+            cursor.execute(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE {target} USING ({value})::{target}")
+            cursor.execute(
+                f"CREATE INDEX {index} ON {table} USING hnsw ({column} {embedding_opclass(storage=storage)}) "
+                f"WITH (m = 16, ef_construction = 64) {condition}"
+            )
+            converted.append(f"{table}.{column}: {current} -> {target}")
+    if converted:
+        # This process writes snippets in the new format from now on; the others notice on their next COPY
+        from .bulk_writer import forget_snippet_encoders
+        forget_snippet_encoders()
+    return converted
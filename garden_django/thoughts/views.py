@@ -1,35 +1,45 @@
 from django.shortcuts import render, redirect, HttpResponse, get_object_or_404
-from django.http import JsonResponse
+from django.http import JsonResponse, Http404
+from django.urls import reverse
+from django.conf import settings
+from django.db import IntegrityError, transaction
 
 from .forms import SeedForm, SearchForm, FileUploadForm, YouTubeForm, SeedBigForm
-from .models import Seed, Snippet, Garden
+from .models import Seed, Snippet, Garden, IngestionJob
 from .main_logic import create_seed_from_youtube, create_seed_from
-from .LLM import get_embedding
 from .files import extract_text_from_youtube
 
-from django.core.paginator import Paginator
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
 
-from django.core.files.storage import default_storage, FileSystemStorage
+from django.core.files.storage import FileSystemStorage
 
-from django.db.models import F
-from pgvector.django import L2Distance
-from .files import extract_text_from_pdf, extract_text_from_docx, process_and_create_embeddings, \
-    split_text_into_chunks
+from .files import save_upload, split_text_into_chunks
 from django_q.tasks import async_task
 from django_q.models import Task
 
-import datetime
-import uuid
-from django.utils.text import slugify
 import logging
+from functools import wraps
 
-from .db_walker import filter_snippets_for_user, filter_seeds_for_user
+from asgiref.sync import sync_to_async
 
-from django.contrib.auth import get_user_model
+from .db_walker import filter_seeds_for_user, search_similar_snippets, arun_search, page_snippets, list_seeds_page
+from .ingestion import start_ingestion_job, queue_chunks
+from .sources import ingest_known_source, source_key_for_file, source_key_for_url
 
 logger = logging.getLogger(__name__)
 
+
+def async_login_required(view):
+    # login_required only wraps sync views in Django 4.2
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        # request.user is loaded lazily, from the session and the database
+        if not await sync_to_async(lambda: request.user.is_authenticated)():
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
+
 @login_required
 def submit_content(request):
     # Initialize forms for text, YouTube URL, and file upload
@@ -51,8 +61,22 @@ def seeds_list(request):
         #TODO: Create a default garden for the user
         Garden.objects.create(owner=request.user, name=f"{request.user.username}'s Garden")
 
-    seeds = filter_seeds_for_user(request.user)
-    return render(request, 'thoughts/seeds_list.html', {'seeds': seeds})
+    seeds, cursor = list_seeds_page(request.user, before=seed_cursor(request))
+    return render(request, 'thoughts/seeds_list.html', {'seeds': seeds, 'cursor': cursor})
+
+
+@login_required
+def seeds_list_json(request):
+    # Next pages of the seed listing, for infinite scroll
+    seeds, cursor = list_seeds_page(request.user, before=seed_cursor(request))
+    for seed in seeds:
+        seed['url'] = reverse('seed_detail_view', kwargs={'pk': seed['id']})
+    return JsonResponse({'seeds': seeds, 'next': cursor})
+
+
+def seed_cursor(request):
+    before = request.GET.get('before', '')
+    return int(before) if before.isdigit() else None
 
 
 @login_required
@@ -62,50 +86,101 @@ def create_seed(request):
         if form.is_valid():
             title = form.cleaned_data['title']
             content = form.cleaned_data['content']
+            job = start_ingestion_job(request.user, title)
+            job.advance(IngestionJob.TAG)
             seed = create_seed_from(title, content, request.user)
 
             # Break down the caption text into chunks and process asynchronously.
             if seed:
-                for chunk in split_text_into_chunks(content, max_chunk_size=request.user.max_chunk_size_setting):
-                    async_task('thoughts.main_logic.create_snippet_from', chunk, seed, request.user, group=str(seed.pk))
+                job.advance(IngestionJob.CHUNK)
+                chunks = split_text_into_chunks(content, max_chunk_size=request.user.max_chunk_size_setting)
+                queue_chunks(job, seed, chunks)
+            else:
+                job.fail("Seed could not be created.")
 
             return redirect('seed_detail_view', pk=seed.pk)
     else:
         form = SeedForm()
     return render(request, 'thoughts/create_seed.html', {'form': form})
 
-@login_required
-def search_seeds(request):
+@async_login_required
+async def search_seeds(request):
     form = SearchForm()
     parts = None  
+    seeds = None
     search_text = ""
 
     if request.method == "POST":
         form = SearchForm(request.POST)
         if form.is_valid():
             search_text = form.cleaned_data['search_text']
-            embedding = get_embedding(search_text, request.user)
-
-            # Now filter Snippets whose Seed is in one of the accessible gardens
-            parts = filter_snippets_for_user(request.user).annotate(
-                distance=L2Distance(F('embedding'), embedding)
-            ).order_by('distance')[:15]
+            # A blank mode means settings.SEARCH_MODE, which may be 'seeds' too
+            mode = form.cleaned_data.get('mode') or settings.SEARCH_MODE
+
+            # Now rank Snippets (or whole Seeds) in the accessible gardens
+            results = await arun_search(request.user, search_text, mode=mode, limit=15,
+                                        ef_search=form.cleaned_data.get('ef_search'))
+            if mode == 'seeds':
+                seeds = results
+            else:
+                parts = results
 
     return render(request, 'thoughts/search_and_display.html', {
         'form': form,
         'parts': parts,
+        'seeds': seeds,
         'search_text': search_text,
     })
 
-@login_required
-def find_similar_seeds(request, snippet_id):
+@async_login_required
+async def search_json(request):
+    # Same as search_seeds, for scripts and the frontend: ?search_text=...&mode=...&limit=...&ef_search=...
+    form = SearchForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    limit = request.GET.get('limit', '')
+    limit = min(int(limit), 50) if limit.isdigit() and int(limit) > 0 else 15
+    mode = form.cleaned_data.get('mode') or settings.SEARCH_MODE
+
+    results = await arun_search(request.user, form.cleaned_data['search_text'], mode=mode, limit=limit,
+                                ef_search=form.cleaned_data.get('ef_search'))
+    if mode == 'seeds':
+        results = [{
+            'id': seed.id,
+            'title': seed.title,
+            'author': seed.author,
+            'distance': seed.distance,
+            'url': reverse('seed_detail_view', kwargs={'pk': seed.id}),
+        } for seed in results]
+    else:
+        for part in results:
+            score = getattr(part, 'score', getattr(part, 'rank', None))
+            part.score = float(score) if score is not None else None
+        results = [{
+            'id': part.id,
+            'content': part.content,
+            'seed': {'id': part.seed.id, 'title': part.seed.title},
+            # Distance for vector modes, fused rank score for hybrid, text rank for lexical
+            'distance': getattr(part, 'distance', None),
+            'score': part.score,
+            'url': reverse('seed_detail_view', kwargs={'pk': part.seed.id}) + f"?highlight={part.id}",
+        } for part in results]
+    return JsonResponse({'results': results})
+
+@async_login_required
+async def find_similar_seeds(request, snippet_id):
     # Fetch the Idea Part based on the given ID
-    target_part = get_object_or_404(Snippet, pk=snippet_id)
-    target_embedding = target_part.embedding  # Assuming the embedding is stored in the 'embedding' field
+    try:
+        target_part = await Snippet.objects.select_related('garden', 'seed').aget(pk=snippet_id)
+    except Snippet.DoesNotExist:
+        raise Http404("No snippet matches the given query.")
     
-    similar_parts = filter_snippets_for_user(request.user).annotate(
-        distance=L2Distance(F('embedding'), target_embedding)
-    ).exclude(id=snippet_id).order_by('distance')[:6]
+    # Optional recall knob for the vector index, e.g. ?ef_search=200, capped like SearchForm's (pgvector allows 1000)
+    ef_search = request.GET.get('ef_search', '')
+    max_ef_search = SearchForm.base_fields['ef_search'].max_value
+    ef_search = min(int(ef_search), max_ef_search) if ef_search.isdigit() and int(ef_search) > 0 else None
+
+    similar_parts = await sync_to_async(search_similar_snippets)(request.user, target_part, limit=6, ef_search=ef_search)
     
     return render(request, 'thoughts/similar_seeds.html', {
         'similar_parts': similar_parts,
@@ -124,11 +199,18 @@ def process_youtube_url(request):
         if not youtube_url:
             return HttpResponse("No YouTube URL provided.", status=400)
         
+        job = start_ingestion_job(request.user, youtube_url)
         try:
+            # A video the user already has is linked or cloned, not fetched and embedded again
+            seed = ingest_known_source(request.user, source_key_for_url(youtube_url), job=job)
+            if seed:
+                return redirect('seed_detail_view', pk=seed.pk)
+
             # Extract captions or relevant text from the YouTube video.
             caption_text_list, caption_text = extract_text_from_youtube(youtube_url)
             
             # Create a new idea or entity in your system based on the YouTube video.
+            job.advance(IngestionJob.TAG)
             seed = create_seed_from_youtube(youtube_url, caption_text, request.user)
 
             # Download video to default storage if 'download_video' is checked.
@@ -137,40 +219,19 @@ def process_youtube_url(request):
 
             # Break down the caption text into chunks and process asynchronously.
             if seed:
-                for chunk in caption_text_list:
-                    try:
-                        chunk_text = chunk['text']
-                        chunk_start_time = chunk['start_time'] if 'start_time' in chunk else None
-                    except KeyError:
-                        return HttpResponse("Invalid format for caption text.", status=400)
-                    async_task('thoughts.main_logic.create_snippet_from', chunk_text, seed, request.user, group=str(seed.pk), start_time=chunk_start_time)
+                if any('text' not in chunk for chunk in caption_text_list):
+                    job.fail("Invalid format for caption text.")
+                    return HttpResponse("Invalid format for caption text.", status=400)
+                queue_chunks(job, seed, caption_text_list)
             # Optional: Further processing with caption_text or idea.
         except Exception as e:
+            job.fail(e)
             return HttpResponse(f"Error processing YouTube URL: {str(e)}", status=500)
         
         return redirect('seed_detail_view', pk=seed.pk) 
     else:
         return HttpResponse("Invalid request method.", status=405)
 
-def process_file_async(uploaded_file, seed, user_id, upload_to_s3):
-    User = get_user_model()
-    user = User.objects.get(id=user_id)  
-    if upload_to_s3:
-        username = user.username
-        safe_filename = slugify(uploaded_file.name.rsplit('.', 1)[0])[:50]
-        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-        extension = uploaded_file.name.rsplit('.', 1)[-1] if '.' in uploaded_file.name else ''
-        unique_filename = f"{username}/{safe_filename}_{timestamp}_{uuid.uuid4().hex[:8]}.{extension}"
-        try:
-            saved_path = default_storage.save(unique_filename, uploaded_file)
-            seed.reserve_file = saved_path
-            seed.save()
-        except Exception as e:
-            logger.error(f"Failed to save file for user {username}: {str(e)}")
-            raise
-    return None
-
-
 @login_required
 def upload_and_process_file_view(request):
     if request.method == 'POST':
@@ -183,21 +244,33 @@ def upload_and_process_file_view(request):
             upload_to_s3 = form.cleaned_data.get('upload_to_s3')
             
             user = request.user
-            
-            # Determine file type and process
-            if uploaded_file.name.endswith('.pdf'):
-                text = extract_text_from_pdf(uploaded_file)
-            elif uploaded_file.name.endswith('.docx'):
-                text = extract_text_from_docx(uploaded_file)
-            else:
-                return "Unsupported file type."
 
-            # Process the extracted text
-            seed = process_and_create_embeddings(text, seed_title, user)
-            task_id = async_task('thoughts.views.process_file_async', uploaded_file, seed, request.user.id, upload_to_s3)
-
-            # Provide feedback to user that the file is being processed
-            return redirect('seed_detail_view', pk=seed.pk) 
+            # The same file uploaded before is linked or cloned instead of extracted and embedded again
+            source_key = source_key_for_file(uploaded_file)
+            seed = ingest_known_source(user, source_key)
+            if seed:
+                return redirect('seed_detail_view', pk=seed.pk)
+            
+            if not uploaded_file.name.endswith(('.pdf', '.docx')):
+                return HttpResponse("Unsupported file type.", status=400)
+
+            # Extraction of big documents takes a while, so the request only stores the file, creates the seed
+            # and queues the rest; the seed's page shows the progress until a worker has embedded it all
+            garden = Garden.objects.filter(owner=user).first()
+            if garden is None:
+                garden = Garden.objects.create(owner=user, name=f"{user.username}'s Garden")
+            job = start_ingestion_job(user, uploaded_file.name)
+            try:
+                with transaction.atomic():
+                    job.seed = Seed.objects.create(garden=garden, title=seed_title, source_key=source_key)
+            except IntegrityError:
+                # The same file was uploaded at the same moment, follow that upload instead
+                job.delete()
+                return redirect('seed_detail_view', pk=Seed.objects.get(garden=garden, source_key=source_key).pk)
+            job.save(update_fields=['seed', 'updated_at'])
+            name = save_upload(uploaded_file, user)
+            async_task('thoughts.files.ingest_uploaded_file', job.pk, name, upload_to_s3, group=str(job.seed.pk))
+            return redirect('seed_detail_view', pk=job.seed.pk)
 
     else:
         form = FileUploadForm()
@@ -209,39 +282,37 @@ def seed_detail_view(request, pk):
     #Look for seed only in the user's gardens
     seed = get_object_or_404(filter_seeds_for_user(request.user), pk=pk)
 
-    parts_list = seed.parts.all().order_by('id')
-    paginator = Paginator(parts_list, 10)
-    page_number = request.GET.get('page')
-    parts = paginator.get_page(page_number)
+    def ordinal_param(name):
+        value = request.GET.get(name, '')
+        return int(value) if value.isdigit() else None
 
     highlighted_part_id = request.GET.get('highlight')
     highlighted_part = None
-    previous_parts = []
-    after_parts = []
+    around = None
 
     if highlighted_part_id:
         try:
-            highlighted_part = Snippet.objects.get(id=highlighted_part_id, seed=seed)
-            # Find the index of the highlighted part
-            highlighted_index = list(parts_list).index(highlighted_part)
-            # Calculate the correct page number based on the index
-            correct_page_number = highlighted_index // paginator.per_page + 1
-            
-            # Adjust the page number to ensure the highlighted part is on the current page
-            page_number = correct_page_number
+            highlighted_part = seed.parts.only('id', 'ordinal').get(id=highlighted_part_id)
+            # The page holding the highlighted part follows from its ordinal, no need to count what's before it
+            around = highlighted_part.ordinal
         except (Snippet.DoesNotExist, ValueError):
             # Handle cases where the snippet does not exist or is not in the list
             highlighted_part = None
 
-    # Get the parts for the adjusted or initial page number
-    parts = paginator.get_page(page_number)
+    parts, has_previous, has_next = page_snippets(
+        seed, per_page=10, after=ordinal_param('after'), before=ordinal_param('before'),
+        around=around, last='last' in request.GET,
+    )
+
+    ingestion_job = seed.ingestion_jobs.order_by('-created_at').first()
 
     return render(request, 'thoughts/seed_detail.html', {
         'seed': seed,
+        'ingestion_job': ingestion_job,
         'parts': parts,
+        'has_previous': has_previous,
+        'has_next': has_next,
         'highlighted_part': highlighted_part,
-        'previous_parts': previous_parts,
-        'after_parts': after_parts,
     })
 
 @login_required